@@ -0,0 +1,75 @@
+import argparse
+import os
+import pathlib
+import pickle
+import random
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import List, Optional
+
+from data import ChatState
+from db.chatstate import ChatStateStore
+
+
+def create_state(chat_id: int) -> ChatState:
+    state: ChatState = ChatState()
+    state.chat_id = chat_id
+    state.current_handler_name = 'trivia'
+    state.last_time = time.time()
+    state.data = {'action': 'question', 'answers': ['Paris', 'London', 'Rome', 'Madrid']}
+    return state
+
+
+def retrieve_pickle(folder: pathlib.Path, chat_id: int) -> Optional[ChatState]:
+    # Lookup as done by Chat.retrieve_chat_state before the state store
+    if not folder.exists():
+        return None
+    filename: pathlib.Path = folder.joinpath(f'{chat_id}.pickle')
+    if filename.exists():
+        with open(str(filename), 'rb') as fobj:
+            return pickle.load(fobj)
+    return None
+
+
+def time_lookups(lookup, chat_ids: List[int]) -> float:
+    start: float = time.perf_counter()
+    for chat_id in chat_ids:
+        lookup(chat_id)
+    return (time.perf_counter() - start) / len(chat_ids) * 1e6
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Compare chat state lookup cost per message')
+    parser.add_argument('--chats', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=50000)
+    parser.add_argument('--cache-size', type=int, default=10000)
+    parser.add_argument('--with-state', type=float, default=0.1, help='fraction of looked up chats with a session')
+    args: Namespace = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder: pathlib.Path = pathlib.Path(tmp).joinpath('chat')
+        folder.mkdir()
+        store: ChatStateStore = ChatStateStore(os.path.join(tmp, 'chat_state.sqlite'), args.cache_size)
+        stateful: int = int(args.chats * args.with_state)
+        for chat_id in range(stateful):
+            with open(str(folder.joinpath(f'{chat_id}.pickle')), 'wb') as fobj:
+                pickle.dump(create_state(chat_id), fobj)
+        store.import_pickles(str(folder))
+        folder = folder.with_name('chat.imported')
+
+        rng: random.Random = random.Random(1)
+        # Uniform over all chats: most lookups miss the cache
+        cold_ids: List[int] = [rng.randrange(args.chats) for _ in range(args.lookups)]
+        # Active chats only, which fit in the cache
+        hot_ids: List[int] = [rng.randrange(args.cache_size) for _ in range(args.lookups)]
+
+        print(f'chats: {args.chats}, with state: {stateful}, lookups: {args.lookups}, cache size: {args.cache_size}')
+        print(f'pickle directory, uniform:    {time_lookups(lambda c: retrieve_pickle(folder, c), cold_ids):8.2f} us/lookup')
+        print(f'ChatStateStore, uniform:      {time_lookups(store.get, cold_ids):8.2f} us/lookup')
+        print(f'pickle directory, active set: {time_lookups(lambda c: retrieve_pickle(folder, c), hot_ids):8.2f} us/lookup')
+        time_lookups(store.get, hot_ids)
+        store.hits = store.misses = 0
+        print(f'ChatStateStore, active set:   {time_lookups(store.get, hot_ids):8.2f} us/lookup '
+              f'(hit rate {store.hits / (store.hits + store.misses):.0%})')
+        store.close()
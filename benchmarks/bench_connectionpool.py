@@ -0,0 +1,84 @@
+import argparse
+import http.server
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser, Namespace
+from typing import Optional
+
+from bot.connectionpool import HttpConnectionPool
+
+RESPONSE_BODY: bytes = b'{"ok": true, "result": []}'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(certfile: Optional[str], keyfile: Optional[str]) -> http.server.ThreadingHTTPServer:
+    server: http.server.ThreadingHTTPServer = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    if certfile is not None:
+        context: ssl.SSLContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_urllib(url: str, body: bytes, count: int, context: Optional[ssl.SSLContext]) -> float:
+    start: float = time.perf_counter()
+    for _ in range(count):
+        with urllib.request.urlopen(urllib.request.Request(url, body), context=context) as response:
+            response.read()
+    return count / (time.perf_counter() - start)
+
+
+def run_pool(pool: HttpConnectionPool, path: str, body: bytes, count: int) -> float:
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    start: float = time.perf_counter()
+    for _ in range(count):
+        pool.request('POST', path, body, headers, timeout=10.)
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Compare Bot.call transports against a local stand-in server')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--certfile', help='serve over TLS with this certificate')
+    parser.add_argument('--keyfile')
+    args: Namespace = parser.parse_args()
+
+    srv: http.server.ThreadingHTTPServer = start_server(args.certfile, args.keyfile)
+    port: int = srv.server_address[1]
+    use_ssl: bool = args.certfile is not None
+    client_context: Optional[ssl.SSLContext] = ssl._create_unverified_context() if use_ssl else None
+    action_path: str = '/botTOKEN/sendMessage'
+    params: bytes = urllib.parse.urlencode({'chat_id': 1, 'text': 'benchmark'}).encode('ascii')
+    scheme: str = 'https' if use_ssl else 'http'
+
+    urllib_rps: float = run_urllib(f'{scheme}://127.0.0.1:{port}{action_path}', params, args.requests, client_context)
+    http_pool: HttpConnectionPool = HttpConnectionPool('127.0.0.1', port, use_ssl=use_ssl, ssl_context=client_context)
+    pool_rps: float = run_pool(http_pool, action_path, params, args.requests)
+    http_pool.close()
+    srv.shutdown()
+
+    print(f'transport: {scheme}, requests: {args.requests}')
+    print(f'urllib.request (new connection per call): {urllib_rps:10.1f} req/s')
+    print(f'HttpConnectionPool (keep-alive):          {pool_rps:10.1f} req/s '
+          f'({http_pool.connections_created} connection(s) opened)')
+    print(f'speed-up: {pool_rps / urllib_rps:.2f}x')
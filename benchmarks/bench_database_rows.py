@@ -0,0 +1,78 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable, List, Tuple
+
+import utils
+from db.database import Database, DataRow, DataTable, Table
+
+
+def row_to_tuple_scanning(table: Table, row: DataRow) -> Tuple:
+    # Table.row_to_tuple_for_insert before the table layouts: one scan of the columns per value
+    res: List = [None] * len(table.columns)
+    for key in row.items:
+        index: int = [i for i, col in enumerate(table.columns) if key == col.name][0]
+        res[index] = row.items[key]
+    return tuple(res)
+
+
+def query_scanning(database: Database, connection: sqlite3.Connection, table_name: str) -> DataTable:
+    # Database.query before the table layouts
+    dt: DataTable = DataTable(table_name)
+    table: Table = [t for t in database.tables if t.name == table_name][0]
+    column_names: List[str] = [c.name for c in table.columns]
+    cursor: sqlite3.Cursor = connection.cursor()
+    cursor.execute(f'SELECT {", ".join(column_names)} FROM [{table_name}];')
+    for row_tuple in cursor.fetchall():
+        row: DataRow = DataRow(table_name, row_tuple[utils.first_index_of(column_names, table.primary_key)])
+        for column_name in column_names:
+            idx: List[int] = utils.index_of(column_names, column_name)
+            if len(idx) > 0:
+                row.put(column_name, row_tuple[idx[0]])
+        dt.merge_rows([row])
+    return dt
+
+
+def rows_per_second(action: Callable[[], object], rows: int) -> float:
+    start: float = time.perf_counter()
+    action()
+    return rows / (time.perf_counter() - start)
+
+
+def create_rows(count: int) -> List[DataRow]:
+    res: List[DataRow] = []
+    for i in range(count):
+        row: DataRow = DataRow('message', i)
+        row.put('id_message', i)
+        row.put('id_user', 1)
+        row.put('id_chat', 1)
+        row.put('date', 1600000000 + i)
+        row.put('text', f'message {i}')
+        res.append(row)
+    return res
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Rows/s of the Database row conversion and query paths')
+    parser.add_argument('--rows', type=int, default=200000)
+    args: Namespace = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        database.create_tables()
+        table: Table = database.get_table('message')
+        rows: List[DataRow] = create_rows(args.rows)
+
+        print(f'message table, {args.rows} rows')
+        print(f'row to tuple, column scan:   {rows_per_second(lambda: [row_to_tuple_scanning(table, r) for r in rows], args.rows):12.0f} rows/s')
+        print(f'row to tuple, table layout:  {rows_per_second(lambda: [table.row_to_tuple_for_insert(r) for r in rows], args.rows):12.0f} rows/s')
+        connection: sqlite3.Connection = database.create_connection()
+        print(f'insert_rows:                 {rows_per_second(lambda: database.insert_rows(connection, rows), args.rows):12.0f} rows/s')
+        connection.commit()
+        print(f'query all, column scan:      {rows_per_second(lambda: query_scanning(database, connection, "message"), args.rows):12.0f} rows/s')
+        print(f'query all, table layout:     {rows_per_second(lambda: database.query(connection, "message", None, False), args.rows):12.0f} rows/s')
+        connection.close()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Dict, List, Set
+
+from data import Update
+from db.database import Database, DataRow, DataSet, DataTable
+
+
+def save_data_set_select_ids(database: Database, connection: sqlite3.Connection, data_set: DataSet) -> None:
+    # Save path used before the upsert: read every primary key of the table, then insert or update
+    for table_name in data_set.tables:
+        data_table: DataTable = data_set.tables[table_name]
+        existing_ids: Set = database.get_existing_ids(connection, table_name)
+        new_rows: List[DataRow] = [r for r in data_table.rows.values() if r.identity not in existing_ids]
+        database.insert_rows(connection, new_rows)
+        existing_rows: List[DataRow] = [r for r in data_table.rows.values() if r.identity in existing_ids]
+        database.update_rows(connection, existing_rows)
+
+
+def populate(database: Database, messages: int) -> None:
+    with database.create_connection() as connection:
+        connection.execute('INSERT INTO [user] (id_user, is_bot, first_name) VALUES (1, 0, \'bench\');')
+        connection.execute('INSERT INTO [chat] (id_chat, type) VALUES (1, \'private\');')
+        connection.executemany('INSERT INTO [message] (id_message, id_user, id_chat, date, text) VALUES (?, 1, 1, 0, ?);',
+                               ((i, f'message {i}') for i in range(messages)))
+        connection.executemany('INSERT INTO [update] (id_update, id_message) VALUES (?, ?);',
+                               ((i, i) for i in range(messages)))
+    connection.close()
+
+
+def time_saves(database: Database, data_sets: List[DataSet], save) -> float:
+    connection: sqlite3.Connection = database.create_connection()
+    start: float = time.perf_counter()
+    for data_set in data_sets:
+        save(connection, data_set)
+        connection.commit()
+    elapsed: float = time.perf_counter() - start
+    connection.close()
+    return elapsed / len(data_sets) * 1e3
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Time saving one update into a large message table')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--saves', type=int, default=20)
+    args: Namespace = parser.parse_args()
+
+    with open('test/testfiles/update.json') as fobj:
+        update_json: Dict = json.load(fobj)
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        database.create_tables()
+        populate(database, args.messages)
+
+        def make_data_sets(first_id: int) -> List[DataSet]:
+            res: List[DataSet] = []
+            for i in range(args.saves):
+                update_json['update_id'] = first_id + i
+                update_json['message']['message_id'] = first_id + i
+                res.append(Update.from_json(update_json).to_data_set)
+            return res
+
+        select_ms: float = time_saves(database, make_data_sets(args.messages),
+                                      lambda c, ds: save_data_set_select_ids(database, c, ds))
+        upsert_ms: float = time_saves(database, make_data_sets(args.messages + args.saves), database.save_data_set)
+
+    print(f'existing messages: {args.messages}, saves: {args.saves}')
+    print(f'select all ids + insert/update: {select_ms:9.3f} ms/update')
+    print(f'upsert (ON CONFLICT DO UPDATE): {upsert_ms:9.3f} ms/update')
+    print(f'speed-up: {select_ms / upsert_ms:.0f}x')
@@ -0,0 +1,80 @@
+import argparse
+import gc
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from typing import Any, Callable, Dict, List
+
+from db.database import DataRow, DataSet, DataTable
+
+
+class DictDataRow(object):
+    # DataRow before the shared row schemas: one items dict per row
+    def __init__(self, table_name: str, identity: object):
+        self.identity = identity
+        self.table_name = table_name
+        self.items: Dict[str, object] = {}
+
+    def put(self, key: str, value: object) -> None:
+        self.items[key] = value
+
+    def get(self, key: str) -> Any:
+        return self.items[key]
+
+
+def merge_with_lists(target: DataTable, other: DataTable) -> None:
+    # DataTable.merge before: rows copied through a temporary list, table name checked per row
+    for row in list(other.rows.values()):
+        if row.table_name == target.table_name and row.identity not in target.rows:
+            target.rows[row.identity] = row
+
+
+def create_rows(row_type: type, count: int) -> List:
+    res: List = []
+    for i in range(count):
+        row = row_type('message', i)
+        row.put('id_message', i)
+        row.put('id_user', i % 1000)
+        row.put('id_chat', i % 1000)
+        row.put('date', 1600000000 + i)
+        row.put('text', None)
+        res.append(row)
+    return res
+
+
+def bytes_per_row(row_type: type, count: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    rows: List = create_rows(row_type, count)
+    size: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return size / count
+
+
+def merge_rows_per_second(rows: List, merge: Callable[[DataTable, DataTable], None]) -> float:
+    source: DataTable = DataTable('message')
+    for row in rows:
+        source.rows[row.identity] = row
+    target: DataTable = DataTable('message')
+    start: float = time.perf_counter()
+    merge(target, source)
+    return len(rows) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Row size and merge throughput of DataRow')
+    parser.add_argument('--rows', type=int, default=1000000)
+    args: Namespace = parser.parse_args()
+
+    print(f'synthetic message table, {args.rows} rows')
+    print(f'bytes/row, items dict:    {bytes_per_row(DictDataRow, args.rows):8.1f}')
+    print(f'bytes/row, slots + schema: {bytes_per_row(DataRow, args.rows):8.1f}')
+    rows: List[DataRow] = create_rows(DataRow, args.rows)
+    print(f'merge, temporary list: {merge_rows_per_second(rows, merge_with_lists):12.0f} rows/s')
+    print(f'merge, DataTable.merge: {merge_rows_per_second(rows, DataTable.merge):11.0f} rows/s')
+    data_set: DataSet = DataSet()
+    start: float = time.perf_counter()
+    for row in rows:
+        data_set.merge_row(row)
+    print(f'DataSet.merge_row:      {args.rows / (time.perf_counter() - start):11.0f} rows/s')
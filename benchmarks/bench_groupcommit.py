@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Dict, List
+
+from data import Message
+from db.database import Database, UnitOfWork
+
+
+def create_messages(count: int, first_id: int) -> List[Message]:
+    with open('test/testfiles/update.json') as fobj:
+        message_json: Dict = json.load(fobj)['message']
+    res: List[Message] = []
+    for i in range(count):
+        message_json['message_id'] = first_id + i
+        res.append(Message.from_json(message_json))
+    return res
+
+
+def open_database(filename: str, synchronous: str) -> Database:
+    database: Database = Database.load_from_json_file('db_definition.json')
+    database.filename = filename
+    database.connection_settings.synchronous = synchronous
+    database.create_tables()
+    return database
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Saving sent messages one commit each vs grouped')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--synchronous', default='normal', help='normal or full (fsync on every commit)')
+    args: Namespace = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = open_database(os.path.join(tmp, 'bench.sqlite'), args.synchronous)
+        messages: List[Message] = create_messages(args.messages, 1)
+        start: float = time.perf_counter()
+        for message in messages:
+            database.save(message)
+        save_s: float = time.perf_counter() - start
+
+        messages = create_messages(args.messages, args.messages + 1)
+        work: UnitOfWork = database.unit_of_work(max_objects=100, max_delay=0.05)
+        start = time.perf_counter()
+        for message in messages:
+            work.add(message)
+        work.close()
+        grouped_s: float = time.perf_counter() - start
+        metrics: Dict[str, float] = work.metrics()
+        database.close()
+
+    print(f'{args.messages} sent messages, synchronous={args.synchronous}')
+    print(f'Database.save per message: {args.messages / save_s:9.0f} messages/s')
+    print(f'unit_of_work(100, 50 ms):  {args.messages / grouped_s:9.0f} messages/s, '
+          f'{metrics["commits"]} commits, {metrics["rows_per_commit"]:.0f} rows/commit, '
+          f'avg commit {metrics["avg_commit_seconds"] * 1e3:.2f} ms')
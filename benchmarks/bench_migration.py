@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Dict, List
+
+from db.database import Database, Table
+from db.migration import SchemaMigrator
+
+
+def recreate_table(connection: sqlite3.Connection, database: Database, table: Table) -> None:
+    # Database.recreate_table, run by create_tables before the online migrations
+    curr_table: Table = database.get_current_table(connection, table.name)
+    columns_str: str = ', '.join([c.name for c in curr_table.columns])
+    connection.execute(f'ALTER TABLE [{table.name}] RENAME TO [{table.name}_bk];')
+    connection.execute(table.get_create_cmd())
+    connection.execute(f'INSERT INTO [{table.name}]({columns_str}) SELECT {columns_str} FROM [{table.name}_bk];')
+    connection.execute(f'DROP TABLE [{table.name}_bk];')
+
+
+def populate(filename: str, definition: Dict, messages: int) -> None:
+    database: Database = Database.from_json(definition)
+    database.filename = filename
+    database.create_tables()
+    with database.transaction() as connection:
+        connection.executemany('INSERT INTO [message] (id_message, id_user, id_chat, date, text) VALUES (?, 1, ?, ?, ?);',
+                               ((i, i % 1000, 1600000000 + i, f'message {i}') for i in range(messages)))
+    database.close()
+
+
+def changed_definition(definition: Dict) -> Dict:
+    res: Dict = json.loads(json.dumps(definition))
+    message: Dict = [t for t in res['tables'] if t['name'] == 'message'][0]
+    text: Dict = [c for c in message['columns'] if c['name'] == 'text'][0]
+    text['type'] = 'bytes?' if text['type'] != 'bytes?' else 'str?'
+    return res
+
+
+def write_latencies(database: Database, stop: threading.Event, first_id: int) -> List[float]:
+    res: List[float] = []
+    id_message: int = first_id
+    while not stop.is_set():
+        start: float = time.perf_counter()
+        with database.transaction() as connection:
+            connection.execute('INSERT INTO [message] (id_message, id_user, id_chat, date) VALUES (?, 1, 1, 0);',
+                               (id_message,))
+        res.append(time.perf_counter() - start)
+        id_message += 1
+        time.sleep(0.005)
+    return res
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Startup time and write latency of a changed message table')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args: Namespace = parser.parse_args()
+
+    with open('db_definition.json') as fobj:
+        definition: Dict = json.load(fobj)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename: str = os.path.join(tmp, 'recreate.sqlite')
+        populate(filename, definition, args.messages)
+        database: Database = Database.from_json(changed_definition(definition))
+        database.filename = filename
+        start: float = time.perf_counter()
+        with database.transaction() as connection:
+            recreate_table(connection, database, database.get_table('message'))
+        recreate_s: float = time.perf_counter() - start
+        database.close()
+
+        filename = os.path.join(tmp, 'online.sqlite')
+        populate(filename, definition, args.messages)
+        database = Database.from_json(changed_definition(definition))
+        database.filename = filename
+        start = time.perf_counter()
+        database.create_tables()
+        startup_s: float = time.perf_counter() - start
+        stop: threading.Event = threading.Event()
+        latencies: List[float] = []
+        writer: threading.Thread = threading.Thread(
+            target=lambda: latencies.extend(write_latencies(database, stop, args.messages)))
+        writer.start()
+        migrator: SchemaMigrator = SchemaMigrator(database, batch_size=args.batch_size)
+        start = time.perf_counter()
+        migrator.run()
+        migration_s: float = time.perf_counter() - start
+        stop.set()
+        writer.join()
+        # The copy must have been swapped in with every row, including those written while it ran
+        connection = database.connection()
+        assert database.pending_migrations == [], 'message table was not migrated'
+        assert not database.table_exists(connection, 'message' + SchemaMigrator.COPY_SUFFIX)
+        assert database.get_current_table(connection, 'message').columns == database.get_table('message').columns
+        rows: int = connection.execute('SELECT COUNT(*) FROM [message];').fetchone()[0]
+        assert rows == args.messages + len(latencies), f'{rows} rows, expected {args.messages + len(latencies)}'
+        database.close()
+
+    latencies.sort()
+    print(f'message table, {args.messages} rows, text column type changed')
+    print(f'recreate_table at startup (blocking): {recreate_s:8.3f} s')
+    print(f'create_tables with online migration:  {startup_s:8.3f} s')
+    print(f'background copy, batch {args.batch_size}:      {migration_s:8.3f} s')
+    print(f'concurrent writes: {len(latencies)}, p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, '
+          f'max {latencies[-1] * 1e3:.2f} ms')
@@ -0,0 +1,86 @@
+import argparse
+import os
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable, List, Tuple
+
+from benchmarks.bench_objectprovider import populate
+from db.database import Database
+from objectprovider import ObjectCache, ObjectProvider, ObjectSession
+
+
+def startup_without_session(provider: ObjectProvider, database: Database) -> int:
+    # Bot.initialize before the sessions: tasks and chats loaded by independent queries
+    tasks: List = provider.query_objects(database, 'data.Task', None, None)
+    chats: List = provider.query_objects(database, 'data.Chat', None, None)
+    return len({id(t.chat) for t in tasks} | {id(c) for c in chats})
+
+
+def startup_with_session(provider: ObjectProvider, database: Database) -> int:
+    session: ObjectSession = provider.session(database)
+    tasks: List = session.query_objects('data.Task')
+    chats: List = session.query_objects('data.Chat')
+    return len({id(t.chat) for t in tasks} | {id(c) for c in chats})
+
+
+def broadcasts(load: Callable[[], List], count: int) -> float:
+    start: float = time.perf_counter()
+    for _ in range(count):
+        load()
+    return (time.perf_counter() - start) / count
+
+
+def lookups(provider: ObjectProvider, database: Database, chat_ids: List[int]) -> Tuple[float, float]:
+    # Seconds per chat looked up by id, without and with the session
+    start: float = time.perf_counter()
+    for id_chat in chat_ids:
+        provider.query_objects(database, 'data.Chat', 'id_chat=?', (id_chat,))
+    query_s: float = (time.perf_counter() - start) / len(chat_ids)
+    session: ObjectSession = provider.session(database)
+    session.query_objects('data.Chat')
+    start = time.perf_counter()
+    for id_chat in chat_ids:
+        session.get('data.Chat', id_chat)
+    return query_s, (time.perf_counter() - start) / len(chat_ids)
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Chat objects loaded at startup, by broadcasts and '
+                                                                 'by id, with and without sessions')
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--broadcasts', type=int, default=20)
+    args: Namespace = parser.parse_args()
+
+    provider: ObjectProvider = ObjectProvider.load_from_json_file('op_definition.json')
+    provider.cache = ObjectCache(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        database.create_tables()
+        populate(database, args.tasks, args.chats)
+        chat_ids: List[int] = [-(i % args.chats + 1) for i in range(args.tasks)]
+
+        start: float = time.perf_counter()
+        instances: int = startup_without_session(provider, database)
+        print(f'{args.tasks} tasks in {args.chats} chats')
+        print(f'startup, independent queries: {(time.perf_counter() - start) * 1e3:8.1f} ms, '
+              f'{instances} chat instances')
+        start = time.perf_counter()
+        instances = startup_with_session(provider, database)
+        print(f'startup, one session:         {(time.perf_counter() - start) * 1e3:8.1f} ms, '
+              f'{instances} chat instances')
+
+        query_s, session_s = lookups(provider, database, chat_ids)
+        print(f'chat by id, query:          {query_s * 1e6:8.2f} us')
+        print(f'chat by id, session:        {session_s * 1e6:8.2f} us')
+
+        print(f'broadcast chat list, no cache:      '
+              f'{broadcasts(lambda: provider.session(database).query_objects("data.Chat"), args.broadcasts) * 1e3:6.2f} ms')
+        provider.cache = ObjectCache(args.chats)
+        provider.session(database).query_objects('data.Chat')
+        print(f'broadcast chat list, warm cache:    '
+              f'{broadcasts(lambda: provider.session(database).query_objects("data.Chat"), args.broadcasts) * 1e3:6.2f} ms')
+        print(f'cache: {provider.cache.metrics()}')
+        database.close()
@@ -0,0 +1,67 @@
+import argparse
+import importlib
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable, List
+
+import utils
+from db.database import Database, DataRow, DataSet, DataTable
+from objectprovider import ObjectDefinition, ObjectProvider
+
+
+def query_properties_interpreted(provider: ObjectProvider, database: Database, connection: sqlite3.Connection,
+                                 object_name: str) -> List[object]:
+    # Row materialization before the compiled mappers: linear definition lookup, rows read into a DataSet, the class
+    # imported for every row and the property sources interpreted with setattr
+    object_definition: ObjectDefinition = utils.first_or_default_where(provider.object_definitions,
+                                                                       lambda d: d.object_name == object_name)
+    name_data = object_name.split('.')
+    module = '.'.join(name_data[:-1])
+    name = name_data[-1]
+    column_list: List[str] = [s.src_column for s in object_definition.property_sources]
+    ds: DataSet = database.raw_query(connection, object_definition.table_name, column_list, None, None)
+    dt: DataTable = ds.tables[object_definition.table_name]
+    res: List[object] = []
+    row: DataRow
+    for row in dt.rows.values():
+        object_instance = getattr(importlib.import_module(module), name)()
+        for property_source in object_definition.property_sources:
+            if property_source.type_ == 'property':
+                setattr(object_instance, property_source.name, row.items.get(property_source.src_column))
+        res.append(object_instance)
+    return res
+
+
+def objects_per_second(load: Callable[[], List[object]]) -> float:
+    start: float = time.perf_counter()
+    count: int = len(load())
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='data.Chat objects built per second')
+    parser.add_argument('--chats', type=int, default=100000)
+    args: Namespace = parser.parse_args()
+
+    provider: ObjectProvider = ObjectProvider.load_from_json_file('op_definition.json')
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        database.create_tables()
+        with database.transaction() as connection:
+            connection.executemany('INSERT INTO [chat] (id_chat, type, first_name, last_name) VALUES (?, ?, ?, ?);',
+                                   ((-i, 'private', f'first {i}', f'last {i}') for i in range(1, args.chats + 1)))
+        connection: sqlite3.Connection = database.create_connection()
+        interpreted: float = objects_per_second(
+            lambda: query_properties_interpreted(provider, database, connection, 'data.Chat'))
+        compiled: float = objects_per_second(
+            lambda: provider._query_objects(database, connection, 'data.Chat', None, None))
+        connection.close()
+        database.close()
+
+    print(f'{args.chats} data.Chat rows')
+    print(f'interpreted property sources: {interpreted:10.0f} objects/s')
+    print(f'compiled ObjectMapper:        {compiled:10.0f} objects/s')
@@ -0,0 +1,78 @@
+import argparse
+import importlib
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable, List, Tuple
+
+from db.database import Database, DataRow, DataSet, DataTable
+from objectprovider import ObjectDefinition, ObjectProvider
+
+
+def query_objects_per_row(provider: ObjectProvider, database: Database, connection: sqlite3.Connection,
+                          object_name: str, where_clause: str, query_params: Tuple) -> List[object]:
+    # ObjectProvider._query_objects before batching: one query per object or list property of every row
+    object_definition: ObjectDefinition = provider.get_object_definition(object_name)
+    name_data = object_name.split('.')
+    module = '.'.join(name_data[:-1])
+    name = name_data[-1]
+    column_list = [s.src_column for s in object_definition.property_sources if s.type_ in ('property', 'object')]
+    ds: DataSet = database.raw_query(connection, object_definition.table_name, column_list, where_clause, query_params)
+    dt: DataTable = ds.tables[object_definition.table_name]
+    res: List[object] = []
+    row: DataRow
+    for row in dt.rows.values():
+        object_instance = getattr(importlib.import_module(module), name)()
+        for property_source in object_definition.property_sources:
+            if property_source.type_ == 'property':
+                setattr(object_instance, property_source.name, row.items.get(property_source.src_column))
+            elif property_source.type_ == 'object':
+                child_object_id = row.get(property_source.src_column)
+                if child_object_id is not None:
+                    child_object = query_objects_per_row(provider, database, connection, property_source.object_name,
+                                                         property_source.src_column + '=?', (child_object_id,))[0]
+                    setattr(object_instance, property_source.name, child_object)
+        res.append(object_instance)
+    return res
+
+
+def populate(database: Database, tasks: int, chats: int) -> None:
+    with database.transaction() as connection:
+        connection.executemany('INSERT INTO [chat] (id_chat, type, first_name) VALUES (?, \'private\', ?);',
+                               ((-i, f'chat {i}') for i in range(1, chats + 1)))
+        connection.executemany('INSERT INTO [task] (id_task, id_chat) VALUES (?, ?);',
+                               ((f'task-{i}', -(i % chats + 1)) for i in range(tasks)))
+
+
+def measure(load: Callable[[sqlite3.Connection], List[object]], database: Database) -> Tuple[int, float, int]:
+    connection: sqlite3.Connection = database.create_connection()
+    queries: List[str] = []
+    connection.set_trace_callback(queries.append)
+    start: float = time.perf_counter()
+    objects: List[object] = load(connection)
+    elapsed: float = time.perf_counter() - start
+    connection.close()
+    return len(queries), elapsed, len(objects)
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Loading data.Task objects with their chats')
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--chats', type=int, default=1000)
+    args: Namespace = parser.parse_args()
+
+    provider: ObjectProvider = ObjectProvider.load_from_json_file('op_definition.json')
+    with tempfile.TemporaryDirectory() as tmp:
+        database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        database.create_tables()
+        populate(database, args.tasks, args.chats)
+        per_row = measure(lambda c: query_objects_per_row(provider, database, c, 'data.Task', None, None), database)
+        batched = measure(lambda c: provider._query_objects(database, c, 'data.Task', None, None), database)
+        database.close()
+
+    print(f'{args.tasks} tasks in {args.chats} chats')
+    print(f'one query per relationship and row: {per_row[0]:6d} queries, {per_row[1] * 1e3:8.1f} ms')
+    print(f'batched IN (...) per relationship:  {batched[0]:6d} queries, {batched[1] * 1e3:8.1f} ms')
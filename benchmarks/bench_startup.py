@@ -0,0 +1,33 @@
+import argparse
+import os
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from db.database import Database
+from utils import PhaseTimer
+
+
+def create_tables_ms(database: Database, force: bool, repeat: int) -> float:
+    start: float = time.perf_counter()
+    for _ in range(repeat):
+        database.create_tables(force=force)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Startup cost of Database.create_tables on an unchanged schema')
+    parser.add_argument('--repeat', type=int, default=200)
+    args: Namespace = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timer: PhaseTimer = PhaseTimer()
+        with timer.phase('Database.load_from_json_file'):
+            database: Database = Database.load_from_json_file('db_definition.json')
+        database.filename = os.path.join(tmp, 'bench.sqlite')
+        with timer.phase('Database.create_tables, new file'):
+            database.create_tables()
+        for name, seconds in timer.phases:
+            print(f'{name}: {seconds * 1e3:.2f} ms')
+        print(f'create_tables, full introspection: {create_tables_ms(database, True, args.repeat):7.3f} ms')
+        print(f'create_tables, fingerprint match:  {create_tables_ms(database, False, args.repeat):7.3f} ms')
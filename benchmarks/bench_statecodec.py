@@ -0,0 +1,51 @@
+import argparse
+import pickle
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable
+
+from db.chatstate import ChatState
+from db.statecodec import StateCodec
+from plugins.trivia.trivia import AnswerArrangement, TriviaQuestion
+
+
+def create_trivia_state() -> ChatState:
+    question: TriviaQuestion = TriviaQuestion.from_json({
+        'category': 'Geography', 'type': 'multiple', 'difficulty': 'medium',
+        'question': 'Which river flows through the city of Zaragoza?',
+        'correct_answer': 'Ebro', 'incorrect_answers': ['Tajo', 'Duero', 'Guadalquivir']})
+    state: ChatState = ChatState()
+    state.chat_id = 12345678
+    state.current_handler_name = 'trivia'
+    state.last_time = time.time()
+    state.data = {'action': 'question', 'question': question,
+                  'answers': AnswerArrangement.generate_random_from_question(question)}
+    return state
+
+
+def time_per_call(action: Callable[[], object], count: int) -> float:
+    start: float = time.perf_counter()
+    for _ in range(count):
+        action()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Compare the chat state codec against pickle')
+    parser.add_argument('--count', type=int, default=50000)
+    args: Namespace = parser.parse_args()
+
+    codec: StateCodec = StateCodec()
+    codec.register('trivia.question', TriviaQuestion)
+    codec.register('trivia.answers', AnswerArrangement)
+    state: ChatState = create_trivia_state()
+    pickled: bytes = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    encoded: bytes = codec.encode(state.data)
+
+    print(f'trivia question state, {args.count} iterations')
+    print(f'pickle:      {len(pickled):5d} bytes, encode {time_per_call(lambda: pickle.dumps(state, pickle.HIGHEST_PROTOCOL), args.count):6.2f} us, '
+          f'decode {time_per_call(lambda: pickle.loads(pickled), args.count):6.2f} us')
+    print(f'StateCodec:  {len(encoded):5d} bytes, encode {time_per_call(lambda: codec.encode(state.data), args.count):6.2f} us, '
+          f'decode {time_per_call(lambda: codec.decode(encoded), args.count):6.2f} us')
+    print(f'lazy load (routing only, data untouched): '
+          f'{time_per_call(lambda: ChatState.from_payload(1, "trivia", 0., encoded, codec), args.count):6.2f} us')
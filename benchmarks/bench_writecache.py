@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Dict, List
+
+from data import Update
+from db.database import Database, DataSet
+
+
+def create_data_sets(count: int) -> List[DataSet]:
+    # Updates from one user in one chat, as in a conversation with the bot
+    with open('test/testfiles/update.json') as fobj:
+        update_json: Dict = json.load(fobj)
+    res: List[DataSet] = []
+    for i in range(count):
+        update_json['update_id'] = i
+        update_json['message']['message_id'] = i
+        res.append(Update.from_json(update_json).to_data_set)
+    return res
+
+
+def save_all(filename: str, data_sets: List[DataSet], write_cache: bool) -> float:
+    database: Database = Database.load_from_json_file('db_definition.json')
+    database.filename = filename
+    for table in database.tables:
+        if not write_cache:
+            table.write_cache = False
+    database.create_tables()
+    start: float = time.perf_counter()
+    for data_set in data_sets:
+        with database.transaction() as connection:
+            database.save_data_set(connection, data_set)
+    elapsed: float = time.perf_counter() - start
+    if write_cache:
+        print(f'write cache: {database.write_cache.metrics()}')
+    database.close()
+    return elapsed / len(data_sets) * 1e6
+
+
+if __name__ == '__main__':
+    parser: ArgumentParser = argparse.ArgumentParser(description='Saving updates whose user and chat rows repeat')
+    parser.add_argument('--updates', type=int, default=20000)
+    args: Namespace = parser.parse_args()
+
+    data_sets: List[DataSet] = create_data_sets(args.updates)
+    with tempfile.TemporaryDirectory() as tmp:
+        upsert_us: float = save_all(os.path.join(tmp, 'upsert.sqlite'), data_sets, False)
+        cached_us: float = save_all(os.path.join(tmp, 'cached.sqlite'), data_sets, True)
+    print(f'{args.updates} updates from one user and chat')
+    print(f'upsert every row:        {upsert_us:8.1f} us/update')
+    print(f'skip unchanged user/chat: {cached_us:7.1f} us/update')
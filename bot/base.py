@@ -1,11 +1,24 @@
-from typing import Union, List, Dict
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Union, List, Dict, Optional
 
 from data import CallbackQuery, Message, ChatState, GetUpdatesResponse, Chat
+from bot.routing import RoutingIndex
 from db.database import Database
+from db.statecodec import StateCodec
 from scheduler import Scheduler
 from textformatting import TextFormatter, MessageStyle
 
 
+class TelegramError(RuntimeError):
+    def __init__(self, message: str, error_code: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.error_code: int = error_code
+        self.description: str = description
+        self.retry_after: Optional[float] = retry_after
+
+
 class InlineKeyboardButton(object):
     def __init__(self):
         self.text: str = ''
@@ -47,6 +60,11 @@ class BotBase(object):
         self.tokens: Dict[str, str] = {}
         self.scheduler: Scheduler = None
         self.message_handlers: Dict[str, type] = {}
+        self.handler_instances: Dict[str, 'MessageHandlerBase'] = {}
+        self.handler_locks: Dict[str, threading.Lock] = {}
+        self.routing: RoutingIndex = RoutingIndex()
+        # Plugins register the classes their handlers keep in ChatState.data
+        self.state_codec: StateCodec = StateCodec()
 
     def get_updates(self) -> GetUpdatesResponse:
         raise NotImplementedError()
@@ -57,6 +75,9 @@ class BotBase(object):
     def send_message(self, chat: Chat, text: Union[str, TextFormatter], style: MessageStyle) -> Message:
         raise NotImplementedError()
 
+    def post_message(self, chat: Chat, text: Union[str, TextFormatter], style: MessageStyle) -> Future:
+        raise NotImplementedError()
+
     def broadcast(self, text: Union[str, TextFormatter], style: MessageStyle) -> Message:
         raise NotImplementedError()
 
@@ -72,16 +93,56 @@ class BotBase(object):
     def stop(self):
         self.running = False
 
-    def add_message_handler(self, handler_name: str, handler_type: type) -> None:
+    def add_message_handler(self, handler_name: str, handler_type: type, keywords: Optional[List[str]] = None,
+                            pattern: Optional[str] = None) -> None:
+        # Without keywords the handler receives every message; pattern is a WordParser spec the text must match
         if handler_name in self.message_handlers:
             raise ValueError(handler_name + ' already added.')
+        instance: MessageHandlerBase = handler_type()
+        instance.handler_name = handler_name
+        self.routing.add(handler_name, keywords, pattern)
         self.message_handlers[handler_name] = handler_type
+        self.handler_instances[handler_name] = instance
+        if not instance.thread_safe:
+            self.handler_locks[handler_name] = threading.Lock()
+
+    def start_handlers(self) -> None:
+        # A failing handler is logged and removed without keeping the others from starting, so it gets no updates
+        for handler_name in list(self.handler_instances):
+            try:
+                self.handler_instances[handler_name].on_start(self)
+            except Exception as e:
+                logging.exception(e)
+                self.remove_message_handler(handler_name)
+
+    def remove_message_handler(self, handler_name: str) -> None:
+        self.routing.remove(handler_name)
+        self.handler_instances.pop(handler_name, None)
+        self.handler_locks.pop(handler_name, None)
+
+    def stop_handlers(self) -> None:
+        for handler_name in self.handler_instances:
+            try:
+                self.handler_instances[handler_name].on_stop(self)
+            except Exception as e:
+                logging.exception(e)
 
 
 class MessageHandlerBase(object):
+    # One instance per handler serves every chat for the lifetime of the bot, and with several dispatcher workers
+    # its methods run concurrently. Handlers keeping mutable state either guard it themselves or set thread_safe to
+    # False, in which case the bot never runs two of their calls at the same time.
+    thread_safe: bool = True
+
     def __init__(self):
         self.handler_name: str = ''
 
+    def on_start(self, bot: BotBase) -> None:
+        pass
+
+    def on_stop(self, bot: BotBase) -> None:
+        pass
+
     def process_message(self, message: Message, bot: BotBase, chat_state: ChatState = None) -> None:
         raise NotImplementedError()
 
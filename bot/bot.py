@@ -1,27 +1,40 @@
-import http.client
+import asyncio
 import json
 import logging
+import secrets
 import socket
 import subprocess
+import threading
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Optional, Set
 from typing import List, Union
 
 import utils
-from bot.base import BotBase, InlineKeyboardMarkup, MessageHandlerBase
+from bot.base import BotBase, InlineKeyboardMarkup, MessageHandlerBase, TelegramError
+from bot.connectionpool import HttpConnectionPool
+from bot.dispatcher import UpdateDispatcher
+from bot.offset import UpdateOffset
+from bot.outbox import OutboundQueue
+from bot.webhook import WebhookServer
 from bot.plugins import PluginCollection
-from data import GetUpdatesResponse, Chat, Message, BotConfig, ChatState, CallbackQuery, Task
-from db.database import Database, DataSet, DataRow
-from objectprovider import ObjectProvider
+from data import GetUpdatesResponse, Chat, Message, BotConfig, ChatState, CallbackQuery, Task, Update
+from db.chatstate import ChatStateStore
+from db.database import Database, DataSet, UnitOfWork
+from db.writebehind import WriteBehindWriter
+from objectprovider import ObjectProvider, ObjectSession
 from scheduler import Scheduler
 from scheduler import TaskExecutor
 from textformatting import TextFormatter, MessageStyle
 
 
 class Bot(BotBase, TaskExecutor):
+    LONG_POLL_MARGIN: float = 10.
+    # Seconds to wait for an update in flight to finish when a poll only returned updates already being processed
+    IN_FLIGHT_WAIT: float = 1.
+    # Actions that can be sent again when the response is lost; sendMessage and the like would be delivered twice
+    IDEMPOTENT_ACTIONS: Set[str] = {'getUpdates', 'getMe', 'getWebhookInfo', 'setWebhook', 'deleteWebhook'}
 
     def __init__(self, config: BotConfig, object_provider: ObjectProvider, database: Database):
         BotBase.__init__(self)
@@ -30,93 +43,249 @@ class Bot(BotBase, TaskExecutor):
         self.object_provider = object_provider  # type: ObjectProvider
         self.database = database  # type: Database
         self.plugin_collection = None  # type: PluginCollection
-
-    def initialize(self):
+        self.dispatcher: Optional[UpdateDispatcher] = None
+        self.http_pool: HttpConnectionPool = HttpConnectionPool('api.telegram.org', max_size=config.http_pool_size)
+        self.outbox: OutboundQueue = OutboundQueue(self.call, config.outbox_senders, config.outbox_global_rate)
+        self.update_offset: UpdateOffset = UpdateOffset(database, config.offset_checkpoint_interval)
+        # Cached objects are dropped only once the new rows are committed, so they cannot be read back stale
+        self.update_writer: WriteBehindWriter = WriteBehindWriter(database, config.write_queue_size,
+                                                                  config.write_batch_size,
+                                                                  on_written=object_provider.invalidate_data_set)
+        commit_interval: Optional[float] = config.message_commit_interval_ms / 1000. \
+            if config.message_commit_interval_ms > 0 else None
+        self.sent_messages: UnitOfWork = database.unit_of_work(config.message_commit_batch_size, commit_interval)
+        self.chat_states: ChatStateStore = ChatStateStore(config.chat_state_file, config.chat_state_cache_size,
+                                                          config.chat_state_ttl, config.chat_state_default_ttl,
+                                                          codec=self.state_codec)
+        Chat.state_store = self.chat_states
+
+    def initialize(self, startup: Optional[utils.PhaseTimer] = None):
+        startup = startup or utils.PhaseTimer(enabled=False)
+        self.outbox.start()
+        self.update_writer.start()
+        with startup.phase('ChatStateStore.open'):
+            self.chat_states.open()
         self.scheduler = Scheduler(self)
-        tasks = self.object_provider.query_objects(self.database, 'data.Task', None, None)  # type: List[Task]
-        for task in tasks:
-            self.scheduler.add_task(task)
+        with startup.phase('load tasks and chats'):
+            # One session for both queries: the chats of the tasks are built once and reused for the chat list
+            session: ObjectSession = self.object_provider.session(self.database)
+            tasks = session.query_objects('data.Task')  # type: List[Task]
+            for task in tasks:
+                self.scheduler.add_task(task)
+            chats: List[Chat] = session.query_objects('data.Chat')
         ip = utils.get_ip_address()
-        chats: List[Chat] = self.object_provider.query_objects(self.database, 'data.Chat', None, None)
         for chat in chats:
-            try:
-                self.send_message(chat, 'Pancho initialized in host {ip}'.format(ip=ip), MessageStyle.NONE)
-            except Exception as ex:
-                logging.error('Could not send message to chat {c}.'.format(c=chat.id_chat), ex)
-        self.plugin_collection = PluginCollection('plugins')
-        for plugin in self.plugin_collection:
-            try:
-                plugin.on_load(self)
-            except Exception as e:
-                logging.error('Could not load plugin {p}'.format(p=plugin.name()), e)
-                self.broadcast('Could not load plugin {p}'.format(p=plugin.name()), MessageStyle.NONE)
+            self.post_message(chat, 'Pancho initialized in host {ip}'.format(ip=ip), MessageStyle.NONE)
+        with startup.phase('PluginCollection walk'):
+            self.plugin_collection = PluginCollection('plugins')
+        with startup.phase('plugin on_load'):
+            for plugin in self.plugin_collection:
+                try:
+                    plugin.on_load(self)
+                except Exception as e:
+                    logging.error('Could not load plugin {p}'.format(p=plugin.name()), e)
+                    self.broadcast('Could not load plugin {p}'.format(p=plugin.name()), MessageStyle.NONE)
+        # After the plugins have registered their state types
+        with startup.phase('ChatStateStore.import_pickles'):
+            self.chat_states.import_pickles('chat')
+        self.chat_states.start_sweeper(self.config.chat_state_sweep_interval)
+        self.start_handlers()
 
     def run(self):
+        self.dispatcher = UpdateDispatcher(self.handle_update, self.config.worker_count, self.config.worker_queue_size,
+                                           on_done=lambda u: self.update_offset.complete(u.id_update))
+        self.dispatcher.start()
         while self.running:
             logging.info('Waiting for messages...')
             try:
                 response = self.get_updates()  # type: GetUpdatesResponse
                 for update in response.result:
-                    if update.message is not None:
-                        self.on_new_message(update.message)
-                    if update.callback_query is not None:
-                        self.on_new_callback_query(update.callback_query)
+                    self.dispatcher.submit(update)
+                logging.debug('Dispatcher queue depths: {d}'.format(d=self.dispatcher.queue_depths()))
+                logging.debug('Update writer: {m}'.format(m=self.update_writer.metrics()))
+                logging.debug('Chat states: {m}'.format(m=self.chat_states.metrics()))
+                logging.debug('Sent messages: {m}'.format(m=self.sent_messages.metrics()))
+                logging.debug('Row write cache: {m}'.format(m=self.database.write_cache.metrics()))
+                logging.debug('Object cache: {m}'.format(m=self.object_provider.cache.metrics()))
+                self.update_offset.checkpoint_if_due()
             except Exception as e:
                 logging.exception(e)
                 time.sleep(60)
+        self.dispatcher.stop()
+        self.shutdown()
+        logging.info('Stopped')
+
+    def run_webhook(self) -> None:
+        self.dispatcher = UpdateDispatcher(self.handle_update, self.config.worker_count, self.config.worker_queue_size)
+        self.dispatcher.start()
+        secret_token: str = self.get_webhook_secret()
+        webhook: WebhookServer = WebhookServer(self.receive_update,
+                                               self.config.webhook_host,
+                                               self.config.webhook_port,
+                                               self.config.webhook_path,
+                                               secret_token,
+                                               self.config.webhook_max_connections,
+                                               self.config.webhook_certfile,
+                                               self.config.webhook_keyfile)
+        webhook.start()
+        if self.config.webhook_url is not None:
+            self.call('setWebhook', {'url': self.config.webhook_url,
+                                     'max_connections': self.config.webhook_max_connections,
+                                     'secret_token': secret_token})
+        while self.running:
+            time.sleep(1)
+        webhook.stop()
+        self.dispatcher.stop()
+        self.shutdown()
+        logging.info('Stopped')
+
+    def get_webhook_secret(self) -> str:
+        secret_token: Optional[str] = self.config.tokens.get('webhook_secret')
+        if secret_token:
+            return secret_token
+        if self.config.webhook_url is None:
+            # The webhook is registered elsewhere, so a generated secret could not be handed to Telegram
+            raise ValueError('webhook_secret is missing from the token file')
+        logging.warning('webhook_secret is missing from the token file, registering a generated one')
+        return secrets.token_urlsafe(32)
+
+    def receive_update(self, update: Update) -> None:
+        self.save_updates([update])
+        self.dispatcher.submit(update)
+
+    def run_async(self) -> None:
+        asyncio.run(self._run_async())
+
+    async def _run_async(self) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=self.config.handler_threads,
+                                                          thread_name_prefix='handler')
+        # Polling gets its own thread so that a full handler pool never delays the next getUpdates
+        poll_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poll')
+        chat_locks: Dict[int, List] = {}
+        pending: Set[asyncio.Task] = set()
+        try:
+            while self.running:
+                logging.info('Waiting for messages...')
+                try:
+                    response: GetUpdatesResponse = await loop.run_in_executor(poll_executor, self.get_updates)
+                    for update in response.result:
+                        task: asyncio.Task = loop.create_task(self._handle_update_async(update, executor, chat_locks))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                        task.add_done_callback(lambda t, i=update.id_update: self.update_offset.complete(i))
+                    await loop.run_in_executor(poll_executor, self.update_offset.checkpoint_if_due)
+                except Exception as e:
+                    logging.exception(e)
+                    await asyncio.sleep(60)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            executor.shutdown(wait=True)
+            poll_executor.shutdown(wait=True)
+            self.shutdown()
         logging.info('Stopped')
 
+    def shutdown(self) -> None:
+        # Called once no more updates are being handled
+        self.update_writer.stop()
+        self.update_offset.checkpoint()
+        self.stop_handlers()
+        self.chat_states.close()
+        self.outbox.stop()
+        self.sent_messages.close()
+        self.http_pool.close()
+        self.database.close()
+
+    async def _handle_update_async(self, update: Update, executor: ThreadPoolExecutor,
+                                   chat_locks: Dict[int, List]) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        chat: Optional[Chat] = update.get_chat()
+        if chat is None:
+            try:
+                await loop.run_in_executor(executor, self.handle_update, update)
+            except Exception as e:
+                logging.exception(e)
+            return
+        # Updates of the same chat are handled in arrival order; the entry holds [lock, users]
+        entry: List = chat_locks.setdefault(chat.id_chat, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await loop.run_in_executor(executor, self.handle_update, update)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del chat_locks[chat.id_chat]
+
+    def handle_update(self, update: Update) -> None:
+        if update.message is not None:
+            self.on_new_message(update.message)
+        if update.callback_query is not None:
+            self.on_new_callback_query(update.callback_query)
+
     def base_url(self) -> str:
         return 'https://api.telegram.org/bot{t}/'.format(t=self.token)
 
     def call(self, action: str, params: Dict = None, timeout: float = socket._GLOBAL_DEFAULT_TIMEOUT) -> Dict:
+        path: str = '/bot{t}/{a}'.format(t=self.token, a=action)
         if params is not None:
-            req = urllib.request.Request(self.base_url() + action, urllib.parse.urlencode(utils.dict_to_url_params(params)).encode('ascii'))
+            body: Optional[bytes] = urllib.parse.urlencode(utils.dict_to_url_params(params)).encode('ascii')
+            status, reason, received_bytes = self.http_pool.request(
+                'POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'}, timeout=timeout,
+                idempotent=action in Bot.IDEMPOTENT_ACTIONS)
         else:
-            req = urllib.request.Request(self.base_url() + action)
-        try:
-            with urllib.request.urlopen(req) as response:  # type:  http.client.HTTPResponse
-                if response.status == 200:
-                    received_bytes = response.read()  # type: bytes
-                    received_str = received_bytes.decode("utf8")  # type: str
-                else:
-                    raise RuntimeError('Could not execute action {a}. Reason: {r}'.format(a=action, r=response.reason))
-        except urllib.error.URLError as e:
-            received_bytes = e.read()  # type: bytes
-            received_obj = json.loads(received_bytes.decode("utf8"))
-            raise RuntimeError('Could not execute action {a}. Error: {e}. Reason: {r}'.format(a=action, e=received_obj['error_code'], r=received_obj['description']))
-
-        # noinspection PyUnboundLocalVariable
+            status, reason, received_bytes = self.http_pool.request('GET', path, timeout=timeout)
+        received_str = received_bytes.decode("utf8")  # type: str
+        if status != 200:
+            try:
+                received_obj = json.loads(received_str)
+            except ValueError:
+                raise RuntimeError('Could not execute action {a}. Reason: {r}'.format(a=action, r=reason))
+            raise TelegramError('Could not execute action {a}. Error: {e}. Reason: {r}'.format(a=action, e=received_obj['error_code'], r=received_obj['description']),
+                                received_obj['error_code'],
+                                received_obj['description'],
+                                received_obj.get('parameters', {}).get('retry_after'))
+
         logging.info('Received response: {r}'.format(r=received_str))
         return json.loads(received_str)
 
     def get_updates(self) -> GetUpdatesResponse:
 
-        last_update_id = self.get_last_update_id()  # type: Optional[int]
-        if last_update_id is None:
-            json_resp = self.call('getUpdates', {"timeout": self.config.get_updates_timeout}, timeout=self.config.get_updates_timeout)
+        offset = self.update_offset.next_offset()  # type: Optional[int]
+        # Telegram holds the request open for up to get_updates_timeout seconds, so the socket waits a bit longer
+        socket_timeout: float = self.config.get_updates_timeout + Bot.LONG_POLL_MARGIN
+        if offset is None:
+            json_resp = self.call('getUpdates', {"timeout": self.config.get_updates_timeout}, timeout=socket_timeout)
         else:
-            json_resp = self.call('getUpdates', {"timeout": self.config.get_updates_timeout, "offset": last_update_id+1}, timeout=self.config.get_updates_timeout)
+            json_resp = self.call('getUpdates', {"timeout": self.config.get_updates_timeout, "offset": offset}, timeout=socket_timeout)
         res = GetUpdatesResponse.from_json(json_resp)  # type: GetUpdatesResponse
+        fetched: int = len(res.result)
+        # The offset only moves past an update once it has been handled and persisted, so the ones still in flight
+        # come back in the next poll and are dropped here
+        res.result = [r for r in res.result if self.update_offset.begin(r.id_update, 2)]
+        update_ids: List[int] = [r.id_update for r in res.result]
+
+        def persisted() -> None:
+            for update_id in update_ids:
+                self.update_offset.complete(update_id)
+
+        self.save_updates(res.result, persisted)
+        if fetched > 0 and len(res.result) == 0:
+            # Polling again at once would return the same updates
+            self.update_offset.wait_for_progress(Bot.IN_FLIGHT_WAIT)
+        return res
 
-        if len(res.result) == 0:
-            return res
+    def save_updates(self, updates: List[Update], on_done: Optional[Callable[[], None]] = None) -> None:
+        if len(updates) == 0:
+            return
 
         ds = DataSet()  # type: DataSet
-        for result in res.result:
+        for result in updates:
             ds.merge(result.to_data_set)
-
-        last_update_id = max(r.id_update for r in res.result)  # type: int
-        last_update_id_row = DataRow('parameter', 'last_update_id')
-        last_update_id_row.put('key', 'last_update_id')
-        last_update_id_row.put('value', str(last_update_id))
-        ds.merge_row(last_update_id_row)
-
-        connection = self.database.create_connection()
-        self.database.save_data_set(connection, ds)
-        connection.commit()
-
-        return res
+        self.update_writer.submit(ds, on_done)
 
     def send_admin(self, text: Union[str, TextFormatter], style: MessageStyle) -> List[Message]:
         # res = []
@@ -127,6 +296,22 @@ class Bot(BotBase, TaskExecutor):
         raise NotImplementedError()
 
     def send_message(self, chat: Chat, text: Union[str, TextFormatter], style: MessageStyle) -> Message:
+        return self.post_message(chat, text, style).result()
+
+    def post_message(self, chat: Chat, text: Union[str, TextFormatter], style: MessageStyle) -> Future:
+        return self._post(chat, 'sendMessage', self._message_params(chat, text, style))
+
+    def broadcast(self, text: Union[str, TextFormatter], style: MessageStyle):
+        chats: List[Chat] = self.object_provider.session(self.database).query_objects('data.Chat')
+        for chat in chats:
+            self.post_message(chat, text, style)
+
+    def send_message_with_inline_keyboard(self, chat: Chat, text: str, style: MessageStyle, inline_keyboard: InlineKeyboardMarkup) -> Message:
+        message_params = self._message_params(chat, text, style)
+        message_params['reply_markup'] = inline_keyboard.to_json()
+        return self._post(chat, 'sendMessage', message_params).result()
+
+    def _message_params(self, chat: Chat, text: Union[str, TextFormatter], style: MessageStyle) -> Dict:
         if type(text) is TextFormatter:
             message_params = {'chat_id': chat.id_chat, 'text': text.format(style)}
         else:
@@ -135,26 +320,27 @@ class Bot(BotBase, TaskExecutor):
             message_params['parse_mode'] = 'Markdown'
         elif style == MessageStyle.HTML:
             message_params['parse_mode'] = 'HTML'
-        resp = self.call('sendMessage', message_params)
-        sent_message = Message.from_json(resp['result'])
-        self.database.save(sent_message)
-        return sent_message
+        return message_params
 
-    def broadcast(self, text: Union[str, TextFormatter], style: MessageStyle):
-        chats: List[Chat] = self.object_provider.query_objects(self.database, 'data.Chat', None, None)
-        for chat in chats:
-            self.send_message(chat, text, style)
+    def _post(self, chat: Chat, action: str, params: Dict) -> Future:
+        res: Future = Future()
 
-    def send_message_with_inline_keyboard(self, chat: Chat, text: str, style: MessageStyle, inline_keyboard: InlineKeyboardMarkup) -> Message:
-        message_params = {'chat_id': chat.id_chat, 'text': text, 'reply_markup': inline_keyboard.to_json()}
-        if style == MessageStyle.MARKDOWN:
-            message_params['parse_mode'] = 'Markdown'
-        elif style == MessageStyle.HTML:
-            message_params['parse_mode'] = 'HTML'
-        resp = self.call('sendMessage', message_params)
-        sent_message = Message.from_json(resp['result'])
-        self.database.save(sent_message)
-        return sent_message
+        def on_sent(sent: Future) -> None:
+            try:
+                sent_message: Message = Message.from_json(sent.result()['result'])
+            except Exception as ex:
+                logging.error('Could not send message to chat {c}: {e}'.format(c=chat.id_chat, e=ex))
+                res.set_exception(ex)
+                return
+            res.set_result(sent_message)
+            # The message was sent: a failed save does not fail the send, and the unit of work retries it
+            try:
+                self.sent_messages.add(sent_message)
+            except Exception as ex:
+                logging.error('Could not save message sent to chat {c}: {e}'.format(c=chat.id_chat, e=ex))
+
+        self.outbox.submit(chat, action, params).add_done_callback(on_sent)
+        return res
 
     def send_document(self, chat: Chat, filename: str):
         subprocess.call(['curl', '-F', 'chat_id=' + str(chat.id_chat), '-F', 'document=@"{x}"'.format(x=filename),
@@ -164,40 +350,32 @@ class Bot(BotBase, TaskExecutor):
         self.call('answerCallbackQuery', {'callback_query_id': callback_query_id})
 
     def get_last_update_id(self) -> Optional[int]:
-        connection = self.database.create_connection()
-        ds: DataSet = self.database.query(connection, 'parameter', 'last_update_id', False)
-        dt = ds.tables['parameter']
-        if len(dt.rows) > 0:
-            return int(list(dt.rows.values())[0].get('value'))
-        else:
-            return None
+        return self.update_offset.last_update_id
 
     def on_new_message(self, message: Message) -> None:
         chat_state: ChatState = message.chat.retrieve_chat_state()
+        if chat_state is not None:
+            # The session is in use: its TTL counts from now
+            self.chat_states.touch(message.chat.id_chat, chat_state)
 
-        instance: MessageHandlerBase = self.message_handlers['base']()
-        instance.handler_name = 'base'
         try:
-            instance.process_message(message, self, chat_state)
+            self.invoke_handler('base', lambda h: h.process_message(message, self, chat_state))
         except Exception as ex:
             self.send_message(message.chat, f'Error: {str(ex)}', MessageStyle.NONE)
             logging.exception(ex)
 
         if chat_state is not None:
-            instance = self.message_handlers[chat_state.current_handler_name]()
-            instance.handler_name = chat_state.current_handler_name
             try:
-                instance.process_message(message, self, chat_state)
+                self.invoke_handler(chat_state.current_handler_name,
+                                    lambda h: h.process_message(message, self, chat_state))
             except Exception as ex:
                 self.send_message(message.chat, f'Error: {str(ex)}', MessageStyle.NONE)
         else:
             handler_name: str
-            for handler_name in self.message_handlers:
+            for handler_name in self.routing.route(message.text):
                 if handler_name != 'base':
-                    instance = self.message_handlers[handler_name]()
-                    instance.handler_name = handler_name
                     try:
-                        instance.process_message(message, self)
+                        self.invoke_handler(handler_name, lambda h: h.process_message(message, self))
                     except Exception as ex:
                         self.send_message(message.chat, f'Error: {str(ex)}', MessageStyle.NONE)
                         logging.exception(ex)
@@ -205,15 +383,27 @@ class Bot(BotBase, TaskExecutor):
     def on_new_callback_query(self, callback_query: CallbackQuery) -> None:
         chat_state: ChatState = callback_query.message.chat.retrieve_chat_state()
         if chat_state is not None:
-            instance: MessageHandlerBase = self.message_handlers[chat_state.current_handler_name]()
-            instance.handler_name = chat_state.current_handler_name
+            self.chat_states.touch(callback_query.message.chat.id_chat, chat_state)
             try:
-                instance.process_callback_query(callback_query, self, chat_state)
+                self.invoke_handler(chat_state.current_handler_name,
+                                    lambda h: h.process_callback_query(callback_query, self, chat_state))
             except Exception as ex:
                 self.send_message(callback_query.message.chat, f'Error: {str(ex)}', MessageStyle.NONE)
         else:
             self.send_message(callback_query.message.chat, 'Could not retrieve chat state', MessageStyle.NONE)
 
+    def invoke_handler(self, handler_name: str, action: Callable[[MessageHandlerBase], None]) -> None:
+        if handler_name not in self.handler_instances:
+            # Handlers that failed to start are removed
+            raise RuntimeError(f'Handler {handler_name} is not running')
+        instance: MessageHandlerBase = self.handler_instances[handler_name]
+        lock: Optional[threading.Lock] = self.handler_locks.get(handler_name)
+        if lock is None:
+            action(instance)
+        else:
+            with lock:
+                action(instance)
+
     def execute_task(self, task: Task):
         self.send_message(task.chat, 'This is a task!', MessageStyle.MARKDOWN)
 
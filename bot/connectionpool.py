@@ -0,0 +1,132 @@
+import http.client
+import select
+import socket
+import ssl
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class PooledConnection(object):
+    def __init__(self, connection: http.client.HTTPConnection):
+        self.connection: http.client.HTTPConnection = connection
+        self.last_used: float = time.time()
+        self.requests: int = 0
+        # False until the current request has been fully written to the socket
+        self.request_sent: bool = False
+
+
+class HttpConnectionPool(object):
+    IDEMPOTENT_METHODS: Tuple[str, ...] = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, host: str, port: Optional[int] = None, use_ssl: bool = True, max_size: int = 8,
+                 max_idle_time: float = 60., ssl_context: Optional[ssl.SSLContext] = None):
+        self.host: str = host
+        self.port: Optional[int] = port
+        self.use_ssl: bool = use_ssl
+        self.max_size: int = max_size
+        self.max_idle_time: float = max_idle_time
+        self.ssl_context: Optional[ssl.SSLContext] = ssl_context
+        self._idle: List[PooledConnection] = []
+        self._lock: threading.Lock = threading.Lock()
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(max_size)
+        self.connections_created: int = 0
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: float = socket._GLOBAL_DEFAULT_TIMEOUT,
+                idempotent: Optional[bool] = None) -> Tuple[int, str, bytes]:
+        # A request that was sent but got no response may have been processed by the server, so it is only sent again
+        # when idempotent, which defaults to the method being idempotent
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        with self._slots:
+            pooled: Optional[PooledConnection] = self._checkout()
+            reused: bool = pooled is not None
+            if pooled is None:
+                pooled = self._create()
+            try:
+                return self._send(pooled, method, path, body, headers, timeout)
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                    BrokenPipeError) as e:
+                pooled.connection.close()
+                if not reused or (pooled.request_sent and not idempotent):
+                    raise e
+            except Exception:
+                pooled.connection.close()
+                raise
+            # The server dropped a kept-alive connection between the health check and the request: retry once
+            pooled = self._create()
+            try:
+                return self._send(pooled, method, path, body, headers, timeout)
+            except Exception:
+                pooled.connection.close()
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            idle: List[PooledConnection] = self._idle
+            self._idle = []
+        for pooled in idle:
+            pooled.connection.close()
+
+    def idle_count(self) -> int:
+        with self._lock:
+            return len(self._idle)
+
+    def _send(self, pooled: PooledConnection, method: str, path: str, body: Optional[bytes],
+              headers: Optional[Dict[str, str]], timeout: float) -> Tuple[int, str, bytes]:
+        connection: http.client.HTTPConnection = pooled.connection
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(None if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+        pooled.request_sent = False
+        connection.request(method, path, body=body, headers=headers or {})
+        pooled.request_sent = True
+        response: http.client.HTTPResponse = connection.getresponse()
+        data: bytes = response.read()
+        pooled.requests += 1
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(pooled)
+        return response.status, response.reason, data
+
+    def _create(self) -> PooledConnection:
+        connection: http.client.HTTPConnection
+        if self.use_ssl:
+            connection = http.client.HTTPSConnection(self.host, self.port, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port)
+        self.connections_created += 1
+        return PooledConnection(connection)
+
+    def _checkout(self) -> Optional[PooledConnection]:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                pooled: PooledConnection = self._idle.pop()
+            if self._is_healthy(pooled):
+                return pooled
+            pooled.connection.close()
+
+    def _checkin(self, pooled: PooledConnection) -> None:
+        pooled.last_used = time.time()
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(pooled)
+                return
+        pooled.connection.close()
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        if time.time() - pooled.last_used > self.max_idle_time:
+            return False
+        sock: Optional[socket.socket] = pooled.connection.sock
+        if sock is None:
+            return False
+        try:
+            # An idle keep-alive socket must not be readable: data or EOF means the server gave up on it
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
@@ -0,0 +1,70 @@
+import logging
+import queue
+import threading
+from typing import Callable, List, Optional
+
+from data import Update, Chat
+
+_STOP: object = object()
+
+
+class UpdateDispatcher(object):
+
+    def __init__(self, handler: Callable[[Update], None], worker_count: int, queue_size: int = 0,
+                 on_done: Optional[Callable[[Update], None]] = None):
+        if worker_count < 1:
+            raise ValueError('worker_count must be at least 1')
+        self.handler: Callable[[Update], None] = handler
+        # Called once the handler has returned or raised
+        self.on_done: Optional[Callable[[Update], None]] = on_done
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(worker_count)]
+        self.workers: List[threading.Thread] = []
+
+    @property
+    def worker_count(self) -> int:
+        return len(self.queues)
+
+    def start(self) -> None:
+        for i, q in enumerate(self.queues):
+            worker: threading.Thread = threading.Thread(target=self._work, args=(q,), name=f'dispatcher-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, wait: bool = True) -> None:
+        for q in self.queues:
+            q.put(_STOP)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+        self.workers = []
+
+    def shard_of(self, update: Update) -> int:
+        # All updates of a chat go to the same worker, which keeps them in arrival order
+        chat: Optional[Chat] = update.get_chat()
+        key: int = chat.id_chat if chat is not None else update.id_update
+        return hash(key) % len(self.queues)
+
+    def submit(self, update: Update) -> None:
+        # Blocks when the shard queue is full so a flooding chat applies back pressure to the poller
+        self.queues[self.shard_of(update)].put(update)
+
+    def queue_depths(self) -> List[int]:
+        return [q.qsize() for q in self.queues]
+
+    def _work(self, q: queue.Queue) -> None:
+        while True:
+            update = q.get()
+            try:
+                if update is _STOP:
+                    return
+                self.handler(update)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                if update is not _STOP and self.on_done is not None:
+                    self.on_done(update)
+                q.task_done()
+
+    def join(self) -> None:
+        for q in self.queues:
+            q.join()
@@ -0,0 +1,114 @@
+import threading
+import time
+from typing import Dict, Optional
+
+from db.database import Database, DataSet, DataRow, DataTable
+
+
+class UpdateOffset(object):
+    # The offset lives in memory and is written to the parameter table every checkpoint_interval seconds and at
+    # shutdown. A fetched update is registered with begin and only counts as done once complete has been called for
+    # each of its stages (handled and persisted). The offset polled and checkpointed never passes the lowest update
+    # still in flight, so Telegram keeps every unfinished update and a crash fetches it again: processing is
+    # at-least-once, never skipped because of the offset.
+    KEY: str = 'last_update_id'
+
+    def __init__(self, database: Database, checkpoint_interval: float):
+        self.database: Database = database
+        self.checkpoint_interval: float = checkpoint_interval
+        self.last_update_id: Optional[int] = None
+        self._checkpointed_id: Optional[int] = None
+        self._last_checkpoint: float = time.time()
+        self._loaded: bool = False
+        # Highest update id fetched, and the stages still unfinished of each update in flight
+        self._received_id: Optional[int] = None
+        self._in_flight: Dict[int, int] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._progress: threading.Condition = threading.Condition(self._lock)
+
+    def load(self) -> Optional[int]:
+        with self._lock:
+            ds: DataSet = self.database.query(self.database.connection(), 'parameter', UpdateOffset.KEY, False)
+            dt: DataTable = ds.tables['parameter']
+            if len(dt.rows) > 0:
+                self._checkpointed_id = int(list(dt.rows.values())[0].get('value'))
+                if self.last_update_id is None or self._checkpointed_id > self.last_update_id:
+                    self.last_update_id = self._checkpointed_id
+            self._loaded = True
+            return self.last_update_id
+
+    def next_offset(self) -> Optional[int]:
+        if not self._loaded:
+            self.load()
+        return self.last_update_id + 1 if self.last_update_id is not None else None
+
+    def advance(self, update_id: int) -> None:
+        # Marks every update up to update_id as done, apart from the ones still in flight
+        if not self._loaded:
+            self.load()
+        with self._lock:
+            if self._received_id is None or update_id > self._received_id:
+                self._received_id = update_id
+            self._update_watermark()
+
+    def begin(self, update_id: int, stages: int = 1) -> bool:
+        # False when the update was fetched before, as Telegram sends again everything after the polled offset
+        if not self._loaded:
+            self.load()
+        with self._lock:
+            if self._received_id is not None and update_id <= self._received_id:
+                return False
+            if self.last_update_id is not None and update_id <= self.last_update_id:
+                return False
+            self._received_id = update_id
+            self._in_flight[update_id] = stages
+            return True
+
+    def complete(self, update_id: int) -> None:
+        with self._lock:
+            stages: Optional[int] = self._in_flight.get(update_id)
+            if stages is None:
+                return
+            if stages > 1:
+                self._in_flight[update_id] = stages - 1
+                return
+            del self._in_flight[update_id]
+            self._update_watermark()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def wait_for_progress(self, timeout: float) -> bool:
+        # Waits until the offset moves or nothing is in flight; True if it did before the timeout
+        with self._lock:
+            last_update_id: Optional[int] = self.last_update_id
+            return self._progress.wait_for(lambda: self.last_update_id != last_update_id or not self._in_flight,
+                                           timeout)
+
+    def _update_watermark(self) -> None:
+        update_id: Optional[int] = min(self._in_flight) - 1 if self._in_flight else self._received_id
+        if update_id is not None and (self.last_update_id is None or update_id > self.last_update_id):
+            self.last_update_id = update_id
+            self._progress.notify_all()
+
+    def checkpoint_if_due(self) -> bool:
+        if time.time() - self._last_checkpoint < self.checkpoint_interval:
+            return False
+        return self.checkpoint()
+
+    def checkpoint(self) -> bool:
+        with self._lock:
+            self._last_checkpoint = time.time()
+            update_id: Optional[int] = self.last_update_id
+            if update_id is None or update_id == self._checkpointed_id:
+                return False
+            row: DataRow = DataRow('parameter', UpdateOffset.KEY)
+            row.put('key', UpdateOffset.KEY)
+            row.put('value', str(update_id))
+            ds: DataSet = DataSet()
+            ds.merge_row(row)
+            with self.database.transaction() as connection:
+                self.database.save_data_set(connection, ds)
+            self._checkpointed_id = update_id
+            return True
@@ -0,0 +1,178 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from bot.base import TelegramError
+from data import Chat
+
+GROUP_CHAT_TYPES: Tuple[str, ...] = ('group', 'supergroup', 'channel')
+
+
+class OutboundRequest(object):
+    def __init__(self, id_chat: int, action: str, params: Dict):
+        self.id_chat: int = id_chat
+        self.action: str = action
+        self.params: Dict = params
+        self.future: Future = Future()
+        self.attempts: int = 0
+
+
+class ChatOutbox(object):
+    def __init__(self, id_chat: int, is_group: bool):
+        self.id_chat: int = id_chat
+        self.is_group: bool = is_group
+        self.pending: Deque[OutboundRequest] = collections.deque()
+        self.sent_times: Deque[float] = collections.deque()
+        self.blocked_until: float = 0.
+        self.in_flight: bool = False
+        self.scheduled: bool = False
+
+
+class OutboundQueue(object):
+    CHAT_INTERVAL: float = 1.
+    GROUP_MESSAGES_PER_MINUTE: int = 20
+    MAX_RETRIES: int = 5
+
+    def __init__(self, call: Callable[[str, Dict], Dict], sender_count: int = 4, global_rate: int = 30):
+        self.call: Callable[[str, Dict], Dict] = call
+        self.sender_count: int = sender_count
+        self.global_rate: int = global_rate
+        self._chats: Dict[int, ChatOutbox] = {}
+        # Chats with pending requests, ordered by the earliest time they may send again
+        self._ready: List[Tuple[float, int, int]] = []
+        self._sequence: itertools.count = itertools.count()
+        self._global_sent: Deque[float] = collections.deque()
+        self._condition: threading.Condition = threading.Condition()
+        self._senders: List[threading.Thread] = []
+        self._stopping: bool = False
+        self._last_prune: float = time.time()
+        self.sent_count: int = 0
+        self.throttled_count: int = 0
+
+    def start(self) -> None:
+        self._stopping = False
+        for i in range(self.sender_count):
+            sender: threading.Thread = threading.Thread(target=self._send_loop, name=f'outbox-{i}', daemon=True)
+            sender.start()
+            self._senders.append(sender)
+
+    def stop(self, wait: bool = True) -> None:
+        # Pending requests are still delivered before the senders exit
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for sender in self._senders:
+                sender.join()
+        self._senders = []
+
+    def submit(self, chat: Chat, action: str, params: Dict) -> Future:
+        request: OutboundRequest = OutboundRequest(chat.id_chat, action, params)
+        with self._condition:
+            if self._stopping and not self._senders:
+                raise RuntimeError('Outbound queue is stopped')
+            chat_outbox: Optional[ChatOutbox] = self._chats.get(chat.id_chat)
+            if chat_outbox is None:
+                chat_outbox = ChatOutbox(chat.id_chat, chat.type in GROUP_CHAT_TYPES or chat.id_chat < 0)
+                self._chats[chat.id_chat] = chat_outbox
+            chat_outbox.pending.append(request)
+            self._schedule(chat_outbox, time.time())
+        return request.future
+
+    def pending_count(self) -> int:
+        with self._condition:
+            return sum(len(c.pending) for c in self._chats.values())
+
+    def _schedule(self, chat_outbox: ChatOutbox, now: float) -> None:
+        if chat_outbox.scheduled or chat_outbox.in_flight or not chat_outbox.pending:
+            return
+        chat_outbox.scheduled = True
+        heapq.heappush(self._ready, (self._chat_ready_time(chat_outbox, now), next(self._sequence), chat_outbox.id_chat))
+        self._condition.notify()
+
+    def _chat_ready_time(self, chat_outbox: ChatOutbox, now: float) -> float:
+        while chat_outbox.sent_times and chat_outbox.sent_times[0] <= now - 60.:
+            chat_outbox.sent_times.popleft()
+        ready: float = chat_outbox.blocked_until
+        if chat_outbox.sent_times:
+            ready = max(ready, chat_outbox.sent_times[-1] + self.CHAT_INTERVAL)
+            if chat_outbox.is_group and len(chat_outbox.sent_times) >= self.GROUP_MESSAGES_PER_MINUTE:
+                ready = max(ready, chat_outbox.sent_times[-self.GROUP_MESSAGES_PER_MINUTE] + 60.)
+        return ready
+
+    def _global_ready_time(self, now: float) -> float:
+        while self._global_sent and self._global_sent[0] <= now - 1.:
+            self._global_sent.popleft()
+        if len(self._global_sent) < self.global_rate:
+            return now
+        return self._global_sent[0] + 1.
+
+    def _take(self) -> Optional[Tuple[ChatOutbox, OutboundRequest]]:
+        with self._condition:
+            while True:
+                now: float = time.time()
+                if not self._ready:
+                    if self._stopping and not any(c.in_flight for c in self._chats.values()):
+                        self._condition.notify_all()
+                        return None
+                    self._condition.wait()
+                    continue
+                ready_time, _, id_chat = self._ready[0]
+                wake_time: float = max(ready_time, self._global_ready_time(now))
+                if wake_time > now:
+                    self._condition.wait(wake_time - now)
+                    continue
+                heapq.heappop(self._ready)
+                chat_outbox: ChatOutbox = self._chats[id_chat]
+                chat_outbox.scheduled = False
+                request: OutboundRequest = chat_outbox.pending.popleft()
+                # Only one request per chat is in flight so that messages keep their order
+                chat_outbox.in_flight = True
+                chat_outbox.sent_times.append(now)
+                self._global_sent.append(now)
+                return chat_outbox, request
+
+    def _send_loop(self) -> None:
+        while True:
+            taken: Optional[Tuple[ChatOutbox, OutboundRequest]] = self._take()
+            if taken is None:
+                return
+            chat_outbox, request = taken
+            request.attempts += 1
+            retry_after: Optional[float] = None
+            try:
+                request.future.set_result(self.call(request.action, request.params))
+            except TelegramError as e:
+                if e.retry_after is not None and request.attempts <= self.MAX_RETRIES:
+                    retry_after = e.retry_after
+                    logging.warning(f'Flood control on chat {request.id_chat}, retrying after {retry_after}s')
+                else:
+                    request.future.set_exception(e)
+            except Exception as e:
+                request.future.set_exception(e)
+            with self._condition:
+                now: float = time.time()
+                chat_outbox.in_flight = False
+                self.sent_count += 1
+                if retry_after is not None:
+                    self.throttled_count += 1
+                    chat_outbox.blocked_until = now + retry_after
+                    chat_outbox.pending.appendleft(request)
+                self._schedule(chat_outbox, now)
+                if now - self._last_prune > 60.:
+                    self._prune(now)
+                self._condition.notify_all()
+
+    def _prune(self, now: float) -> None:
+        # Chats are forgotten once their send history can no longer delay a new message
+        self._last_prune = now
+        idle: List[int] = [id_chat for id_chat, c in self._chats.items()
+                           if not c.pending and not c.in_flight and c.blocked_until < now
+                           and (not c.sent_times or c.sent_times[-1] <= now - 60.)]
+        for id_chat in idle:
+            del self._chats[id_chat]
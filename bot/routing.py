@@ -0,0 +1,56 @@
+from typing import Dict, List, Optional, Tuple
+
+from wordparser import WordParser
+
+
+class MessageRoute(object):
+    def __init__(self, handler_name: str, order: int, keywords: Tuple[str, ...], pattern: Optional[WordParser]):
+        self.handler_name: str = handler_name
+        self.order: int = order
+        self.keywords: Tuple[str, ...] = keywords
+        self.pattern: Optional[WordParser] = pattern
+
+    def accepts(self, text: Optional[str]) -> bool:
+        return self.pattern is None or (text is not None and self.pattern.match(text).success)
+
+
+class RoutingIndex(object):
+    def __init__(self):
+        self.routes: Dict[str, MessageRoute] = {}
+        self._by_keyword: Dict[str, List[MessageRoute]] = {}
+        self._catch_all: List[MessageRoute] = []
+        self._next_order: int = 0
+
+    def add(self, handler_name: str, keywords: Optional[List[str]] = None, pattern: Optional[str] = None) -> None:
+        if handler_name in self.routes:
+            raise ValueError(handler_name + ' already routed.')
+        route: MessageRoute = MessageRoute(handler_name,
+                                           self._next_order,
+                                           tuple(k.lower() for k in keywords or []),
+                                           WordParser.from_str(pattern) if pattern is not None else None)
+        self._next_order += 1
+        self.routes[handler_name] = route
+        if route.keywords:
+            for keyword in route.keywords:
+                self._by_keyword.setdefault(keyword, []).append(route)
+        else:
+            self._catch_all.append(route)
+
+    def remove(self, handler_name: str) -> None:
+        route: Optional[MessageRoute] = self.routes.pop(handler_name, None)
+        if route is None:
+            return
+        for keyword in route.keywords:
+            self._by_keyword[keyword].remove(route)
+            if not self._by_keyword[keyword]:
+                del self._by_keyword[keyword]
+        if route in self._catch_all:
+            self._catch_all.remove(route)
+
+    def route(self, text: Optional[str]) -> List[str]:
+        # Handlers are returned in registration order, keyword matches merged with the catch-all ones
+        keyword: str = text.split(' ', 1)[0].lower() if text else ''
+        candidates: List[MessageRoute] = self._by_keyword.get(keyword, [])
+        if self._catch_all:
+            candidates = sorted(candidates + self._catch_all, key=lambda r: r.order)
+        return [r.handler_name for r in candidates if r.accepts(text)]
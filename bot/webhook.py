@@ -0,0 +1,117 @@
+import hmac
+import http.server
+import json
+import logging
+import ssl
+import threading
+from typing import Callable, Optional, Tuple
+
+from data import Update
+
+SECRET_TOKEN_HEADER: str = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address: Tuple[str, int], webhook: 'WebhookServer'):
+        super().__init__(server_address, WebhookRequestHandler)
+        self.webhook: WebhookServer = webhook
+        self.request_slots: threading.BoundedSemaphore = threading.BoundedSemaphore(webhook.max_connections)
+
+    def process_request(self, request, client_address):
+        # Accepting stops while all slots are busy, so excess requests wait in the listen backlog
+        self.request_slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.request_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.request_slots.release()
+
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: WebhookHttpServer
+
+    def do_POST(self):
+        webhook: WebhookServer = self.server.webhook
+        if self.path != webhook.path:
+            self.send_empty_response(404)
+            return
+        if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), webhook.secret_token):
+            self.send_empty_response(403)
+            return
+        length: int = int(self.headers.get('Content-Length', 0))
+        if length > webhook.max_body_size:
+            self.close_connection = True
+            self.send_empty_response(413)
+            return
+        try:
+            update: Update = Update.from_json(json.loads(self.rfile.read(length).decode('utf8')))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Discarding malformed webhook update: {e}')
+            self.send_empty_response(400)
+            return
+        try:
+            webhook.on_update(update)
+        except Exception as e:
+            # Telegram delivers the update again when the response is not successful
+            logging.exception(e)
+            self.send_empty_response(500)
+            return
+        self.send_empty_response(200)
+
+    def send_empty_response(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug('Webhook: ' + format % args)
+
+
+class WebhookServer(object):
+    def __init__(self, on_update: Callable[[Update], None], host: str, port: int, path: str = '/',
+                 secret_token: Optional[str] = None, max_connections: int = 40, certfile: Optional[str] = None,
+                 keyfile: Optional[str] = None):
+        # Without a secret anyone who can reach the port could inject updates
+        if not secret_token:
+            raise ValueError('A secret token is required for the webhook')
+        self.on_update: Callable[[Update], None] = on_update
+        self.host: str = host
+        self.port: int = port
+        self.path: str = path
+        self.secret_token: str = secret_token
+        self.max_connections: int = max_connections
+        self.max_body_size: int = 1024 * 1024
+        self.certfile: Optional[str] = certfile
+        self.keyfile: Optional[str] = keyfile
+        self._server: Optional[WebhookHttpServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def server_address(self) -> Tuple[str, int]:
+        return self._server.server_address
+
+    def start(self) -> None:
+        self._server = WebhookHttpServer((self.host, self.port), self)
+        if self.certfile is not None:
+            context: ssl.SSLContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logging.info(f'Webhook listening on {self.server_address[0]}:{self.server_address[1]}{self.path}')
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
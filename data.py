@@ -1,14 +1,12 @@
 import uuid
-from pathlib import Path
 from typing import List, Optional, Dict
-import pickle
-import pathlib
 import time
 
 import sqlite3
 
 import jsonutils
 import utils
+from db.chatstate import ChatState, ChatStateStore
 from db.database import DataRow, DbSerializable, DataSet, Database
 from jsonutils import JsonDeserializable
 
@@ -31,6 +29,30 @@ class BotConfig(JsonDeserializable):
         self.database_definition_file: Optional[str] = None
         self.object_provider_file: str = None
         self.get_updates_timeout: int = 0
+        self.offset_checkpoint_interval: float = 30.
+        self.handler_threads: int = 8
+        self.worker_count: int = 4
+        self.worker_queue_size: int = 100
+        self.http_pool_size: int = 8
+        self.outbox_senders: int = 4
+        self.write_queue_size: int = 1000
+        self.write_batch_size: int = 100
+        # Sent messages are committed in groups every this many ms; 0 commits each one as it is saved
+        self.message_commit_interval_ms: int = 50
+        self.message_commit_batch_size: int = 100
+        self.outbox_global_rate: int = 30
+        self.chat_state_file: str = 'chat_state.sqlite'
+        self.chat_state_cache_size: int = 10000
+        self.chat_state_ttl: Dict[str, float] = {}
+        self.chat_state_default_ttl: Optional[float] = None
+        self.chat_state_sweep_interval: float = 60.
+        self.webhook_url: Optional[str] = None
+        self.webhook_host: str = '127.0.0.1'
+        self.webhook_port: int = 8443
+        self.webhook_path: str = '/'
+        self.webhook_max_connections: int = 40
+        self.webhook_certfile: Optional[str] = None
+        self.webhook_keyfile: Optional[str] = None
         self.tokens: Dict[str, str] = {}
         # self.specific_config = {}  # type: Dict
         self.administrator_id: int = 0
@@ -41,6 +63,30 @@ class BotConfig(JsonDeserializable):
         res.database_definition_file = json_object.get('database_definition_file')
         res.object_provider_file = json_object.get('object_provider_file')
         res.get_updates_timeout = json_object.get('get_updates_timeout')
+        res.offset_checkpoint_interval = json_object.get('offset_checkpoint_interval', 30.)
+        res.handler_threads = json_object.get('handler_threads', 8)
+        res.worker_count = json_object.get('worker_count', 4)
+        res.worker_queue_size = json_object.get('worker_queue_size', 100)
+        res.http_pool_size = json_object.get('http_pool_size', 8)
+        res.outbox_senders = json_object.get('outbox_senders', 4)
+        res.write_queue_size = json_object.get('write_queue_size', 1000)
+        res.write_batch_size = json_object.get('write_batch_size', 100)
+        res.message_commit_interval_ms = json_object.get('message_commit_interval_ms', 50)
+        res.message_commit_batch_size = json_object.get('message_commit_batch_size', 100)
+        res.outbox_global_rate = json_object.get('outbox_global_rate', 30)
+        res.chat_state_file = json_object.get('chat_state_file', 'chat_state.sqlite')
+        res.chat_state_cache_size = json_object.get('chat_state_cache_size', 10000)
+        res.chat_state_ttl = json_object.get('chat_state_ttl', {})
+        res.chat_state_default_ttl = json_object.get('chat_state_default_ttl')
+        res.chat_state_sweep_interval = json_object.get('chat_state_sweep_interval', 60.)
+        webhook: Dict = json_object.get('webhook', {})
+        res.webhook_url = webhook.get('url')
+        res.webhook_host = webhook.get('host', '127.0.0.1')
+        res.webhook_port = webhook.get('port', 8443)
+        res.webhook_path = webhook.get('path', '/')
+        res.webhook_max_connections = webhook.get('max_connections', 40)
+        res.webhook_certfile = webhook.get('certfile')
+        res.webhook_keyfile = webhook.get('keyfile')
         res.tokens = utils.get_file_json(json_object['token_file'])
         specific_config = utils.get_file_json(json_object['specific_config_file'])
         res.administrator_id = specific_config['administrator_id']
@@ -61,6 +107,13 @@ class Update(DbSerializable, JsonDeserializable):
         res.callback_query = CallbackQuery.from_json(json_obj['callback_query']) if 'callback_query' in json_obj else None
         return res
 
+    def get_chat(self) -> Optional['Chat']:
+        if self.message is not None:
+            return self.message.chat
+        if self.callback_query is not None and self.callback_query.message is not None:
+            return self.callback_query.message.chat
+        return None
+
     @property
     def to_data_set(self) -> DataSet:
         res: DataSet = DataSet()
@@ -73,15 +126,9 @@ class Update(DbSerializable, JsonDeserializable):
         return res
 
 
-class ChatState(object):
-    def __init__(self):
-        self.current_handler_name: str = None
-        self.last_time: float = 0.
-        self.chat_id: int = 0
-        self.data: Dict = {}
-
-
 class Chat(DbSerializable, JsonDeserializable):
+    state_store: Optional[ChatStateStore] = None
+
     def __init__(self):
         self.id_chat: int = 0
         self.first_name: str = None
@@ -128,33 +175,20 @@ class Chat(DbSerializable, JsonDeserializable):
         res.last_name = row.get('last_name')
         return res
 
+    @classmethod
+    def get_state_store(cls) -> ChatStateStore:
+        if cls.state_store is None:
+            cls.state_store = ChatStateStore('chat_state.sqlite')
+        return cls.state_store
+
     def retrieve_chat_state(self) -> ChatState or None:
-        folder: pathlib.Path = pathlib.Path('chat')
-        if not folder.exists():
-            return None
-        filename = folder.joinpath('{id}.pickle'.format(id=self.id_chat))
-        if filename.exists():
-            with open(str(filename), 'rb') as fobj:
-                data = pickle.load(fobj)
-            return data
-        else:
-            return None
+        return Chat.get_state_store().get(self.id_chat)
 
     def save_chat_state(self, chat_state: ChatState) -> None:
-        folder: pathlib.Path = pathlib.Path('chat')
-        if not folder.exists():
-            folder.mkdir()
-        filename = folder.joinpath(f'{self.id_chat}.pickle')
-        with open(str(filename), 'wb') as fobj:
-            pickle.dump(chat_state, fobj)
+        Chat.get_state_store().put(self.id_chat, chat_state)
 
     def remove_chat_state(self) -> None:
-        folder: pathlib.Path = pathlib.Path('chat')
-        if not folder.exists():
-            return
-        filename: Path = folder.joinpath(f'{self.id_chat}.pickle')
-        if filename.exists():
-            filename.unlink()
+        Chat.get_state_store().remove(self.id_chat)
 
 
 class Message(DbSerializable, JsonDeserializable):
@@ -0,0 +1,296 @@
+import collections
+import logging
+import pathlib
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, OrderedDict
+
+from db.statecodec import StateCodec
+
+_MISSING: object = object()
+
+
+class ChatState(object):
+    # data is decoded from the store payload on first access, so routing a message by current_handler_name and
+    # checking expiry never decode it
+    def __init__(self):
+        self.current_handler_name: str = None
+        self.last_time: float = 0.
+        self.chat_id: int = 0
+        self._data: Optional[Dict] = {}
+        self._payload: Optional[bytes] = None
+        self._codec: Optional[StateCodec] = None
+
+    @property
+    def data(self) -> Dict:
+        if self._data is None:
+            self._data = self._codec.decode(self._payload)
+            self._payload = None
+        return self._data
+
+    @data.setter
+    def data(self, value: Dict) -> None:
+        self._data = value
+        self._payload = None
+
+    def encode_data(self, codec: StateCodec) -> bytes:
+        return self._payload if self._data is None else codec.encode(self._data)
+
+    @classmethod
+    def from_payload(cls, chat_id: int, handler_name: Optional[str], last_time: float, payload: bytes,
+                     codec: StateCodec) -> 'ChatState':
+        res: ChatState = ChatState()
+        res.chat_id = chat_id
+        res.current_handler_name = handler_name
+        res.last_time = last_time
+        res._data = None
+        res._payload = payload
+        res._codec = codec
+        return res
+
+    def __getstate__(self) -> Dict:
+        return {'current_handler_name': self.current_handler_name, 'last_time': self.last_time,
+                'chat_id': self.chat_id, 'data': self.data}
+
+    def __setstate__(self, state: Dict) -> None:
+        # Also reads the chat/<id>.pickle files written before the state store
+        self.__init__()
+        self.current_handler_name = state.get('current_handler_name')
+        self.last_time = state.get('last_time', 0.)
+        self.chat_id = state.get('chat_id', 0)
+        self._data = state.get('data', {})
+
+
+class ChatStateStore(object):
+    # Chat states are kept in one SQLite table and fronted by an LRU cache holding up to cache_size chats. Chats
+    # without a state are cached too, so the common case of a message from a chat with no open session never touches
+    # the disk. Writes go through to the table before the cache is updated, each in its own transaction.
+    # Cached states are the live objects handed to the handlers: a state changed without saving it again is lost at
+    # the next restart or eviction, as with the pickle files.
+    # A state expires ttl[handler] (or default_ttl) seconds after its last_time, which the bot refreshes through touch
+    # every time it routes a message to the state. Expired states are never returned; the sweeper thread deletes them
+    # in batches through the (handler, last_time) index.
+    # Payloads are written by codec; pickled states left by earlier versions are still read.
+
+    def __init__(self, filename: str, cache_size: int = 10000, ttl: Optional[Dict[str, float]] = None,
+                 default_ttl: Optional[float] = None, sweep_batch_size: int = 500, codec: Optional[StateCodec] = None,
+                 touch_interval: float = 10.):
+        self.filename: str = filename
+        self.codec: StateCodec = codec or StateCodec()
+        self.cache_size: int = cache_size
+        self.ttl: Dict[str, float] = ttl or {}
+        self.default_ttl: Optional[float] = default_ttl
+        self.sweep_batch_size: int = sweep_batch_size
+        # touch writes last_time at most once per touch_interval seconds
+        self.touch_interval: float = touch_interval
+        self._cache: OrderedDict[int, Optional[ChatState]] = collections.OrderedDict()
+        self._lock: threading.RLock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop_sweeping: threading.Event = threading.Event()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.expired_on_access: int = 0
+        self.expired_by_sweep: int = 0
+        self.sweeps: int = 0
+        self.last_sweep_seconds: float = 0.
+
+    def open(self) -> None:
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+                self._connection.execute('CREATE TABLE IF NOT EXISTS [chat_state] (id_chat INTEGER NOT NULL PRIMARY KEY, '
+                                         'handler TEXT, last_time REAL NOT NULL, payload BLOB NOT NULL);')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS [chat_state_expiry] '
+                                         'ON [chat_state] (handler, last_time);')
+                self._connection.commit()
+
+    def start_sweeper(self, interval: float) -> None:
+        self.open()
+        self._stop_sweeping.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,), name='chat-state-sweeper',
+                                         daemon=True)
+        self._sweeper.start()
+
+    def close(self) -> None:
+        if self._sweeper is not None:
+            self._stop_sweeping.set()
+            self._sweeper.join()
+            self._sweeper = None
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self._cache.clear()
+
+    def get(self, chat_id: int) -> Optional[ChatState]:
+        with self._lock:
+            state = self._cache.get(chat_id, _MISSING)
+            if state is not _MISSING:
+                self._cache.move_to_end(chat_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.open()
+                row = self._connection.execute('SELECT handler, last_time, payload FROM [chat_state] WHERE id_chat=?;',
+                                               (chat_id,)).fetchone()
+                state = self._load_state(chat_id, row) if row is not None else None
+                self._remember(chat_id, state)
+            if state is not None and self.is_expired(state, time.time()):
+                self.expired_on_access += 1
+                self.remove(chat_id)
+                return None
+            return state
+
+    def get_ttl(self, handler_name: Optional[str]) -> Optional[float]:
+        return self.ttl.get(handler_name, self.default_ttl)
+
+    def is_expired(self, state: ChatState, now: float) -> bool:
+        ttl: Optional[float] = self.get_ttl(state.current_handler_name)
+        return ttl is not None and state.last_time + ttl < now
+
+    def put(self, chat_id: int, state: ChatState) -> None:
+        payload: bytes = state.encode_data(self.codec)
+        with self._lock:
+            self.open()
+            with self._connection:
+                self._connection.execute('INSERT OR REPLACE INTO [chat_state] (id_chat, handler, last_time, payload) '
+                                         'VALUES (?, ?, ?, ?);',
+                                         (chat_id, state.current_handler_name, state.last_time, payload))
+            self._remember(chat_id, state)
+
+    def touch(self, chat_id: int, state: ChatState, now: Optional[float] = None) -> None:
+        # Keeps a state in use from expiring; only last_time is written, the payload is left as it is
+        now = now if now is not None else time.time()
+        if now - state.last_time < self.touch_interval:
+            return
+        with self._lock:
+            state.last_time = now
+            self.open()
+            with self._connection:
+                self._connection.execute('UPDATE [chat_state] SET last_time=? WHERE id_chat=?;', (now, chat_id))
+
+    def remove(self, chat_id: int) -> None:
+        with self._lock:
+            self.open()
+            with self._connection:
+                self._connection.execute('DELETE FROM [chat_state] WHERE id_chat=?;', (chat_id,))
+            self._remember(chat_id, None)
+
+    def update(self, chat_id: int, action: Callable[[Optional[ChatState]], Optional[ChatState]]) -> Optional[ChatState]:
+        # Read-modify-write for one chat with no other access to the store in between. The value returned by action
+        # is saved, or the state is removed when it returns None.
+        with self._lock:
+            state = action(self.get(chat_id))
+            if state is None:
+                self.remove(chat_id)
+            else:
+                self.put(chat_id, state)
+            return state
+
+    def count(self) -> int:
+        with self._lock:
+            self.open()
+            return self._connection.execute('SELECT COUNT(*) FROM [chat_state];').fetchone()[0]
+
+    def cached_count(self) -> int:
+        with self._lock:
+            return len(self._cache)
+
+    def metrics(self) -> Dict[str, float]:
+        return {'cached': self.cached_count(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired_on_access': self.expired_on_access,
+                'expired_by_sweep': self.expired_by_sweep,
+                'sweeps': self.sweeps,
+                'last_sweep_seconds': self.last_sweep_seconds}
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        # Deletes at most sweep_batch_size states per transaction and releases the lock in between, so lookups from
+        # the handlers are only held up for one batch
+        now = now if now is not None else time.time()
+        start: float = time.time()
+        expired: int = 0
+        for where, params in self._expiry_conditions(now):
+            while not self._stop_sweeping.is_set():
+                with self._lock:
+                    self.open()
+                    chat_ids: List[int] = [r[0] for r in self._connection.execute(
+                        f'SELECT id_chat FROM [chat_state] WHERE {where} LIMIT ?;',
+                        params + (self.sweep_batch_size,)).fetchall()]
+                    if chat_ids:
+                        with self._connection:
+                            self._connection.executemany('DELETE FROM [chat_state] WHERE id_chat=?;',
+                                                         [(c,) for c in chat_ids])
+                        for chat_id in chat_ids:
+                            self._cache.pop(chat_id, None)
+                expired += len(chat_ids)
+                if len(chat_ids) < self.sweep_batch_size:
+                    break
+                time.sleep(0)
+        self.expired_by_sweep += expired
+        self.sweeps += 1
+        self.last_sweep_seconds = time.time() - start
+        return expired
+
+    def _expiry_conditions(self, now: float) -> List[tuple]:
+        res: List[tuple] = [('handler=? AND last_time<?', (h, now - ttl)) for h, ttl in self.ttl.items()
+                            if ttl is not None]
+        if self.default_ttl is not None:
+            names: List[str] = list(self.ttl)
+            placeholders: str = ', '.join('?' for _ in names)
+            res.append((f'(handler IS NULL OR handler NOT IN ({placeholders})) AND last_time<?',
+                        tuple(names) + (now - self.default_ttl,)))
+        return res
+
+    def _sweep_loop(self, interval: float) -> None:
+        while not self._stop_sweeping.wait(interval):
+            try:
+                expired: int = self.sweep()
+                if expired:
+                    logging.info(f'Expired {expired} chat state(s) in {self.last_sweep_seconds:.3f}s')
+            except Exception as e:
+                logging.error(f'Chat state sweep failed: {e}')
+
+    def import_pickles(self, folder: str) -> int:
+        # One-off migration from the former chat/<id>.pickle files. States already in the store win. The folder is
+        # renamed afterwards so the import does not run again.
+        path: pathlib.Path = pathlib.Path(folder)
+        if not path.is_dir():
+            return 0
+        imported: int = 0
+        with self._lock:
+            self.open()
+            for filename in path.glob('*.pickle'):
+                try:
+                    chat_id: int = int(filename.stem)
+                    with open(str(filename), 'rb') as fobj:
+                        state: ChatState = pickle.load(fobj)
+                    payload: bytes = state.encode_data(self.codec)
+                except Exception as e:
+                    logging.warning(f'Could not import chat state {filename}: {e}')
+                    continue
+                with self._connection:
+                    cursor: sqlite3.Cursor = self._connection.execute(
+                        'INSERT OR IGNORE INTO [chat_state] (id_chat, handler, last_time, payload) VALUES (?, ?, ?, ?);',
+                        (chat_id, state.current_handler_name, state.last_time, payload))
+                imported += cursor.rowcount
+                self._cache.pop(chat_id, None)
+        path.rename(path.with_name(path.name + '.imported'))
+        logging.info(f'Imported {imported} chat state(s) from {folder}')
+        return imported
+
+    def _load_state(self, chat_id: int, row: tuple) -> ChatState:
+        handler_name, last_time, payload = row
+        if payload[:1] == b'\x80':
+            return pickle.loads(payload)
+        return ChatState.from_payload(chat_id, handler_name, last_time, payload, self.codec)
+
+    def _remember(self, chat_id: int, state: Optional[ChatState]) -> None:
+        self._cache[chat_id] = state
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
@@ -0,0 +1,94 @@
+import contextlib
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from jsonutils import JsonDeserializable
+
+
+class ConnectionSettings(JsonDeserializable):
+    # Pragmas applied to every connection; None leaves the SQLite default
+    def __init__(self):
+        self.journal_mode: Optional[str] = None
+        self.synchronous: Optional[str] = None
+        self.cache_size: Optional[int] = None
+        self.mmap_size: Optional[int] = None
+        self.busy_timeout: float = 5.
+
+    @classmethod
+    def from_json(cls, json_object: Dict) -> 'ConnectionSettings':
+        res: ConnectionSettings = ConnectionSettings()
+        res.journal_mode = json_object.get('journal_mode')
+        res.synchronous = json_object.get('synchronous')
+        res.cache_size = json_object.get('cache_size')
+        res.mmap_size = json_object.get('mmap_size')
+        res.busy_timeout = json_object.get('busy_timeout', 5.)
+        return res
+
+    def get_pragmas(self) -> List[str]:
+        res: List[str] = []
+        if self.journal_mode is not None:
+            res.append(f'PRAGMA journal_mode={self.journal_mode};')
+        if self.synchronous is not None:
+            res.append(f'PRAGMA synchronous={self.synchronous};')
+        if self.cache_size is not None:
+            res.append(f'PRAGMA cache_size={int(self.cache_size)};')
+        if self.mmap_size is not None:
+            res.append(f'PRAGMA mmap_size={int(self.mmap_size)};')
+        return res
+
+
+class ConnectionManager(object):
+    # Each thread gets one long-lived connection, opened on first use and closed by close_all. In WAL mode readers
+    # on other threads do not block the writer. transaction() commits when the outermost block exits and rolls back
+    # if it raises; nested blocks join the enclosing transaction.
+
+    def __init__(self, filename: str, settings: Optional[ConnectionSettings] = None):
+        self.filename: str = filename
+        self.settings: ConnectionSettings = settings or ConnectionSettings()
+        self._local: threading.local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock: threading.Lock = threading.Lock()
+        self.connections_opened: int = 0
+
+    def connect(self) -> sqlite3.Connection:
+        # A new connection with the configured pragmas, owned by the caller
+        connection: sqlite3.Connection = sqlite3.connect(self.filename, timeout=self.settings.busy_timeout,
+                                                         check_same_thread=False)
+        for pragma in self.settings.get_pragmas():
+            connection.execute(pragma)
+        self.connections_opened += 1
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self._local.connection = connection
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection: sqlite3.Connection = self.connection()
+        self._local.depth += 1
+        try:
+            yield connection
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                connection.rollback()
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            connection.commit()
+
+    def close_all(self) -> None:
+        # Only once no other thread uses its connection any more
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
@@ -1,9 +1,21 @@
+import collections
+import contextlib
+import hashlib
+import json
+import logging
 import sqlite3
-from typing import Optional, List, Dict, Tuple, Set, Type, Any, Iterator
+import threading
+import time
+from collections.abc import MutableMapping
+from types import MappingProxyType
+from typing import Optional, List, Dict, Tuple, Set, Type, Any, Iterator, Mapping, Sequence
 import itertools
 import utils
+from db.connection import ConnectionManager, ConnectionSettings
 from jsonutils import JsonDeserializable
 
+_UNSET: object = object()
+
 
 class Column(object):
     TYPES = {
@@ -54,17 +66,176 @@ class ForeignKey(object):
         return res
 
 
+class Index(object):
+    def __init__(self):
+        self.name: str = ''
+        self.columns: List[str] = []
+        self.unique: bool = False
+        self.where: Optional[str] = None
+
+    @staticmethod
+    def from_json(json_object: Dict, table_name: str) -> 'Index':
+        res: Index = Index()
+        res.columns = json_object['columns']
+        res.name = json_object.get('name', 'ix_{t}_{c}'.format(t=table_name, c='_'.join(res.columns)))
+        res.unique = json_object.get('unique', False)
+        res.where = json_object.get('where')
+        return res
+
+    def get_create_cmd(self, table_name: str) -> str:
+        # Compared with the sql column of sqlite_master to detect changed definitions, so it is built without
+        # IF NOT EXISTS or a trailing semicolon
+        res: str = 'CREATE {u}INDEX [{n}] ON [{t}] ({c})'.format(u='UNIQUE ' if self.unique else '', n=self.name,
+                                                                  t=table_name, c=', '.join(self.columns))
+        if self.where is not None:
+            res += ' WHERE ' + self.where
+        return res
+
+    def __repr__(self):
+        return 'Index: ' + self.name
+
+
+class RowSchema(object):
+    # Column name -> slot map shared by every DataRow of a table. It only grows: a put with a new column name adds a
+    # slot for all rows of the table. Schemas are registered by table name and column names: rows read through a
+    # TableLayout share the schema of that exact column list, whose slots follow the columns, so databases with a
+    # same-named table of other columns never share slots. Rows built by name alone share the (table, None) schema.
+    _schemas: Dict[Tuple[str, Optional[Tuple[str, ...]]], 'RowSchema'] = {}
+    _lock: threading.Lock = threading.Lock()
+
+    def __init__(self, table_name: str, column_names: Tuple[str, ...] = ()):
+        self.table_name: str = table_name
+        self.names: List[str] = list(column_names)
+        self.index: Dict[str, int] = {n: i for i, n in enumerate(column_names)}
+        self._slots: Dict[Tuple[str, ...], Tuple[Tuple[int, ...], bool]] = {}
+
+    @classmethod
+    def for_table(cls, table_name: str, column_names: Optional[Tuple[str, ...]] = None) -> 'RowSchema':
+        key: Tuple[str, Optional[Tuple[str, ...]]] = (table_name, column_names)
+        schema: Optional[RowSchema] = cls._schemas.get(key)
+        if schema is None:
+            with cls._lock:
+                schema = cls._schemas.setdefault(key, RowSchema(table_name, column_names or ()))
+        return schema
+
+    def slot_of(self, name: str) -> int:
+        slot: Optional[int] = self.index.get(name)
+        if slot is None:
+            with RowSchema._lock:
+                slot = self.index.get(name)
+                if slot is None:
+                    slot = len(self.names)
+                    self.names.append(name)
+                    self.index[name] = slot
+        return slot
+
+    def slots_for(self, names: Tuple[str, ...]) -> Tuple[Tuple[int, ...], bool]:
+        # Slots of a column sequence, and whether they are simply 0..n-1
+        res: Optional[Tuple[Tuple[int, ...], bool]] = self._slots.get(names)
+        if res is None:
+            slots: Tuple[int, ...] = tuple(self.slot_of(n) for n in names)
+            res = (slots, slots == tuple(range(len(slots))))
+            self._slots[names] = res
+        return res
+
+
 class DataRow(object):
-    def __init__(self, table_name: str, identity: object):
+    # Values are kept in a list aligned with the table's RowSchema; slots never put hold _UNSET
+    __slots__ = ('identity', 'table_name', 'schema', 'values')
+
+    def __init__(self, table_name: str, identity: object, schema: Optional[RowSchema] = None):
         self.identity = identity  # type: object
         self.table_name = table_name  # type: str
-        self.items = {}  # type: Dict[str, object]
+        self.schema = schema or RowSchema.for_table(table_name)  # type: RowSchema
+        self.values = [_UNSET] * len(self.schema.names)  # type: List[object]
 
     def put(self, key: str, value: object) -> None:
-        self.items[key] = value
+        slot: int = self.schema.slot_of(key)
+        values: List[object] = self.values
+        if slot >= len(values):
+            values.extend([_UNSET] * (slot + 1 - len(values)))
+        values[slot] = value
 
     def get(self, key: str) -> Any:
-        return self.items[key]
+        slot: Optional[int] = self.schema.index.get(key)
+        if slot is None or slot >= len(self.values) or self.values[slot] is _UNSET:
+            raise KeyError(key)
+        return self.values[slot]
+
+    def set_values(self, names: Tuple[str, ...], values: Sequence) -> None:
+        # Replaces the content of the row with names[i] = values[i]
+        slots, in_order = self.schema.slots_for(names)
+        if in_order:
+            self.values = list(values)
+        else:
+            res: List[object] = [_UNSET] * (max(slots) + 1 if slots else 0)
+            for slot, value in zip(slots, values):
+                res[slot] = value
+            self.values = res
+
+    def iter_items(self) -> Iterator[Tuple[str, object]]:
+        names: List[str] = self.schema.names
+        for slot, value in enumerate(self.values):
+            if value is not _UNSET:
+                yield names[slot], value
+
+    @property
+    def items(self) -> 'RowItems':
+        # Dictionary view kept for code written against the former items dict
+        return RowItems(self)
+
+    @items.setter
+    def items(self, value: Dict[str, object]) -> None:
+        self.values = []
+        for key in value:
+            self.put(key, value[key])
+
+
+class RowItems(MutableMapping):
+    def __init__(self, row: DataRow):
+        self.row: DataRow = row
+
+    def __getitem__(self, key: str) -> Any:
+        return self.row.get(key)
+
+    def __setitem__(self, key: str, value: object) -> None:
+        self.row.put(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.row.get(key)
+        self.row.values[self.row.schema.index[key]] = _UNSET
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key, _ in self.row.iter_items())
+
+    def __len__(self) -> int:
+        return sum(1 for value in self.row.values if value is not _UNSET)
+
+    def __repr__(self):
+        return repr(dict(self.row.iter_items()))
+
+
+class QueryRow(object):
+    # Read-only row yielded by Database.iter_rows: the values tuple plus the column map shared by every row of the
+    # query
+    __slots__ = ('table_name', 'identity', 'values', 'column_index')
+
+    def __init__(self, table_name: str, identity: object, values: Tuple, column_index: Mapping[str, int]):
+        self.table_name: str = table_name
+        self.identity: object = identity
+        self.values: Tuple = values
+        self.column_index: Mapping[str, int] = column_index
+
+    def get(self, key: str) -> Any:
+        return self.values[self.column_index[key]]
+
+    def __getitem__(self, key: str) -> Any:
+        return self.values[self.column_index[key]]
+
+    def to_data_row(self) -> DataRow:
+        res: DataRow = DataRow(self.table_name, self.identity)
+        res.set_values(tuple(self.column_index), self.values)
+        return res
 
 
 class DataTable(object):
@@ -79,7 +250,10 @@ class DataTable(object):
 
     def merge(self, other: 'DataTable'):
         if self.table_name == other.table_name:
-            self.merge_rows(list(other.rows.values()))
+            rows: Dict[object, DataRow] = self.rows
+            for identity, row in other.rows.items():
+                if identity not in rows:
+                    rows[identity] = row
 
 
 class DataSet(object):
@@ -87,9 +261,11 @@ class DataSet(object):
         self.tables = {}  # type: Dict[str, DataTable]
 
     def merge_row(self, row: DataRow) -> None:
-        if row.table_name not in self.tables:
-            self.tables[row.table_name] = DataTable(row.table_name)
-        self.tables[row.table_name].merge_rows([row])
+        table: Optional[DataTable] = self.tables.get(row.table_name)
+        if table is None:
+            table = self.tables[row.table_name] = DataTable(row.table_name)
+        if row.identity not in table.rows:
+            table.rows[row.identity] = row
 
     def merge(self, other: 'DataSet') -> None:
         for table_name in other.tables:
@@ -109,6 +285,10 @@ class Table(object):
         self.columns: List[Column] = []
         self.primary_key: Optional[str] = None
         self.foreign_keys: List[ForeignKey] = []
+        self.indexes: List[Index] = []
+        # Rows already written with the same values are skipped, see RowWriteCache
+        self.write_cache: bool = False
+        self.layout: Optional[TableLayout] = None
 
     @staticmethod
     def from_json(json_object: Dict) -> 'Table':
@@ -117,9 +297,11 @@ class Table(object):
         res.columns = [Column.from_json(r) for r in json_object['columns']]
         res.primary_key = json_object.get('primary_key')
         res.foreign_keys = [ForeignKey.from_json(fk) for fk in json_object['foreign_keys']]
+        res.indexes = [Index.from_json(ix, res.name) for ix in json_object.get('indexes', [])]
+        res.write_cache = json_object.get('write_cache', False)
         return res
 
-    def get_create_cmd(self):
+    def get_create_cmd(self, table_name: Optional[str] = None):
         columns_create_str_list: List[str] = []
         for column in self.columns:
             col_str: str = '{n} {t}'.format(n=column.name, t=column.type)
@@ -132,35 +314,147 @@ class Table(object):
         for foreign_key in self.foreign_keys:
             fk_str: str = f'FOREIGN KEY ({foreign_key.column}) REFERENCES {foreign_key.referenced_table}({foreign_key.referenced_column})'
             columns_create_str_list.append(fk_str)
-        res: str = f'CREATE TABLE IF NOT EXISTS [{self.name}] ({", ".join(columns_create_str_list)});'
+        res: str = f'CREATE TABLE IF NOT EXISTS [{table_name or self.name}] ({", ".join(columns_create_str_list)});'
         return res
 
+    def get_layout(self) -> 'TableLayout':
+        # Compiled on first use; a table is not changed once the database has been loaded
+        if self.layout is None:
+            self.layout = TableLayout(self)
+        return self.layout
+
     def row_to_tuple_for_insert(self, row: DataRow) -> Tuple:
-        res: List = [None] * len(self.columns)
-        key: str
-        for key in row.items:
-            try:
-                index: int = [i for i, col in enumerate(self.columns) if key == col.name][0]
-            except:
+        return self.get_layout().row_to_tuple_for_insert(row)
+
+    def row_to_tuple_for_update(self, row: DataRow) -> Tuple:
+        return self.get_layout().row_to_tuple_for_update(row)
+
+    def __repr__(self):
+        return 'Table: ' + self.name
+
+
+class TableLayout(object):
+    # Column positions and SQL text of a table, computed once so the read and write paths do no lookups by scanning
+    def __init__(self, table: Table):
+        self.name: str = table.name
+        self.primary_key: Optional[str] = table.primary_key
+        self.write_cache: bool = table.write_cache and table.primary_key is not None
+        self.column_names: Tuple[str, ...] = tuple(c.name for c in table.columns)
+        self.column_index: Mapping[str, int] = MappingProxyType({n: i for i, n in enumerate(self.column_names)})
+        # Rows read from the table take the fast path of DataRow.set_values
+        self.schema: RowSchema = RowSchema.for_table(table.name, self.column_names)
+        self.pk_index: Optional[int] = self.column_index.get(table.primary_key)
+        self.update_column_names: Tuple[str, ...] = tuple(n for n in self.column_names if n != table.primary_key)
+        self.update_index: Mapping[str, int] = MappingProxyType(
+            {n: i for i, n in enumerate(self.update_column_names)})
+        columns: str = ', '.join(self.column_names)
+        placeholders: str = ', '.join('?' for _ in self.column_names)
+        assignments: str = ', '.join(n + '=?' for n in self.update_column_names)
+        self.insert_sql: str = f'INSERT into [{self.name}] ({columns}) values ({placeholders})'
+        self.update_sql: str = f'UPDATE [{self.name}] SET {assignments} where {self.primary_key}=?'
+        conflict: str = ''
+        if self.primary_key is not None:
+            if self.update_column_names:
+                conflict = f' ON CONFLICT({self.primary_key}) DO UPDATE SET ' + \
+                           ', '.join(f'{n}=excluded.{n}' for n in self.update_column_names)
+            else:
+                conflict = f' ON CONFLICT({self.primary_key}) DO NOTHING'
+        self.upsert_sql: str = self.insert_sql + conflict
+        self.select_sql: str = f'SELECT {columns} FROM [{self.name}];'
+        self.select_by_pk_sql: str = f'SELECT {columns} FROM [{self.name}] WHERE {self.primary_key}=?;'
+        self.select_ids_sql: str = f'SELECT {self.primary_key} FROM [{self.name}];'
+        self._partial_update_sql: Dict[Tuple[int, ...], str] = {}
+
+    def __setattr__(self, key, value):
+        if key in self.__dict__:
+            raise AttributeError(f'TableLayout of {self.name} is read-only')
+        super().__setattr__(key, value)
+
+    def row_to_tuple_for_insert(self, row: DataRow) -> Tuple:
+        res: List = [None] * len(self.column_names)
+        column_index: Mapping[str, int] = self.column_index
+        for key, value in row.iter_items():
+            index: Optional[int] = column_index.get(key)
+            if index is None:
                 raise RuntimeError('Column \'{k}\' not found in table \'{t}\''.format(k=key, t=self.name))
-            res[index] = row.items[key]
+            res[index] = value
         return tuple(res)
 
     def row_to_tuple_for_update(self, row: DataRow) -> Tuple:
-        columns_without_pk: List[Column] = [c for c in self.columns if c.name != self.primary_key]
-        res: List[object] = [None for _ in columns_without_pk]
-        for key in row.items:
+        res: List = [None] * (len(self.update_column_names) + 1)
+        update_index: Mapping[str, int] = self.update_index
+        for key, value in row.iter_items():
             if key != self.primary_key:
-                try:
-                    index: int = [i for i, col in enumerate(columns_without_pk) if key == col.name][0]
-                except:
+                index: Optional[int] = update_index.get(key)
+                if index is None:
                     raise RuntimeError('Column \'{k}\' not found in table \'{t}\''.format(k=key, t=self.name))
-                res[index] = row.items[key]
-        res.append(row.items[self.primary_key])
+                res[index] = value
+        res[-1] = row.get(self.primary_key)
         return tuple(res)
 
-    def __repr__(self):
-        return 'Table: ' + self.name
+    def get_partial_update_sql(self, column_indices: Tuple[int, ...]) -> str:
+        # UPDATE of only the given columns, compiled once per combination
+        res: Optional[str] = self._partial_update_sql.get(column_indices)
+        if res is None:
+            assignments: str = ', '.join(self.column_names[i] + '=?' for i in column_indices)
+            res = f'UPDATE [{self.name}] SET {assignments} WHERE {self.primary_key}=?;'
+            self._partial_update_sql[column_indices] = res
+        return res
+
+    def to_row(self, table_name: str, row_tuple: Tuple) -> DataRow:
+        row: DataRow = DataRow(table_name, row_tuple[self.pk_index], self.schema)
+        row.set_values(self.column_names, row_tuple)
+        return row
+
+
+class RowWriteCache(object):
+    # Column values last written for each (table, primary key) of the tables marked with write_cache, least recently
+    # used first. Database.upsert_rows skips a row whose values are unchanged and updates only the columns that
+    # differ. The values are compared rather than hashes since equal hashes (hash(-1) == hash(-2)) would drop writes.
+    # Writes made outside upsert_rows forget the rows they touch, and a rolled back Database.transaction clears the
+    # whole cache.
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size: int = max_size
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.rows_skipped: int = 0
+        self.rows_updated: int = 0
+        self.rows_written: int = 0
+
+    def get(self, table_name: str, identity: object) -> Optional[Tuple]:
+        key: Tuple[str, object] = (table_name, identity)
+        with self._lock:
+            res: Optional[Tuple] = self._entries.get(key)
+            if res is not None:
+                self._entries.move_to_end(key)
+            return res
+
+    def put(self, table_name: str, identity: object, values: Tuple) -> None:
+        key: Tuple[str, object] = (table_name, identity)
+        with self._lock:
+            self._entries[key] = values
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def forget(self, table_name: str, identities: Iterator[object]) -> None:
+        with self._lock:
+            for identity in identities:
+                self._entries.pop((table_name, identity), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'cached_rows': len(self._entries),
+                'rows_skipped': self.rows_skipped,
+                'rows_updated': self.rows_updated,
+                'rows_written': self.rows_written}
 
 
 class DbSerializable(object):
@@ -176,10 +470,19 @@ class DbSerializable(object):
 
 
 class Database(JsonDeserializable):
+    SCHEMA_INFO_TABLE: str = 'schema_info'
+
     def __init__(self):
         self.name: str = 'db'
         self.filename: Optional[str] = None
         self.tables: List[Table] = []
+        self.tables_by_name: Dict[str, Table] = {}
+        self.layouts: Dict[str, TableLayout] = {}
+        self.connection_settings: ConnectionSettings = ConnectionSettings()
+        # Tables whose column definitions changed, copied in the background by db.migration.SchemaMigrator
+        self.pending_migrations: List[Table] = []
+        self.write_cache: RowWriteCache = RowWriteCache()
+        self._connections: Optional[ConnectionManager] = None
 
     @classmethod
     def from_json(cls, json_obj: Dict) -> 'Database':
@@ -187,24 +490,94 @@ class Database(JsonDeserializable):
         res.name = json_obj.get('name')
         res.filename = json_obj['filename']
         res.tables = [Table.from_json(t) for t in json_obj['tables']]
+        res.connection_settings = ConnectionSettings.from_json(json_obj.get('connection', {}))
+        res.write_cache = RowWriteCache(json_obj.get('write_cache_size', 10000))
+        res.compile_tables()
         return res
 
+    def compile_tables(self) -> None:
+        # Every layout is built here, from from_json, so reads and writes only look it up
+        for table in self.tables:
+            table.get_layout()
+        self.tables_by_name = {t.name: t for t in self.tables}
+        self.layouts = {t.name: t.layout for t in self.tables}
+
+    @property
+    def connections(self) -> ConnectionManager:
+        if self._connections is None:
+            self._connections = ConnectionManager(self.filename, self.connection_settings)
+        return self._connections
+
     def create_connection(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.filename)
+        # A separate connection the caller closes; use connection() or transaction() on hot paths
+        return self.connections.connect()
 
-    def create_tables(self):
-        conn: sqlite3.Connection = sqlite3.connect(self.filename)
+    def connection(self) -> sqlite3.Connection:
+        return self.connections.connection()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        try:
+            with self.connections.transaction() as connection:
+                yield connection
+        except BaseException:
+            # The cache may hold rows of the rolled back transaction
+            self.write_cache.clear()
+            raise
+
+    def close(self) -> None:
+        if self._connections is not None:
+            self._connections.close_all()
+
+    def create_tables(self, force: bool = False):
+        # Skips the comparison with the existing tables when they were last brought to this same schema
+        self.pending_migrations = []
+        conn: sqlite3.Connection = self.create_connection()
+        fingerprint: str = self.get_schema_fingerprint()
+        if not force and self.read_schema_fingerprint(conn) == fingerprint:
+            logging.debug(f'Database schema unchanged ({fingerprint[:12]})')
+            conn.close()
+            return
         for table in self.tables:
             if not self.table_exists(conn, table.name):
                 self.create_table(conn, table)
             else:
                 self.update_table(conn, table)
+            self.update_indexes(conn, table)
+        # Stored by the SchemaMigrator instead once the pending migrations are done
+        self.store_schema_fingerprint(conn, fingerprint if len(self.pending_migrations) == 0 else None)
+        conn.commit()
         conn.close()
 
+    def get_schema_fingerprint(self) -> str:
+        # Hash of the compiled definitions, so formatting and key order of the json file do not matter
+        schema: List = sorted([t.get_create_cmd(), sorted(ix.get_create_cmd(t.name) for ix in t.indexes)]
+                              for t in self.tables)
+        return hashlib.sha256(json.dumps(schema).encode('utf-8')).hexdigest()
+
+    def read_schema_fingerprint(self, connection: sqlite3.Connection) -> Optional[str]:
+        try:
+            row: Optional[Tuple] = connection.execute(
+                f'SELECT value FROM [{self.SCHEMA_INFO_TABLE}] WHERE key=\'fingerprint\';').fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def store_schema_fingerprint(self, connection: sqlite3.Connection, fingerprint: Optional[str]) -> None:
+        connection.execute(f'CREATE TABLE IF NOT EXISTS [{self.SCHEMA_INFO_TABLE}] (key TEXT PRIMARY KEY, value TEXT);')
+        if fingerprint is None:
+            connection.execute(f'DELETE FROM [{self.SCHEMA_INFO_TABLE}] WHERE key=\'fingerprint\';')
+        else:
+            connection.execute(f'INSERT OR REPLACE INTO [{self.SCHEMA_INFO_TABLE}] (key, value) '
+                               f'VALUES (\'fingerprint\', ?);', (fingerprint,))
+
     def save(self, obj: DbSerializable):
-        with self.create_connection() as connection:
+        with self.transaction() as connection:
             self.save_data_set(connection, obj.to_data_set())
-            connection.commit()
+
+    def unit_of_work(self, max_objects: int = 100, max_delay: Optional[float] = 0.05, max_retries: int = 3,
+                     retry_delay: float = 0.1) -> 'UnitOfWork':
+        return UnitOfWork(self, max_objects, max_delay, max_retries, retry_delay)
 
     def table_exists(self, connection: sqlite3.Connection, table_name: str) -> bool:
         cursor: sqlite3.Cursor = connection.cursor()
@@ -216,6 +589,39 @@ class Database(JsonDeserializable):
         cursor: sqlite3.Cursor = connection.cursor()
         cursor.execute(table.get_create_cmd())
 
+    def get_current_indexes(self, connection: sqlite3.Connection, table_name: str) -> Dict[str, str]:
+        # Explicitly created indexes only; the ones SQLite creates for primary keys have no sql
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute('SELECT name, sql FROM sqlite_master WHERE type=\'index\' AND tbl_name=? AND sql IS NOT NULL;',
+                       (table_name,))
+        return {name: sql for name, sql in cursor.fetchall()}
+
+    def update_indexes(self, connection: sqlite3.Connection, table: Table) -> None:
+        # Drops indexes no longer defined or whose definition changed, then creates the missing ones
+        current: Dict[str, str] = self.get_current_indexes(connection, table.name)
+        defined: Dict[str, str] = {ix.name: ix.get_create_cmd(table.name) for ix in table.indexes}
+        cursor: sqlite3.Cursor = connection.cursor()
+        for name, sql in current.items():
+            if defined.get(name) != sql:
+                cursor.execute(f'DROP INDEX [{name}];')
+        for name, sql in defined.items():
+            if current.get(name) != sql:
+                cursor.execute(sql + ';')
+
+    def explain(self, connection: sqlite3.Connection, sql: str, query_params: Tuple = ()) -> List[str]:
+        # Query plan lines, e.g. 'SEARCH message USING INDEX ix_message_id_chat_date (id_chat=?)'
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, query_params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def indexes_used(self, connection: sqlite3.Connection, sql: str, query_params: Tuple = ()) -> List[str]:
+        res: List[str] = []
+        for detail in self.explain(connection, sql, query_params):
+            words: List[str] = detail.split(' ')
+            if 'INDEX' in words and words.index('INDEX') + 1 < len(words):
+                res.append(words[words.index('INDEX') + 1])
+        return res
+
     def update_table(self, connection: sqlite3.Connection, table: Table) -> None:
         # cursor = connection.cursor()
         curr_table = self.get_current_table(connection, table.name)
@@ -224,29 +630,19 @@ class Database(JsonDeserializable):
             defined_col = utils.first_or_default_where(table.columns, lambda c: c.name == curr_col.name)
             if defined_col is not None and curr_col != defined_col:
                 update_needed = True
+        current_names: Set[str] = {c.name for c in curr_table.columns}
+        for expected_column in table.columns:
+            if expected_column.name not in current_names:
+                # While a migration is pending the column is added as nullable, so that rows keep being written to
+                # the current table until the copy with the new definition replaces it
+                self.add_column_to_table(connection, table.name, expected_column, force_nullable=update_needed)
         if update_needed:
-            self.recreate_table(connection, table)
-        else:
-            # add_columns_needed = False  # type: bool
-            for expected_column in table.columns:
-                if expected_column not in curr_table.columns:
-                    self.add_column_to_table(connection, table.name, expected_column)
-
-    def recreate_table(self, connection: sqlite3.Connection, table: Table):
-        curr_table: Table = self.get_current_table(connection, table.name)
-        columns_str: str = ', '.join([c.name for c in curr_table.columns])
-        cursor: sqlite3.Cursor = connection.cursor()
-        backup_table_name: str = table.name + '_bk'
-        sql_cmd = 'ALTER TABLE [{t}] RENAME TO [{bt}];'.format(t=table.name, bt=backup_table_name)
-        cursor.execute(sql_cmd)
-        cursor.execute(table.get_create_cmd())
-        cursor.execute(
-            'INSERT INTO [{t}]({c}) SELECT {c} FROM [{bt}];'.format(t=table.name, bt=backup_table_name, c=columns_str))
-        cursor.execute('DROP TABLE [{bt}];'.format(bt=backup_table_name))
+            self.pending_migrations.append(table)
 
-    def add_column_to_table(self, connection: sqlite3.Connection, table_name: str, column: Column) -> None:
+    def add_column_to_table(self, connection: sqlite3.Connection, table_name: str, column: Column,
+                            force_nullable: bool = False) -> None:
         col_str: str = '[{n}] {t}'.format(n=column.name, t=column.type)
-        if not column.nullable:
+        if not column.nullable and not force_nullable:
             col_str += ' NOT NULL'
         # if self.primary_key is not None and self.primary_key == column.name:
         #     col_str += ' PRIMARY KEY'
@@ -294,84 +690,107 @@ class Database(JsonDeserializable):
             self.save_data_table(connection, data_table_collection.tables[table_name])
 
     def save_data_table(self, connection: sqlite3.Connection, data_table: DataTable):
-        existing_ids: Set = self.get_existing_ids(connection, data_table.table_name)
-        new_rows: List[DataRow] = [r for r in data_table.rows.values() if r.identity not in existing_ids]
-        self.insert_rows(connection, new_rows)
-        existing_rows = [r for r in data_table.rows.values() if r.identity in existing_ids]
-        self.update_rows(connection, existing_rows)
+        # Cost depends on the number of rows saved, not on the size of the table
+        self.upsert_rows(connection, list(data_table.rows.values()))
 
     def insert_rows(self, connection: sqlite3.Connection, rows: List[DataRow]) -> None:
         cursor: sqlite3.Cursor = connection.cursor()
         groups: Iterator[Tuple[str, Iterator[DataRow]]] = itertools.groupby(rows, lambda r: r.table_name)
         for table_name, table_rows in groups:
-            table = [t for t in self.tables if t.name == table_name][0]  # type: Table
-            columns = ', '.join([c.name for c in table.columns])  # type: str
-            values_placeholder = ', '.join(['?' for _ in table.columns])  # type: str
-            sql_cmd = 'INSERT into [{t}] ({c}) values ({v})'.format(t=table.name, c=columns,
-                                                                    v=values_placeholder)  # type: str
-            values = [table.row_to_tuple_for_insert(row) for row in table_rows]
-            cursor.executemany(sql_cmd, values)
+            layout: TableLayout = self.get_layout(table_name)
+            value_tuples: List[Tuple] = [layout.row_to_tuple_for_insert(row) for row in table_rows]
+            cursor.executemany(layout.insert_sql, value_tuples)
+            if layout.write_cache:
+                self.write_cache.forget(table_name, (t[layout.pk_index] for t in value_tuples))
+
+    def upsert_rows(self, connection: sqlite3.Connection, rows: List[DataRow]) -> None:
+        # Rows whose primary key already exists get every other column overwritten, as update_rows does
+        cursor: sqlite3.Cursor = connection.cursor()
+        groups: Iterator[Tuple[str, Iterator[DataRow]]] = itertools.groupby(rows, lambda r: r.table_name)
+        for table_name, table_rows in groups:
+            layout: TableLayout = self.get_layout(table_name)
+            if layout.write_cache:
+                self.upsert_changed_rows(cursor, layout, table_rows)
+            else:
+                cursor.executemany(layout.upsert_sql, [layout.row_to_tuple_for_insert(row) for row in table_rows])
+
+    def upsert_changed_rows(self, cursor: sqlite3.Cursor, layout: TableLayout, rows: Iterator[DataRow]) -> None:
+        cache: RowWriteCache = self.write_cache
+        upserts: List[Tuple] = []
+        for row in rows:
+            values: Tuple = layout.row_to_tuple_for_insert(row)
+            pk: object = values[layout.pk_index]
+            previous: Optional[Tuple] = cache.get(layout.name, pk)
+            if previous == values:
+                cache.rows_skipped += 1
+                continue
+            if previous is not None:
+                changed: Tuple[int, ...] = tuple(i for i, v in enumerate(values) if v != previous[i])
+                cursor.execute(layout.get_partial_update_sql(changed), tuple(values[i] for i in changed) + (pk,))
+                # No row when it was deleted in the meantime; it is then inserted again below
+                if cursor.rowcount == 1:
+                    cache.put(layout.name, pk, values)
+                    cache.rows_updated += 1
+                    continue
+            upserts.append(values)
+            cache.put(layout.name, pk, values)
+        if upserts:
+            cursor.executemany(layout.upsert_sql, upserts)
+            cache.rows_written += len(upserts)
 
     def insert_data_set(self, connection: sqlite3.Connection, data_table_collection: DataSet):
         cursor = connection.cursor()
         for table_name in data_table_collection.tables:
-            table = self.get_table(table_name)
-            columns = ', '.join([c.name for c in table.columns])  # type: str
-            values_placeholder = ', '.join(['?' for _ in table.columns])  # type: str
-            sql_cmd = 'INSERT into [{t}] ({c}) values ({v})'.format(t=table.name, c=columns,
-                                                                    v=values_placeholder)  # type: str
-            values = [table.row_to_tuple_for_insert(row) for row in
+            layout: TableLayout = self.get_layout(table_name)
+            values = [layout.row_to_tuple_for_insert(row) for row in
                       data_table_collection.tables[table_name].rows.values()]
-            cursor.executemany(sql_cmd, values)
+            cursor.executemany(layout.insert_sql, values)
 
     def update_rows(self, connection: sqlite3.Connection, rows: List[DataRow]) -> None:
         cursor = connection.cursor()  # type: sqlite3.Connection
         groups = itertools.groupby(rows, lambda r: r.table_name)
         for table_name, rows in groups:
-            table = [t for t in self.tables if t.name == table_name][0]  # type: Table
-            values = ', '.join([c.name + '=?' for c in table.columns if c.name != table.primary_key])  # type: str
-            sql_cmd = 'UPDATE [{t}] SET {v} where {pk}=?'.format(t=table.name, pk=table.primary_key,
-                                                                 v=values)  # type: str
-            values = [table.row_to_tuple_for_update(row) for row in rows]
-            cursor.executemany(sql_cmd, values)
+            layout: TableLayout = self.get_layout(table_name)
+            value_tuples: List[Tuple] = [layout.row_to_tuple_for_update(row) for row in rows]
+            cursor.executemany(layout.update_sql, value_tuples)
+            if layout.write_cache:
+                self.write_cache.forget(table_name, (t[-1] for t in value_tuples))
 
     def table_contains(self, connection: sqlite3.Connection, table_name: str, obj_id: object):
         cursor = connection.cursor()  # type: sqlite3.Cursor
-        table = self.get_table(table_name)  # type: Table
-        cursor.execute('SELECT * FROM [{t}] WHERE {pk}=?;'.format(t=table_name, pk=table.primary_key), (obj_id,))
-        rows = cursor.fetchall()
-        return len(rows) > 0
+        cursor.execute(self.get_layout(table_name).select_by_pk_sql, (obj_id,))
+        return cursor.fetchone() is not None
 
     def get_table(self, table_name: str) -> Table:
-        tables = [t for t in self.tables if t.name == table_name]
-        if len(tables) > 0:
-            return tables[0]
-        else:
-            raise RuntimeError('Table {t} not found'.format(t=table_name))
+        table: Optional[Table] = self.tables_by_name.get(table_name)
+        if table is None:
+            # Tables appended to self.tables after loading
+            self.compile_tables()
+            table = self.tables_by_name.get(table_name)
+            if table is None:
+                raise RuntimeError('Table {t} not found'.format(t=table_name))
+        return table
+
+    def get_layout(self, table_name: str) -> TableLayout:
+        layout: Optional[TableLayout] = self.layouts.get(table_name)
+        if layout is None:
+            layout = self.get_table(table_name).get_layout()
+        return layout
 
     def query(self, connection: sqlite3.Connection, table_name: str, id_object: object,
               include_children: bool) -> DataSet:
         res: DataSet = DataSet()
         dt: DataTable = DataTable(table_name)
         cursor: sqlite3.Cursor = connection.cursor()
-        table: Table = self.get_table(table_name)
-        column_names: List[str] = [c.name for c in table.columns]
-        column_str: str = ', '.join(column_names)
+        layout: TableLayout = self.get_layout(table_name)
         if id_object is not None:
-            cursor.execute(
-                f'SELECT {column_str} FROM [{table_name}] WHERE {table.primary_key}=?;',
-                (id_object,))
+            cursor.execute(layout.select_by_pk_sql, (id_object,))
         else:
-            cursor.execute(f'SELECT {column_str} FROM [{table_name}];')
-        row_tuples = cursor.fetchall()
-        for row_tuple in row_tuples:
-            row: DataRow = DataRow(table_name, row_tuple[utils.first_index_of(column_names, table.primary_key)])
-            column_name: str
-            for column_name in column_names:
-                idx: List[int] = utils.index_of(column_names, column_name)
-                if len(idx) > 0:
-                    row.put(column_name, row_tuple[idx[0]])
-            dt.merge_rows([row])
+            cursor.execute(layout.select_sql)
+        for row_tuple in cursor.fetchall():
+            row: DataRow = layout.to_row(table_name, row_tuple)
+            if row.identity not in dt.rows:
+                dt.rows[row.identity] = row
         res.tables[dt.table_name] = dt
         return res
 
@@ -395,16 +814,46 @@ class Database(JsonDeserializable):
 
         res: DataSet = DataSet()
         dt: DataTable = DataTable(table_name)
+        pk_index: int = column_list.index(table.primary_key)
+        column_names: Tuple[str, ...] = tuple(column_list)
         for row_tuple in row_tuples:
-            row: DataRow = DataRow(table_name, row_tuple[utils.first_index_of(column_list, table.primary_key)])
-            for column_name in column_list:
-                idx: List[int] = utils.index_of(column_list, column_name)
-                if len(idx) > 0:
-                    row.put(column_name, row_tuple[idx[0]])
-            dt.merge_rows([row])
+            row: DataRow = DataRow(table_name, row_tuple[pk_index])
+            row.set_values(column_names, row_tuple)
+            if row.identity not in dt.rows:
+                dt.rows[row.identity] = row
         res.tables[dt.table_name] = dt
         return res
 
+    def iter_rows(self, connection: sqlite3.Connection, table_name: str, where_clause: Optional[str] = None,
+                  query_params: Optional[Tuple] = None, batch_size: int = 500,
+                  column_list: Optional[List[str]] = None) -> Iterator[QueryRow]:
+        # Rows are fetched batch_size at a time while iterating, so memory does not grow with the table. Unlike
+        # query, duplicates are not merged and nothing is kept once yielded.
+        layout: TableLayout = self.get_layout(table_name)
+        if column_list is None:
+            column_index: Mapping[str, int] = layout.column_index
+            select: str = layout.select_sql.rstrip(';')
+        else:
+            if layout.primary_key is not None and layout.primary_key not in column_list:
+                column_list = [layout.primary_key] + column_list
+            column_index = MappingProxyType({n: i for i, n in enumerate(column_list)})
+            select = f'SELECT {", ".join(column_list)} FROM [{table_name}]'
+        if where_clause is not None:
+            select += f' WHERE {where_clause}'
+        pk_index: Optional[int] = column_index.get(layout.primary_key)
+        cursor: sqlite3.Cursor = connection.cursor()
+        try:
+            cursor.execute(select, query_params or ())
+            while True:
+                row_tuples: List[Tuple] = cursor.fetchmany(batch_size)
+                if not row_tuples:
+                    break
+                for row_tuple in row_tuples:
+                    yield QueryRow(table_name, row_tuple[pk_index] if pk_index is not None else None, row_tuple,
+                                   column_index)
+        finally:
+            cursor.close()
+
     def query_row(self, connection: sqlite3.Connection, table_name: str, id_object: object) -> DataRow or None:
         ds = self.query(connection, table_name, id_object, True)
         dt = ds.tables[table_name]
@@ -424,11 +873,159 @@ class Database(JsonDeserializable):
         return obj_type.from_data_set(ds)[0]
 
     def get_existing_ids(self, connection: sqlite3.Connection, table_name: str) -> Set:
-        res = set()
         cursor = connection.cursor()  # type: sqlite3.Cursor
-        table = self.get_table(table_name)  # type: Table
-        cursor.execute('SELECT {c} FROM [{t}];'.format(c=table.primary_key, t=table_name))
-        rows = cursor.fetchall()
-        for row in rows:
-            res.add(row[0])
-        return res
+        cursor.execute(self.get_layout(table_name).select_ids_sql)
+        return {row[0] for row in cursor.fetchall()}
+
+
+class UnitOfWork(object):
+    # Objects added are saved together in one transaction once max_objects are pending or the oldest one has waited
+    # max_delay seconds. With max_delay None every add commits before returning, like Database.save. Objects are
+    # converted to data sets when added, so later changes to them are not saved.
+    # A failed commit puts its objects back ahead of the ones added since and is retried, after a growing delay in the
+    # background. Once max_retries have failed the objects are saved one per transaction and only the ones that still
+    # fail are dropped.
+
+    def __init__(self, database: Database, max_objects: int = 100, max_delay: Optional[float] = 0.05,
+                 max_retries: int = 3, retry_delay: float = 0.1):
+        self.database: Database = database
+        self.max_objects: int = max_objects
+        self.max_delay: Optional[float] = max_delay
+        self.max_retries: int = max_retries
+        self.retry_delay: float = retry_delay
+        # Failed commits in a row of the objects at the front of _pending
+        self._failures: int = 0
+        self._pending: List[DataSet] = []
+        self._first_pending: float = 0.
+        self._condition: threading.Condition = threading.Condition()
+        # Keeps commits in the order the objects were added
+        self._flush_lock: threading.Lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed: bool = False
+        self.commits: int = 0
+        self.commits_failed: int = 0
+        self.objects_dropped: int = 0
+        self.objects_saved: int = 0
+        self.rows_saved: int = 0
+        self.max_rows_per_commit: int = 0
+        self.total_commit_seconds: float = 0.
+        self.last_commit_seconds: float = 0.
+        self.max_commit_seconds: float = 0.
+
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def add(self, obj: DbSerializable) -> None:
+        self.add_data_set(obj.to_data_set())
+
+    def add_data_set(self, data_set: DataSet) -> None:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Unit of work is closed')
+            self._pending.append(data_set)
+            flush_now: bool = self.max_delay is None or len(self._pending) >= self.max_objects
+            if not flush_now and len(self._pending) == 1:
+                self._first_pending = time.monotonic()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_loop, name='unit-of-work', daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+        if flush_now:
+            self.flush()
+
+    def pending_count(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def flush(self) -> None:
+        # Raises if the commit fails and the objects are kept for the next flush. After max_retries failures the
+        # objects that cannot be saved on their own are dropped instead.
+        with self._flush_lock:
+            with self._condition:
+                batch: List[DataSet] = self._pending
+                self._pending = []
+            if len(batch) == 0:
+                return
+            try:
+                self._commit(batch)
+            except Exception:
+                self.commits_failed += 1
+                self._failures += 1
+                if self._failures <= self.max_retries:
+                    with self._condition:
+                        self._pending[:0] = batch
+                    raise
+                self._failures = 0
+                for data_set in batch:
+                    try:
+                        self._commit([data_set])
+                    except Exception as e:
+                        self.objects_dropped += 1
+                        logging.error(f'Dropping an object that could not be saved: {e}')
+                return
+            self._failures = 0
+
+    def _commit(self, batch: List[DataSet]) -> None:
+        start: float = time.perf_counter()
+        with self.database.transaction() as connection:
+            for data_set in batch:
+                self.database.save_data_set(connection, data_set)
+        elapsed: float = time.perf_counter() - start
+        rows: int = sum(len(t.rows) for ds in batch for t in ds.tables.values())
+        self.commits += 1
+        self.objects_saved += len(batch)
+        self.rows_saved += rows
+        self.max_rows_per_commit = max(self.max_rows_per_commit, rows)
+        self.total_commit_seconds += elapsed
+        self.last_commit_seconds = elapsed
+        self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+    def close(self) -> None:
+        # Commits what is pending; no objects can be added afterwards
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        while True:
+            try:
+                self.flush()
+                return
+            except Exception as e:
+                logging.warning(f'Could not save pending objects, attempt {self._failures}: {e}')
+                time.sleep(self.retry_delay * 2 ** (self._failures - 1))
+
+    def metrics(self) -> Dict[str, float]:
+        return {'pending': self.pending_count(),
+                'commits': self.commits,
+                'commits_failed': self.commits_failed,
+                'objects_dropped': self.objects_dropped,
+                'objects_saved': self.objects_saved,
+                'rows_saved': self.rows_saved,
+                'rows_per_commit': self.rows_saved / self.commits if self.commits > 0 else 0.,
+                'max_rows_per_commit': self.max_rows_per_commit,
+                'avg_commit_seconds': self.total_commit_seconds / self.commits if self.commits > 0 else 0.,
+                'last_commit_seconds': self.last_commit_seconds,
+                'max_commit_seconds': self.max_commit_seconds}
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed and len(self._pending) == 0:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                delay: float = self._first_pending + self.max_delay - time.monotonic()
+                while not self._closed and len(self._pending) > 0 and delay > 0:
+                    self._condition.wait(delay)
+                    delay = self._first_pending + self.max_delay - time.monotonic()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f'Could not save pending objects, attempt {self._failures}: {e}')
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed, self.retry_delay * 2 ** (self._failures - 1))
@@ -0,0 +1,238 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from db.database import Database, Table
+
+
+class MigrationProgress(object):
+    def __init__(self, table_name: str, copied_rows: int, total_rows: int):
+        self.table_name: str = table_name
+        self.copied_rows: int = copied_rows
+        self.total_rows: int = total_rows
+
+    @property
+    def fraction(self) -> float:
+        return min(1., self.copied_rows / self.total_rows) if self.total_rows > 0 else 1.
+
+    def __repr__(self):
+        return f'MigrationProgress: {self.table_name} {self.copied_rows}/{self.total_rows}'
+
+
+class SchemaMigrator(object):
+    # Brings the tables in Database.pending_migrations to their new definition without blocking the bot. Rows are
+    # copied by rowid in short transactions into [<table>__migrating] while the bot keeps reading and writing the
+    # current table; triggers mirror those writes into the copy, skipping rows that do not fit the new definition so
+    # that the bot's writes never fail. The batches only cover the rowids present when the copy began, so the copy
+    # ends under steady writes. Once it holds every row, the current table is dropped and the copy renamed in one
+    # transaction; otherwise the migration is aborted and the current table kept. The rowid reached is stored in the
+    # schema_migration table after every batch, so an interrupted copy resumes where it stopped on the next start.
+    METADATA_TABLE: str = 'schema_migration'
+    COPY_SUFFIX: str = '__migrating'
+    STATUS_COPYING: str = 'copying'
+    STATUS_DONE: str = 'done'
+    STATUS_FAILED: str = 'failed'
+
+    def __init__(self, database: Database, batch_size: int = 5000, pause: float = 0.01,
+                 progress_interval: float = 5.,
+                 on_progress: Optional[Callable[[MigrationProgress], None]] = None):
+        self.database: Database = database
+        self.batch_size: int = batch_size
+        self.pause: float = pause
+        self.progress_interval: float = progress_interval
+        self.on_progress: Optional[Callable[[MigrationProgress], None]] = on_progress
+        self.progress: Optional[MigrationProgress] = None
+        self._stop: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if len(self.database.pending_migrations) == 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='SchemaMigrator', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        # The copy stops after the current batch and resumes on the next start
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self) -> None:
+        connection: sqlite3.Connection = self.database.create_connection()
+        # Transactions are opened explicitly so that each batch takes the write lock only for its own duration
+        connection.isolation_level = None
+        try:
+            self.create_metadata_table(connection)
+            for table in list(self.database.pending_migrations):
+                if self._stop.is_set():
+                    break
+                try:
+                    if self.migrate(connection, table):
+                        self.database.pending_migrations.remove(table)
+                except sqlite3.Error:
+                    logging.exception(f'Migration of table {table.name} failed')
+                    self.abort(connection, table)
+            if len(self.database.pending_migrations) == 0:
+                self.database.store_schema_fingerprint(connection, self.database.get_schema_fingerprint())
+        finally:
+            connection.close()
+
+    def create_metadata_table(self, connection: sqlite3.Connection) -> None:
+        connection.execute(f'CREATE TABLE IF NOT EXISTS [{self.METADATA_TABLE}] ('
+                           f'id_migration INTEGER PRIMARY KEY, table_name TEXT NOT NULL, target_sql TEXT NOT NULL, '
+                           f'status TEXT NOT NULL, last_rowid INTEGER NOT NULL, copied_rows INTEGER NOT NULL, '
+                           f'total_rows INTEGER NOT NULL, started REAL NOT NULL, finished REAL, end_rowid INTEGER);')
+        columns: List[str] = [r[1] for r in connection.execute(f'PRAGMA table_info([{self.METADATA_TABLE}]);')]
+        if 'end_rowid' not in columns:
+            # Metadata tables created before end_rowid; their copies in progress are started again
+            connection.execute(f'ALTER TABLE [{self.METADATA_TABLE}] ADD COLUMN end_rowid INTEGER;')
+
+    def applied_migrations(self, connection: sqlite3.Connection) -> List[Tuple[str, str, float]]:
+        # (table name, create command, finish time) of every completed migration, oldest first
+        self.create_metadata_table(connection)
+        cursor: sqlite3.Cursor = connection.execute(
+            f'SELECT table_name, target_sql, finished FROM [{self.METADATA_TABLE}] WHERE status=? '
+            f'ORDER BY id_migration;', (self.STATUS_DONE,))
+        return cursor.fetchall()
+
+    def migrate(self, connection: sqlite3.Connection, table: Table) -> bool:
+        # True once the table has been swapped, False if stopped before
+        id_migration, last_rowid, end_rowid, copied_rows, total_rows = self.begin(connection, table)
+        self.progress = MigrationProgress(table.name, copied_rows, total_rows)
+        logging.info(f'Migrating table {table.name}: {copied_rows}/{total_rows} rows copied')
+        copy_table: str = table.name + self.COPY_SUFFIX
+        columns: str = ', '.join(f'[{c.name}]' for c in table.columns)
+        last_report: float = time.monotonic()
+        while not self._stop.is_set():
+            connection.execute('BEGIN IMMEDIATE;')
+            try:
+                # Only the rows present when the copy began are read; the triggers copy everything written since
+                batch_end: Optional[int] = connection.execute(
+                    f'SELECT MAX(rowid) FROM (SELECT rowid FROM [{table.name}] WHERE rowid > ? AND rowid <= ? '
+                    f'ORDER BY rowid LIMIT ?);', (last_rowid, end_rowid, self.batch_size)).fetchone()[0]
+                if batch_end is None:
+                    self.swap(connection, table, id_migration)
+                    connection.execute('COMMIT;')
+                    break
+                # Rows already mirrored by the triggers are newer than the ones read here and are kept. Unlike
+                # INSERT OR IGNORE, DO NOTHING still fails on rows that do not fit the new definition.
+                cursor: sqlite3.Cursor = connection.execute(
+                    f'INSERT INTO [{copy_table}] (rowid, {columns}) SELECT rowid, {columns} FROM [{table.name}] '
+                    f'WHERE rowid > ? AND rowid <= ? ON CONFLICT DO NOTHING;', (last_rowid, batch_end))
+                copied_rows += cursor.rowcount
+                last_rowid = batch_end
+                connection.execute(f'UPDATE [{self.METADATA_TABLE}] SET last_rowid=?, copied_rows=? '
+                                   f'WHERE id_migration=?;', (last_rowid, copied_rows, id_migration))
+                connection.execute('COMMIT;')
+            except BaseException:
+                connection.execute('ROLLBACK;')
+                raise
+            self.progress = MigrationProgress(table.name, copied_rows, total_rows)
+            if self.on_progress is not None:
+                self.on_progress(self.progress)
+            if time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                logging.info(f'Migrating table {table.name}: {copied_rows}/{total_rows} rows copied '
+                             f'({self.progress.fraction:.0%})')
+            self._stop.wait(self.pause)
+        else:
+            logging.info(f'Migration of table {table.name} stopped at rowid {last_rowid}')
+            return False
+        # The copy was created without indexes so that batches stay cheap
+        connection.execute('BEGIN IMMEDIATE;')
+        self.database.update_indexes(connection, table)
+        connection.execute('COMMIT;')
+        logging.info(f'Migrated table {table.name}: {copied_rows} rows copied')
+        return True
+
+    def begin(self, connection: sqlite3.Connection, table: Table) -> Tuple[int, int, int, int, int]:
+        # Resumes the copy recorded for the same target definition, or starts a new one. Returns the migration id,
+        # the last rowid copied, the last rowid to copy, and the copied and total row counts.
+        target_sql: str = table.get_create_cmd()
+        copy_table: str = table.name + self.COPY_SUFFIX
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            row: Optional[Tuple] = connection.execute(
+                f'SELECT id_migration, target_sql, last_rowid, end_rowid, copied_rows, total_rows '
+                f'FROM [{self.METADATA_TABLE}] WHERE table_name=? AND status=?;',
+                (table.name, self.STATUS_COPYING)).fetchone()
+            if row is not None and row[1] == target_sql and row[3] is not None and \
+                    self.database.table_exists(connection, copy_table):
+                connection.execute('COMMIT;')
+                return row[0], row[2], row[3], row[4], row[5]
+            if row is not None:
+                connection.execute(f'UPDATE [{self.METADATA_TABLE}] SET status=? WHERE id_migration=?;',
+                                   (self.STATUS_FAILED, row[0]))
+            self.drop_copy(connection, table)
+            connection.execute(table.get_create_cmd(copy_table))
+            self.create_triggers(connection, table)
+            # Rowids can be 0 or negative, like the ids of group chats in [chat]. The copy starts below the lowest
+            # one and ends at the highest one present now, read in the transaction that installs the triggers.
+            min_rowid, max_rowid, total_rows = connection.execute(
+                f'SELECT MIN(rowid), MAX(rowid), COUNT(*) FROM [{table.name}];').fetchone()
+            last_rowid: int = min_rowid - 1 if min_rowid is not None else 0
+            end_rowid: int = max_rowid if max_rowid is not None else 0
+            cursor: sqlite3.Cursor = connection.execute(
+                f'INSERT INTO [{self.METADATA_TABLE}] (table_name, target_sql, status, last_rowid, end_rowid, '
+                f'copied_rows, total_rows, started) VALUES (?, ?, ?, ?, ?, 0, ?, ?);',
+                (table.name, target_sql, self.STATUS_COPYING, last_rowid, end_rowid, total_rows, time.time()))
+            connection.execute('COMMIT;')
+        except BaseException:
+            connection.execute('ROLLBACK;')
+            raise
+        return cursor.lastrowid, last_rowid, end_rowid, 0, total_rows
+
+    def create_triggers(self, connection: sqlite3.Connection, table: Table) -> None:
+        copy_table: str = table.name + self.COPY_SUFFIX
+        columns: str = ', '.join(f'[{c.name}]' for c in table.columns)
+        new_values: str = ', '.join(f'NEW.[{c.name}]' for c in table.columns)
+        # These run inside the bot's own writes, which must not fail because a row does not fit the new definition.
+        # Such a row is left out of the copy instead, and swap gives up on the migration when rows are missing.
+        insert: str = f'INSERT OR IGNORE INTO [{copy_table}] (rowid, {columns}) VALUES (NEW.rowid, {new_values});'
+        connection.execute(f'CREATE TRIGGER [{table.name}__migrate_insert] AFTER INSERT ON [{table.name}] BEGIN '
+                           f'DELETE FROM [{copy_table}] WHERE rowid=NEW.rowid; {insert} END;')
+        connection.execute(f'CREATE TRIGGER [{table.name}__migrate_update] AFTER UPDATE ON [{table.name}] BEGIN '
+                           f'DELETE FROM [{copy_table}] WHERE rowid=OLD.rowid OR rowid=NEW.rowid; {insert} END;')
+        connection.execute(f'CREATE TRIGGER [{table.name}__migrate_delete] AFTER DELETE ON [{table.name}] BEGIN '
+                           f'DELETE FROM [{copy_table}] WHERE rowid=OLD.rowid; END;')
+
+    def drop_triggers(self, connection: sqlite3.Connection, table: Table) -> None:
+        for action in ('insert', 'update', 'delete'):
+            connection.execute(f'DROP TRIGGER IF EXISTS [{table.name}__migrate_{action}];')
+
+    def drop_copy(self, connection: sqlite3.Connection, table: Table) -> None:
+        self.drop_triggers(connection, table)
+        connection.execute(f'DROP TABLE IF EXISTS [{table.name + self.COPY_SUFFIX}];')
+
+    def swap(self, connection: sqlite3.Connection, table: Table, id_migration: int) -> None:
+        # The current table is dropped before the rename: renaming it away would make SQLite rewrite the foreign
+        # keys of the tables that reference it
+        copy_table: str = table.name + self.COPY_SUFFIX
+        # Every row of the copy comes from a current row, so equal counts mean that none was left out
+        missing: int = connection.execute(f'SELECT (SELECT COUNT(*) FROM [{table.name}]) - '
+                                          f'(SELECT COUNT(*) FROM [{copy_table}]);').fetchone()[0]
+        if missing != 0:
+            rowids: List[int] = [r[0] for r in connection.execute(
+                f'SELECT rowid FROM [{table.name}] WHERE rowid NOT IN (SELECT rowid FROM [{copy_table}]) '
+                f'ORDER BY rowid LIMIT 10;')]
+            raise sqlite3.IntegrityError(f'{missing} row(s) of table {table.name} were not copied, rowids '
+                                         f'{", ".join(str(r) for r in rowids)}{", ..." if missing > 10 else ""}')
+        self.drop_triggers(connection, table)
+        connection.execute(f'DROP TABLE [{table.name}];')
+        connection.execute(f'ALTER TABLE [{copy_table}] RENAME TO [{table.name}];')
+        connection.execute(f'UPDATE [{self.METADATA_TABLE}] SET status=?, finished=? WHERE id_migration=?;',
+                           (self.STATUS_DONE, time.time(), id_migration))
+
+    def abort(self, connection: sqlite3.Connection, table: Table) -> None:
+        # Leaves the current table as it is; the migration is attempted again on the next start
+        if connection.in_transaction:
+            connection.execute('ROLLBACK;')
+        connection.execute('BEGIN IMMEDIATE;')
+        self.drop_copy(connection, table)
+        connection.execute(f'UPDATE [{self.METADATA_TABLE}] SET status=? WHERE table_name=? AND status=?;',
+                           (self.STATUS_FAILED, table.name, self.STATUS_COPYING))
+        connection.execute('COMMIT;')
@@ -0,0 +1,83 @@
+import json
+from typing import Any, Callable, Dict, Optional
+
+TYPE_KEY: str = '$t'
+VERSION_KEY: str = '$v'
+VALUE_KEY: str = '$o'
+
+
+class StateType(object):
+    def __init__(self, name: str, obj_type: type, version: int, to_state: Callable[[Any], Dict],
+                 from_state: Callable[[Dict], Any]):
+        self.name: str = name
+        self.obj_type: type = obj_type
+        self.version: int = version
+        self.to_state: Callable[[Any], Dict] = to_state
+        self.from_state: Callable[[Dict], Any] = from_state
+        self.migrations: Dict[int, Callable[[Dict], Dict]] = {}
+
+
+class StateCodec(object):
+    # Encodes ChatState.data as compact JSON. Besides JSON values (dicts, lists, str, int, float, bool, None) only
+    # registered types are accepted; each is written with its name and version. As with any JSON, tuples come back as
+    # lists and dict keys as strings. When a registered class changes, bump its version and add a migration from the
+    # previous one: old states are upgraded when decoded.
+    VERSION: int = 1
+
+    def __init__(self):
+        self.types_by_name: Dict[str, StateType] = {}
+        self.types_by_class: Dict[type, StateType] = {}
+        self._encoder: json.JSONEncoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                                                           default=self._encode_object)
+
+    def register(self, name: str, obj_type: type, version: int = 1, to_state: Optional[Callable[[Any], Dict]] = None,
+                 from_state: Optional[Callable[[Dict], Any]] = None) -> None:
+        # Without explicit functions the instance attributes are stored, and restored over a default-constructed
+        # instance so attributes added later keep their defaults
+        if name in self.types_by_name:
+            raise ValueError(f'State type {name} already registered.')
+        state_type: StateType = StateType(name, obj_type, version,
+                                          to_state or (lambda obj: dict(vars(obj))),
+                                          from_state or (lambda value: StateCodec.restore_attributes(obj_type, value)))
+        self.types_by_name[name] = state_type
+        self.types_by_class[obj_type] = state_type
+
+    def add_migration(self, name: str, from_version: int, migrate: Callable[[Dict], Dict]) -> None:
+        self.types_by_name[name].migrations[from_version] = migrate
+
+    def encode(self, data: Dict) -> bytes:
+        return self._encoder.encode({'v': StateCodec.VERSION, 'd': data}).encode('utf8')
+
+    def decode(self, payload: bytes) -> Dict:
+        envelope: Dict = json.loads(payload.decode('utf8'), object_hook=self._decode_object)
+        if envelope.get('v') != StateCodec.VERSION:
+            raise ValueError(f'Unsupported chat state version {envelope.get("v")}')
+        return envelope['d']
+
+    def _encode_object(self, value: Any) -> Dict:
+        # Called by the JSON encoder for anything that is not a JSON value
+        state_type: Optional[StateType] = self.types_by_class.get(type(value))
+        if state_type is None:
+            raise ValueError(f'Type {type(value).__name__} is not registered in the state codec')
+        return {TYPE_KEY: state_type.name, VERSION_KEY: state_type.version, VALUE_KEY: state_type.to_state(value)}
+
+    def _decode_object(self, obj: Dict) -> Any:
+        if TYPE_KEY not in obj:
+            return obj
+        state_type: Optional[StateType] = self.types_by_name.get(obj[TYPE_KEY])
+        if state_type is None:
+            raise ValueError(f'State type {obj[TYPE_KEY]} is not registered in the state codec')
+        version: int = obj[VERSION_KEY]
+        value: Dict = obj[VALUE_KEY]
+        while version < state_type.version:
+            if version not in state_type.migrations:
+                raise ValueError(f'No migration for state type {state_type.name} from version {version}')
+            value = state_type.migrations[version](value)
+            version += 1
+        return state_type.from_state(value)
+
+    @staticmethod
+    def restore_attributes(obj_type: type, value: Dict) -> Any:
+        res = obj_type()
+        res.__dict__.update(value)
+        return res
@@ -0,0 +1,144 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from db.database import Database, DataSet
+
+_STOP: object = object()
+
+
+class WriteBehindWriter(object):
+    # Data sets are saved in submission order by a single thread. Everything collected within max_delay (up to
+    # batch_size data sets) goes into one transaction, so a burst of updates costs one commit. A failed batch is
+    # retried with a growing delay, then written one data set per transaction so that a bad one is the only loss.
+
+    def __init__(self, database: Database, queue_size: int = 1000, batch_size: int = 100, max_delay: float = 0.05,
+                 retries: int = 3, retry_delay: float = 0.1, on_written: Optional[Callable[[DataSet], None]] = None):
+        self.database: Database = database
+        # Called with every data set once its transaction has committed
+        self.on_written: Optional[Callable[[DataSet], None]] = on_written
+        self.batch_size: int = batch_size
+        self.max_delay: float = max_delay
+        self.retries: int = retries
+        self.retry_delay: float = retry_delay
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._pending_since: Deque[float] = collections.deque()
+        self._lock: threading.Lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.batches_committed: int = 0
+        self.batches_failed: int = 0
+        self.data_sets_dropped: int = 0
+        self.data_sets_written: int = 0
+        self.rows_written: int = 0
+        self.last_commit_seconds: float = 0.
+        self.last_lag_seconds: float = 0.
+        self.max_lag_seconds: float = 0.
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._write_loop, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # Everything submitted before stop is committed before this returns
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, data_set: DataSet, on_done: Optional[Callable[[], None]] = None) -> None:
+        # Blocks while the queue is full, which slows the producer down instead of growing memory. on_done is called
+        # from the writer thread once the data set has been committed or given up.
+        now: float = time.time()
+        with self._lock:
+            self._pending_since.append(now)
+        self._queue.put((now, data_set, on_done))
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def lag(self) -> float:
+        with self._lock:
+            return time.time() - self._pending_since[0] if self._pending_since else 0.
+
+    def metrics(self) -> Dict[str, float]:
+        return {'queued': self._queue.qsize(),
+                'lag_seconds': self.lag(),
+                'last_lag_seconds': self.last_lag_seconds,
+                'max_lag_seconds': self.max_lag_seconds,
+                'last_commit_seconds': self.last_commit_seconds,
+                'batches_committed': self.batches_committed,
+                'batches_failed': self.batches_failed,
+                'data_sets_dropped': self.data_sets_dropped,
+                'data_sets_written': self.data_sets_written,
+                'rows_written': self.rows_written}
+
+    def _write_loop(self) -> None:
+        stopping: bool = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            batch: List[Tuple[float, DataSet, Optional[Callable[[], None]]]] = [item]
+            deadline: float = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch: List[Tuple[float, DataSet, Optional[Callable[[], None]]]]) -> None:
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self._commit(batch)
+                    return
+                except Exception as e:
+                    self.batches_failed += 1
+                    logging.warning(f'Could not write {len(batch)} data set(s), attempt {attempt + 1}: {e}')
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            # Saved one by one, so only the data sets that cannot be written at all are lost
+            for item in batch:
+                try:
+                    self._commit([item])
+                except Exception as e:
+                    self.data_sets_dropped += 1
+                    logging.error(f'Dropping a data set that could not be written: {e}')
+        finally:
+            with self._lock:
+                for _ in batch:
+                    self._pending_since.popleft()
+            for _, _, on_done in batch:
+                if on_done is not None:
+                    on_done()
+
+    def _commit(self, batch: List[Tuple[float, DataSet, Optional[Callable[[], None]]]]) -> None:
+        start: float = time.time()
+        with self.database.transaction() as connection:
+            for _, data_set, _ in batch:
+                self.database.save_data_set(connection, data_set)
+        if self.on_written is not None:
+            for _, data_set, _ in batch:
+                try:
+                    self.on_written(data_set)
+                except Exception as e:
+                    logging.exception(e)
+        end: float = time.time()
+        self.batches_committed += 1
+        self.data_sets_written += len(batch)
+        self.rows_written += sum(len(t.rows) for _, ds, _ in batch for t in ds.tables.values())
+        self.last_commit_seconds = end - start
+        self.last_lag_seconds = end - batch[0][0]
+        self.max_lag_seconds = max(self.max_lag_seconds, self.last_lag_seconds)
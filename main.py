@@ -8,7 +8,9 @@ import data
 from bot.bot import Bot
 from data import BotConfig
 from db.database import Database
+from db.migration import SchemaMigrator
 from objectprovider import ObjectProvider
+from utils import PhaseTimer
 
 if __name__ == '__main__':
 
@@ -19,16 +21,35 @@ if __name__ == '__main__':
 
     parser: ArgumentParser = argparse.ArgumentParser()
     parser.add_argument('--no-ssl-cert', action='store_true')
+    parser.add_argument('--asyncio', action='store_true')
+    parser.add_argument('--webhook', action='store_true')
+    parser.add_argument('--verbose-startup', action='store_true', help='log how long each startup phase takes')
     args: Namespace = parser.parse_args()
 
     if args.no_ssl_cert:
         ssl._create_default_https_context = ssl._create_unverified_context
 
+    startup: PhaseTimer = PhaseTimer(args.verbose_startup)
     bot_config: BotConfig = data.BotConfig.load_from_json_file('bot_config.json')
-    database: Database = Database.load_from_json_file(bot_config.database_definition_file)
-    database.create_tables()
-    object_provider: ObjectProvider = ObjectProvider.load_from_json_file('op_definition.json')
+    with startup.phase('Database.load_from_json_file'):
+        database: Database = Database.load_from_json_file(bot_config.database_definition_file)
+    with startup.phase('Database.create_tables'):
+        database.create_tables()
+    # Changed tables are copied in the background while the bot already serves updates
+    migrator: SchemaMigrator = SchemaMigrator(database)
+    migrator.start()
+    with startup.phase('ObjectProvider.load_from_json_file'):
+        object_provider: ObjectProvider = ObjectProvider.load_from_json_file('op_definition.json')
 
     pancho_bot: Bot = Bot(bot_config, object_provider, database)
-    pancho_bot.initialize()
-    pancho_bot.run()
+    pancho_bot.initialize(startup)
+    startup.report('Startup')
+    try:
+        if args.webhook:
+            pancho_bot.run_webhook()
+        elif args.asyncio:
+            pancho_bot.run_async()
+        else:
+            pancho_bot.run()
+    finally:
+        migrator.stop()
@@ -1,9 +1,11 @@
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Optional, Callable, Iterable
 from typing import List
 
+import collections
 import sqlite3
 import importlib
-import utils
+import keyword
+import threading
 from db.database import DataRow, DataTable, DataSet
 from db.database import Database, DataSet
 from jsonutils import JsonDeserializable
@@ -28,7 +30,7 @@ class PropertySource(JsonDeserializable):
         res.src_column = json_object['src_column']
         # res.referenced_table = json_object.get('referenced_table')
         # res.referenced_column = json_object.get('referenced_column')
-        res.object_name = json_object.get('object_name')
+        res.object_name = json_object.get('object_name', json_object.get('object_type'))
         return res
 
 
@@ -49,21 +51,243 @@ class ObjectDefinition(JsonDeserializable):
         return res
 
 
+class ObjectMapper(object):
+    # An ObjectDefinition compiled for reading: the SELECT, the position of every column in the row tuples and a
+    # function generated from the property assignments that builds an object from a row tuple. The class is imported
+    # on first use, so definitions can be loaded before their modules.
+
+    def __init__(self, definition: ObjectDefinition):
+        self.definition: ObjectDefinition = definition
+        column_names: List[str] = [definition.object_id]
+        for property_source in definition.property_sources:
+            if property_source.src_column not in column_names:
+                column_names.append(property_source.src_column)
+        self.column_names: Tuple[str, ...] = tuple(column_names)
+        self.column_index: Dict[str, int] = {n: i for i, n in enumerate(self.column_names)}
+        self.properties: Tuple[Tuple[str, int], ...] = tuple(
+            (s.name, self.column_index[s.src_column]) for s in definition.property_sources if s.type_ == 'property')
+        # (attribute, column index, object name) of the object and list properties
+        self.objects: Tuple[Tuple[str, int, str], ...] = tuple(
+            (s.name, self.column_index[s.src_column], s.object_name)
+            for s in definition.property_sources if s.type_ == 'object')
+        self.lists: Tuple[Tuple[str, int, str], ...] = tuple(
+            (s.name, self.column_index[s.src_column], s.object_name)
+            for s in definition.property_sources if s.type_ == 'list')
+        self._selects: Dict[Optional[str], Tuple[str, int]] = {}
+        self._build: Optional[Callable[[Tuple], object]] = None
+
+    def get_select(self, key_column: Optional[str] = None) -> Tuple[str, int]:
+        # SELECT of the mapped columns, plus key_column at the end when it is not mapped, and the index of key_column
+        res: Optional[Tuple[str, int]] = self._selects.get(key_column)
+        if res is None:
+            columns: List[str] = list(self.column_names)
+            key_index: int = -1
+            if key_column is not None:
+                if key_column not in self.column_index:
+                    columns.append(key_column)
+                key_index = columns.index(key_column)
+            res = (f'SELECT {", ".join(columns)} FROM [{self.definition.table_name}]', key_index)
+            self._selects[key_column] = res
+        return res
+
+    @property
+    def build(self) -> Callable[[Tuple], object]:
+        if self._build is None:
+            self._build = self._compile_build()
+        return self._build
+
+    def _compile_build(self) -> Callable[[Tuple], object]:
+        module, _, name = self.definition.object_name.rpartition('.')
+        object_type: type = getattr(importlib.import_module(module), name)
+        if all(n.isidentifier() and not keyword.iskeyword(n) for n, _ in self.properties):
+            lines: List[str] = ['def build(values):', '    obj = object_type()']
+            lines += [f'    obj.{n} = values[{i}]' for n, i in self.properties]
+            lines.append('    return obj')
+            namespace: Dict[str, Any] = {'object_type': object_type}
+            exec('\n'.join(lines), namespace)
+            return namespace['build']
+        properties: Tuple[Tuple[str, int], ...] = self.properties
+
+        def build_with_setattr(values: Tuple) -> object:
+            obj = object_type()
+            for attribute, index in properties:
+                setattr(obj, attribute, values[index])
+            return obj
+        return build_with_setattr
+
+
+class ObjectCache(object):
+    # Objects kept between sessions with the row values they were built from, least recently used first, keyed by
+    # (object name, object id). A max_size of 0 disables it. A cached object is only reused for a row fetched with the
+    # same values, so a row changed by any writer is built again.
+
+    def __init__(self, max_size: int = 0):
+        self.max_size: int = max_size
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stale: int = 0
+
+    def get(self, key: Tuple[str, object], values: Tuple) -> Optional[object]:
+        # The object cached for key if it was built from these row values
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry: Optional[Tuple[Tuple, object]] = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != values:
+                self.stale += 1
+                del self._entries[key]
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Tuple[str, object], obj: object, values: Tuple) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (values, obj)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, object_name: str, object_ids: Optional[Iterable[object]] = None) -> None:
+        # Every object of the type when object_ids is None
+        with self._lock:
+            if object_ids is None:
+                for key in [k for k in self._entries if k[0] == object_name]:
+                    del self._entries[key]
+            else:
+                for object_id in object_ids:
+                    self._entries.pop((object_name, object_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'cached_objects': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'stale': self.stale}
+
+
+class ObjectSession(object):
+    # Identity map: objects loaded through a session are built once per (object name, object id) and shared by every
+    # query and relationship of the session. Rows fetched for objects missing from the session reuse the provider's
+    # cached object when its values are unchanged. A session is used by one thread.
+
+    def __init__(self, provider: 'ObjectProvider', database: Database,
+                 connection: Optional[sqlite3.Connection] = None):
+        self.provider: ObjectProvider = provider
+        self.database: Database = database
+        self.connection: sqlite3.Connection = connection or database.connection()
+        self.identity_map: Dict[Tuple[str, object], object] = {}
+
+    def query_objects(self, object_name: str, where_clause: Optional[str] = None,
+                      query_params: Optional[Tuple] = None) -> List[Any]:
+        return [obj for _, obj in self.provider._load_objects(self.database, self.connection, object_name,
+                                                              where_clause, query_params, session=self)]
+
+    def get(self, object_name: str, object_id: object) -> Optional[Any]:
+        # A dictionary hit once the object has been loaded in this session
+        res: Optional[object] = self.identity_map.get((object_name, object_id))
+        if res is None:
+            object_id_column: str = self.provider.get_mapper(object_name).definition.object_id
+            objects: List[Any] = self.query_objects(object_name, object_id_column + '=?', (object_id,))
+            res = objects[0] if objects else None
+        return res
+
+    def lookup(self, key: Tuple[str, object], values: Tuple) -> Optional[object]:
+        # The object of the session, or the cached one built from the same row values
+        res: Optional[object] = self.identity_map.get(key)
+        if res is None:
+            res = self.provider.cache.get(key, values)
+            if res is not None:
+                self.identity_map[key] = res
+        return res
+
+    def add(self, key: Tuple[str, object], obj: object, values: Tuple) -> None:
+        self.identity_map[key] = obj
+        self.provider.cache.put(key, obj, values)
+
+    def evict(self, object_name: str, object_id: object) -> None:
+        self.identity_map.pop((object_name, object_id), None)
+
+
 class ObjectProvider(JsonDeserializable):
+    # Keys per IN (...) query when loading relationships, below the SQLite limit of bound parameters
+    MAX_KEYS_PER_QUERY: int = 500
+
     def __init__(self):
         self.object_definitions: List[ObjectDefinition] = []
+        self.definitions_by_name: Dict[str, ObjectDefinition] = {}
+        self.mappers: Dict[str, ObjectMapper] = {}
+        self.object_names_by_table: Dict[str, List[str]] = {}
+        # Names of the definitions with an object or list property of each type
+        self.referencing_names: Dict[str, List[str]] = {}
+        self.cache: ObjectCache = ObjectCache()
 
     @classmethod
     def from_json(cls, json_object: Dict) -> 'ObjectProvider':
         res: ObjectProvider = ObjectProvider()
         res.object_definitions = [ObjectDefinition.from_json(j) for j in json_object['object_definitions']]
+        res.cache = ObjectCache(json_object.get('cache_size', 0))
+        res.compile_definitions()
         return res
 
+    def compile_definitions(self) -> None:
+        self.definitions_by_name = {d.object_name: d for d in self.object_definitions}
+        self.mappers = {d.object_name: ObjectMapper(d) for d in self.object_definitions}
+        self.object_names_by_table = {}
+        self.referencing_names = {}
+        for definition in self.object_definitions:
+            self.object_names_by_table.setdefault(definition.table_name, []).append(definition.object_name)
+            for property_source in definition.property_sources:
+                if property_source.type_ in ('object', 'list'):
+                    self.referencing_names.setdefault(property_source.object_name, []).append(definition.object_name)
+
+    def session(self, database: Database, connection: Optional[sqlite3.Connection] = None) -> ObjectSession:
+        return ObjectSession(self, database, connection)
+
+    def invalidate(self, object_name: str, object_ids: Optional[Iterable[object]] = None) -> None:
+        # Cached objects that reference an invalidated one, directly or not, are dropped too whatever their id
+        self.cache.invalidate(object_name, object_ids)
+        invalidated: set = {object_name}
+        pending: List[str] = list(self.referencing_names.get(object_name, []))
+        while pending:
+            referencing_name: str = pending.pop()
+            if referencing_name not in invalidated:
+                invalidated.add(referencing_name)
+                self.cache.invalidate(referencing_name)
+                pending.extend(self.referencing_names.get(referencing_name, []))
+
+    def invalidate_data_set(self, data_set: DataSet) -> None:
+        # Called once the data set is committed. Objects referencing the written ones, whose own rows are unchanged,
+        # are only refreshed through this.
+        if len(self.cache) == 0:
+            return
+        for table_name, data_table in data_set.tables.items():
+            for object_name in self.object_names_by_table.get(table_name, []):
+                self.invalidate(object_name, list(data_table.rows.keys()))
+
     def get_object_definition(self, object_name: str) -> ObjectDefinition:
-        # object_name = object_type.__module__ + '.' + object_type.__name__  # type: str
-        object_definition: ObjectDefinition = utils.first_or_default_where(self.object_definitions,
-                                                                           lambda d: d.object_name == object_name)
-        return object_definition
+        if object_name not in self.definitions_by_name:
+            self.compile_definitions()
+        return self.definitions_by_name.get(object_name)
+
+    def get_mapper(self, object_name: str) -> ObjectMapper:
+        mapper: Optional[ObjectMapper] = self.mappers.get(object_name)
+        if mapper is None:
+            self.compile_definitions()
+            mapper = self.mappers.get(object_name)
+            if mapper is None:
+                raise ValueError('Object definition for type {t} is not defined'.format(t=object_name))
+        return mapper
 
     def _query_object(self, database: Database, connection: sqlite3.Connection, object_name: str,
                       id_object: object) -> object:
@@ -92,54 +316,87 @@ class ObjectProvider(JsonDeserializable):
         return object_instance
 
     def query_objects(self, database: Database, object_name: str, where_clause: str or None, query_params: Tuple or None) -> List[Any]:
-        res = []
-        with database.create_connection() as connection:
-            res = self._query_objects(database, connection, object_name, where_clause, query_params)
-        return res
+        return self._query_objects(database, database.connection(), object_name, where_clause, query_params)
 
     def _query_objects(self, database: Database, connection: sqlite3.Connection, object_name: str, where_clause: str,
                        query_params: Tuple) -> List[object]:
-        object_definition: ObjectDefinition = self.get_object_definition(object_name)
-        if object_definition is None:
-            raise ValueError('Object definition for type {t} is not defined'.format(t=object_name))
-        name_data = object_name.split('.')
-        module = '.'.join(name_data[:-1])
-        name = name_data[-1]
+        return [obj for _, obj in self._load_objects(database, connection, object_name, where_clause, query_params)]
 
-        column_list = [s.src_column for s in object_definition.property_sources if s.type_ in ('property', 'object')]
-        ds: DataSet = database.raw_query(connection,
-                                         object_definition.table_name,
-                                         column_list,
-                                         where_clause,
-                                         query_params)
-        dt: DataTable = ds.tables[object_definition.table_name]
+    def _load_objects(self, database: Database, connection: sqlite3.Connection, object_name: str, where_clause: str,
+                      query_params: Tuple, key_column: Optional[str] = None,
+                      session: Optional[ObjectSession] = None) -> List[Tuple[Tuple, object]]:
+        # Objects with the row tuples they were built from. Each object and list property is loaded for all the rows
+        # at once with IN (...) queries instead of one query per row. With a session, objects it already holds are
+        # returned as they are and only the new ones get their relationships loaded.
+        mapper: ObjectMapper = self.get_mapper(object_name)
+        sql: str = mapper.get_select(key_column)[0]
+        if where_clause is not None:
+            sql += ' WHERE ' + where_clause
+        cursor: sqlite3.Cursor = connection.execute(sql, query_params or ())
+        build: Callable[[Tuple], object] = mapper.build
+        column_count: int = len(mapper.column_names)
+        res: List[Tuple[Tuple, object]]
+        new: List[Tuple[Tuple, object]]
+        if session is None:
+            res = [(values, build(values)) for values in cursor.fetchall()]
+            new = res
+        else:
+            res = []
+            new = []
+            for values in cursor.fetchall():
+                # The object_id is the first column of every mapper
+                key: Tuple[str, object] = (object_name, values[0])
+                # Without the key column that get_select may append
+                object_values: Tuple = values[:column_count]
+                object_instance: Optional[object] = session.lookup(key, object_values)
+                if object_instance is None:
+                    object_instance = build(values)
+                    session.add(key, object_instance, object_values)
+                    new.append((values, object_instance))
+                res.append((values, object_instance))
+        if not new:
+            return res
+
+        for attribute, index, child_name in mapper.objects:
+            # The column holds the object_id of the referenced object
+            children: Dict[object, List[object]] = {}
+            keys: List[object] = [values[index] for values, _ in new]
+            if session is not None:
+                # Children already in the session need no query; cached ones are checked against their row
+                missing: List[object] = []
+                for child_id in dict.fromkeys(k for k in keys if k is not None):
+                    child: Optional[object] = session.identity_map.get((child_name, child_id))
+                    if child is None:
+                        missing.append(child_id)
+                    else:
+                        children[child_id] = [child]
+                keys = missing
+            children.update(self._load_objects_by_key(database, connection, child_name,
+                                                      self.get_mapper(child_name).definition.object_id, keys, session))
+            for values, object_instance in new:
+                child_objects: Optional[List[object]] = children.get(values[index])
+                if child_objects:
+                    setattr(object_instance, attribute, child_objects[0])
+        for attribute, index, child_name in mapper.lists:
+            # Children whose column of the same name holds the value of this row
+            children = self._load_objects_by_key(database, connection, child_name, mapper.column_names[index],
+                                                 [values[index] for values, _ in new], session)
+            for values, object_instance in new:
+                setattr(object_instance, attribute, children.get(values[index], []))
+        return res
 
-        res: List[object] = []
-        row: DataRow
-        for row in dt.rows.values():
-            object_instance = getattr(importlib.import_module(module), name)()
-            for property_source in object_definition.property_sources:
-                if property_source.type_ == 'property':
-                    setattr(object_instance, property_source.name, row.items.get(property_source.src_column))
-                elif property_source.type_ == 'object':
-                    child_object_id = row.get(property_source.src_column)
-                    if child_object_id is not None:
-                        child_object_where_clause = property_source.src_column + '=?'
-                        child_object = self._query_objects(database,
-                                                           connection,
-                                                           property_source.object_name,
-                                                           child_object_where_clause,
-                                                           (row.get(property_source.src_column),))[0]
-                        setattr(object_instance, property_source.name, child_object)
-                elif property_source.type_ == 'list':
-                    child_object_where_clause = property_source.src_column + '=?'
-                    child_objects = self._query_objects(database,
-                                                        connection,
-                                                        property_source.object_name,
-                                                        child_object_where_clause,
-                                                        (row.get(property_source.src_column),))
-                    setattr(object_instance, property_source.name, child_objects)
-            res.append(object_instance)
+    def _load_objects_by_key(self, database: Database, connection: sqlite3.Connection, object_name: str,
+                             key_column: str, keys: List[object],
+                             session: Optional[ObjectSession] = None) -> Dict[object, List[object]]:
+        res: Dict[object, List[object]] = {}
+        key_index: int = self.get_mapper(object_name).get_select(key_column)[1]
+        unique_keys: List[object] = list(dict.fromkeys(k for k in keys if k is not None))
+        for start in range(0, len(unique_keys), self.MAX_KEYS_PER_QUERY):
+            chunk: List[object] = unique_keys[start:start + self.MAX_KEYS_PER_QUERY]
+            where_clause: str = '{c} IN ({p})'.format(c=key_column, p=', '.join('?' for _ in chunk))
+            for values, object_instance in self._load_objects(database, connection, object_name, where_clause,
+                                                              tuple(chunk), key_column, session):
+                res.setdefault(values[key_index], []).append(object_instance)
         return res
 
     def _object_to_dataset(self, database: Database, connection: sqlite3.Connection, obj: object) -> DataSet:
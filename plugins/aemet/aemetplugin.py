@@ -48,7 +48,7 @@ class AemetMessageHandler(MessageHandlerBase):
 
 class AemetPlugin(Plugin):
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('aemet', AemetMessageHandler)
+        bot.add_message_handler('aemet', AemetMessageHandler, ['tiempo'])
         token: str = utils.get_file_json('plugins/aemet/tokens.json')['aemet']
         bot.tokens['aemet'] = token
 
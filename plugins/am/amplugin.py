@@ -45,4 +45,4 @@ class AmPlugin(Plugin):
         return 'am'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('am', AmMessageHandler)
+        bot.add_message_handler('am', AmMessageHandler, ['chp'])
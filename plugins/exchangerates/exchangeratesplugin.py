@@ -5,4 +5,4 @@ from plugins.exchangerates.exchangerates import ExchangeRatesMessageHandler
 
 class ExchangeRatesPlugin(Plugin):
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('exchangerates', ExchangeRatesMessageHandler)
+        bot.add_message_handler('exchangerates', ExchangeRatesMessageHandler, ['exchange'])
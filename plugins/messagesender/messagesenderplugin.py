@@ -8,4 +8,4 @@ class MessageSenderPlugin(Plugin):
         return 'messagesender'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('messagesender', MesageSenderMessageHandler)
\ No newline at end of file
+        bot.add_message_handler('messagesender', MesageSenderMessageHandler, ['msg'])
\ No newline at end of file
@@ -8,4 +8,4 @@ class NewtonCalcPlugin(Plugin):
         return 'newtoncalc'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('newtoncalc', NewtonCalcMessageHandler)
\ No newline at end of file
+        bot.add_message_handler('newtoncalc', NewtonCalcMessageHandler, ['newton'])
\ No newline at end of file
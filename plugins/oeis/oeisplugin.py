@@ -8,4 +8,4 @@ class OeisPlugin(Plugin):
         return 'oeis'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('oeis', OeisMessageHandler)
\ No newline at end of file
+        bot.add_message_handler('oeis', OeisMessageHandler, ['oeis'])
\ No newline at end of file
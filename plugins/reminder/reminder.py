@@ -21,6 +21,10 @@ class RemindData(object):
 
 
 class ReminderMessageHandler(MessageHandlerBase):
+    def __init__(self):
+        super().__init__()
+        self.word_parser: WordParser = WordParser.from_str('cmd:w interval:t msg:*w')
+
     @staticmethod
     def get_help() -> TextFormatter:
         res: TextFormatter = TextFormatter()
@@ -31,8 +35,7 @@ class ReminderMessageHandler(MessageHandlerBase):
         return res
 
     def process_message(self, message: Message, bot: BotBase, chat_state: ChatState = None) -> None:
-        wp: WordParser = WordParser.from_str('cmd:w interval:t msg:*w')
-        parse_res: MatchResult = wp.match(message.text)
+        parse_res: MatchResult = self.word_parser.match(message.text)
         if parse_res.success:
             if parse_res.results['cmd'].lower() == 'remind':
                 s: scheduler = sched.scheduler(time.time, time.sleep)
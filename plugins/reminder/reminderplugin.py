@@ -8,4 +8,4 @@ class ReminderPlugin(Plugin):
         return 'reminder'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('reminder', ReminderMessageHandler)
\ No newline at end of file
+        bot.add_message_handler('reminder', ReminderMessageHandler, ['remind', 'testremind'], 'cmd:w interval:t msg:*w')
\ No newline at end of file
@@ -8,4 +8,4 @@ class TerminalPlugin(Plugin):
         return 'poweroff'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('terminal', PowerOff)
+        bot.add_message_handler('terminal', PowerOff, ['cmd'])
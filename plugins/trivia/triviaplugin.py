@@ -1,6 +1,6 @@
 from bot.base import BotBase
 from bot.plugins import Plugin
-from plugins.trivia.trivia import TriviaMessageHandler
+from plugins.trivia.trivia import TriviaMessageHandler, TriviaQuestion, AnswerArrangement
 
 
 class TriviaPlugin(Plugin):
@@ -8,4 +8,6 @@ class TriviaPlugin(Plugin):
         return 'trivia'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('trivia', TriviaMessageHandler)
+        bot.state_codec.register('trivia.question', TriviaQuestion)
+        bot.state_codec.register('trivia.answers', AnswerArrangement)
+        bot.add_message_handler('trivia', TriviaMessageHandler, ['trivia'])
@@ -137,6 +137,11 @@ class Estimation(JsonDeserializable):
 
 
 class TuaMessageHandler(MessageHandlerBase):
+    def __init__(self):
+        super().__init__()
+        self.word_parser: WordParser = WordParser.from_str('cmd:w action:w')
+        self.tua_lines: TuaLines or None = None
+
     @staticmethod
     def get_help() -> TextFormatter:
         res: TextFormatter = TextFormatter()
@@ -147,8 +152,7 @@ class TuaMessageHandler(MessageHandlerBase):
 
     def process_message(self, message: Message, bot: BotBase, chat_state: ChatState = None) -> None:
         if chat_state is None:
-            word_parser: WordParser = WordParser.from_str('cmd:w action:w')
-            res: MatchResult = word_parser.match(message.text)
+            res: MatchResult = self.word_parser.match(message.text)
             if res.success:
                 if res.results['cmd'].lower() == 'tua':
                     if res.results['action'].lower() == 'update':
@@ -172,6 +176,13 @@ class TuaMessageHandler(MessageHandlerBase):
             lines_json['lines'].append(self.retrieve_line(line).to_json())
         with open('dat/app/tua/lines.json', 'w') as fobj:
             json.dump(lines_json, fobj, indent=4)
+        self.tua_lines = TuaLines.from_json(lines_json)
+
+    def get_lines(self) -> TuaLines:
+        # Concurrent first calls may both load the file; either result is valid
+        if self.tua_lines is None:
+            self.tua_lines = TuaLines.load_from_json_file('dat/app/tua/lines.json')
+        return self.tua_lines
 
     def retrieve_line(self, name: str) -> Line:
         res: Line = Line()
@@ -214,7 +225,7 @@ class TuaMessageHandler(MessageHandlerBase):
         return res
 
     def show_lines(self, message: Message, bot: BotBase) -> None:
-        tua_lines = TuaLines.load_from_json_file('dat/app/tua/lines.json')  # type: TuaLines
+        tua_lines = self.get_lines()  # type: TuaLines
         fmt = TextFormatter()
         for line in tua_lines.lines:
             fmt.bold(line.sub_line_forth.id_sub_line + ': ').normal(line.sub_line_forth.name + '\n')
@@ -223,7 +234,7 @@ class TuaMessageHandler(MessageHandlerBase):
         bot.send_message(message.chat, fmt, MessageStyle.MARKDOWN)
 
     def show_line(self, message: Message, bot: BotBase, line_name: str) -> None:
-        tua_lines = TuaLines.load_from_json_file('dat/app/tua/lines.json')  # type: TuaLines
+        tua_lines = self.get_lines()  # type: TuaLines
         sub_line = tua_lines.get_sub_line(line_name.upper())  # type: SubLine
         if sub_line is not None:
             keyboard = InlineKeyboardMarkup()  # type: InlineKeyboardMarkup
@@ -8,4 +8,4 @@ class TuaPlugin(Plugin):
         return 'tua'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('tua', TuaMessageHandler)
+        bot.add_message_handler('tua', TuaMessageHandler, ['tua'], 'cmd:w action:w')
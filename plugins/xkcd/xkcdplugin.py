@@ -14,7 +14,7 @@ class XkcdPlugin(Plugin):
         return 'xkcd'
 
     def on_load(self, bot: BotBase) -> None:
-        bot.add_message_handler('xkcd', XkcdMessageHandler)
+        bot.add_message_handler('xkcd', XkcdMessageHandler, ['xkcd'])
 
 
 class XkcdMessageHandler(MessageHandlerBase):
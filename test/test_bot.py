@@ -0,0 +1,145 @@
+import asyncio
+import pathlib
+import threading
+import unittest
+import unittest.mock
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from bot.bot import Bot
+from bot.offset import UpdateOffset
+from data import BotConfig, Chat, Message, Update
+from db.database import Database
+from test.test_dispatcher import create_update
+from test.test_offset import PARAMETER_DB
+
+
+class TestHandleUpdateAsync(unittest.TestCase):
+    def setUp(self):
+        # Only handle_update is used by the asyncio path
+        self.bot: Bot = Bot.__new__(Bot)
+        self.handled: List[int] = []
+        self.lock: threading.Lock = threading.Lock()
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def handle(self, update: Update) -> None:
+        with self.lock:
+            self.handled.append(update.id_update)
+        if update.id_update % 2 == 1:
+            raise RuntimeError(f'update {update.id_update} failed')
+
+    def run_updates(self, updates: List[Update], chat_locks: Dict[int, List]) -> List:
+        self.bot.handle_update = self.handle
+
+        async def run() -> List:
+            return await asyncio.gather(*[self.bot._handle_update_async(u, self.executor, chat_locks)
+                                          for u in updates], return_exceptions=True)
+        return asyncio.run(run())
+
+    def test_chat_updates(self):
+        chat_locks: Dict[int, List] = {}
+        with self.assertLogs(level='ERROR') as logs:
+            results: List = self.run_updates([create_update(i, 7) for i in range(4)], chat_locks)
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(self.handled, [0, 1, 2, 3])
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(chat_locks, {})
+
+    def test_updates_without_chat(self):
+        with self.assertLogs(level='ERROR') as logs:
+            results: List = self.run_updates([Update.from_json({'update_id': i}) for i in range(2)], {})
+        self.assertEqual(results, [None, None])
+        self.assertEqual(sorted(self.handled), [0, 1])
+        self.assertIn('update 1 failed', logs.output[0])
+
+
+class TestWebhookSecret(unittest.TestCase):
+    def test_webhook_secret(self):
+        bot: Bot = Bot.__new__(Bot)
+        bot.config = BotConfig()
+        bot.config.tokens = {'telegram': 'token'}
+        with self.assertRaises(ValueError):
+            bot.get_webhook_secret()
+        bot.config.webhook_url = 'https://example.org/telegram'
+        with self.assertLogs(level='WARNING'):
+            generated: str = bot.get_webhook_secret()
+        self.assertGreaterEqual(len(generated), 32)
+        bot.config.tokens['webhook_secret'] = 'secret'
+        self.assertEqual(bot.get_webhook_secret(), 'secret')
+
+
+class TestPost(unittest.TestCase):
+    def setUp(self):
+        self.bot: Bot = Bot.__new__(Bot)
+        self.sent: Future = Future()
+        self.bot.outbox = unittest.mock.Mock()
+        self.bot.outbox.submit.return_value = self.sent
+        self.bot.sent_messages = unittest.mock.Mock()
+        self.chat: Chat = Chat.from_json({'id': -100123, 'type': 'group'})
+
+    def test_sent_message_not_saved(self):
+        self.bot.sent_messages.add.side_effect = RuntimeError('database is locked')
+        res: Future = self.bot._post(self.chat, 'sendMessage', {'text': 'hello'})
+        with self.assertLogs(level='ERROR'):
+            self.sent.set_result({'ok': True, 'result': {'message_id': 7,
+                                                         'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                                                         'chat': {'id': -100123, 'type': 'group'},
+                                                         'date': 0, 'text': 'hello'}})
+        # The message was sent, so the send does not fail
+        sent_message: Message = res.result(timeout=0)
+        self.assertEqual(sent_message.id_message, 7)
+        self.bot.sent_messages.add.assert_called_once_with(sent_message)
+
+    def test_send_failed(self):
+        res: Future = self.bot._post(self.chat, 'sendMessage', {'text': 'hello'})
+        with self.assertLogs(level='ERROR'):
+            self.sent.set_exception(ConnectionError('timed out'))
+        self.assertIsInstance(res.exception(timeout=0), ConnectionError)
+        self.bot.sent_messages.add.assert_not_called()
+
+
+class TestGetUpdates(unittest.TestCase):
+    def setUp(self):
+        self.database: Database = Database.from_json(PARAMETER_DB)
+        self.database.create_tables()
+        self.bot: Bot = Bot.__new__(Bot)
+        self.bot.config = BotConfig()
+        self.bot.update_offset = UpdateOffset(self.database, 60.)
+        self.offsets: List[Optional[int]] = []
+        # Telegram sends every update from the polled offset on
+        self.available: List[Dict] = [{'update_id': i} for i in range(1, 4)]
+        self.bot.call = self.call
+        self.bot.save_updates = self.save_updates
+
+    def tearDown(self):
+        self.database.close()
+        db_file: pathlib.Path = pathlib.Path('test.sqlite')
+        if db_file.exists():
+            db_file.unlink()
+
+    def call(self, action: str, params: Dict, timeout: float) -> Dict:
+        offset: Optional[int] = params.get('offset')
+        self.offsets.append(offset)
+        return {'ok': True, 'result': [u for u in self.available if offset is None or u['update_id'] >= offset]}
+
+    def save_updates(self, updates: List[Update], on_done: Callable[[], None]) -> None:
+        on_done()
+
+    @unittest.mock.patch.object(Bot, 'IN_FLIGHT_WAIT', 0.01)
+    def test_unfinished_update_polled_again(self):
+        self.assertEqual([u.id_update for u in self.bot.get_updates().result], [1, 2, 3])
+        for id_update in (1, 3):
+            self.bot.update_offset.complete(id_update)
+        # Update 2 is still being handled: it is not confirmed to Telegram and not handled twice
+        self.assertEqual(self.bot.get_updates().result, [])
+        self.assertEqual(self.offsets, [None, 2])
+        self.bot.update_offset.complete(2)
+        self.bot.get_updates()
+        self.assertEqual(self.offsets[-1], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
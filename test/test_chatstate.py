@@ -0,0 +1,117 @@
+import pathlib
+import pickle
+import shutil
+import time
+import unittest
+
+from data import ChatState
+from db.chatstate import ChatStateStore
+
+
+def create_state(chat_id: int, handler_name: str) -> ChatState:
+    state: ChatState = ChatState()
+    state.chat_id = chat_id
+    state.current_handler_name = handler_name
+    state.last_time = 1000.
+    state.data = {'action': 'question'}
+    return state
+
+
+class TestChatStateStore(unittest.TestCase):
+    def setUp(self):
+        self.store: ChatStateStore = ChatStateStore('test_chat_state.sqlite', cache_size=2)
+
+    def tearDown(self):
+        self.store.close()
+        db_file: pathlib.Path = pathlib.Path('test_chat_state.sqlite')
+        if db_file.exists():
+            db_file.unlink()
+        shutil.rmtree('test_chat.imported', ignore_errors=True)
+
+    def test_write_through(self):
+        self.assertIsNone(self.store.get(1))
+        self.store.put(1, create_state(1, 'trivia'))
+        reopened: ChatStateStore = ChatStateStore('test_chat_state.sqlite')
+        self.assertEqual(reopened.get(1).current_handler_name, 'trivia')
+        self.store.remove(1)
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(reopened.count(), 0)
+        reopened.close()
+
+    def test_lru_eviction(self):
+        for chat_id in (1, 2, 3):
+            self.store.put(chat_id, create_state(chat_id, 'tua'))
+        self.assertEqual(self.store.cached_count(), 2)
+        self.store.get(2)
+        self.assertEqual(self.store.hits, 1)
+        self.assertEqual(self.store.get(1).chat_id, 1)
+        self.assertEqual(self.store.misses, 1)
+        self.assertIsNone(self.store.get(4))
+        self.assertIsNone(self.store.get(4))
+        self.assertEqual(self.store.misses, 2)
+
+    def test_update(self):
+        self.store.put(1, create_state(1, 'trivia'))
+
+        def set_action(state: ChatState) -> ChatState:
+            state.data['action'] = 'choose_category'
+            return state
+
+        self.store.update(1, set_action)
+        self.assertEqual(ChatStateStore('test_chat_state.sqlite').get(1).data['action'], 'choose_category')
+        self.store.update(1, lambda state: None)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_import_pickles(self):
+        folder: pathlib.Path = pathlib.Path('test_chat')
+        folder.mkdir()
+        with open(str(folder.joinpath('5.pickle')), 'wb') as fobj:
+            pickle.dump(create_state(5, 'newtoncalc'), fobj)
+        self.assertEqual(self.store.import_pickles('test_chat'), 1)
+        self.assertFalse(folder.exists())
+        self.assertEqual(self.store.get(5).current_handler_name, 'newtoncalc')
+
+    def test_expired_on_access(self):
+        self.store.ttl = {'trivia': 60.}
+        self.store.put(1, create_state(1, 'trivia'))
+        self.store.put(2, create_state(2, 'tua'))
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(self.store.get(2).chat_id, 2)
+        self.assertEqual(self.store.expired_on_access, 1)
+        self.assertEqual(self.store.count(), 1)
+
+    def test_sweep(self):
+        self.store.sweep_batch_size = 2
+        self.store.ttl = {'trivia': 60.}
+        self.store.default_ttl = 600.
+        for chat_id in range(5):
+            self.store.put(chat_id, create_state(chat_id, 'trivia'))
+        self.store.put(10, create_state(10, 'tua'))
+        self.store.put(11, create_state(11, None))
+        self.assertEqual(self.store.sweep(now=1100.), 5)
+        self.assertEqual(self.store.count(), 2)
+        self.assertEqual(self.store.sweep(now=1700.), 2)
+        self.assertEqual(self.store.metrics()['expired_by_sweep'], 7)
+        self.assertEqual(self.store.cached_count(), 0)
+
+    def test_touch_keeps_active_state(self):
+        self.store.ttl = {'newtoncalc': 60.}
+        start: float = time.time() - 150.
+        state: ChatState = create_state(1, 'newtoncalc')
+        state.last_time = start
+        self.store.put(1, state)
+        # A message routed to the state every 50 seconds, for longer than its TTL
+        for elapsed in (50., 100., 150.):
+            self.assertEqual(self.store.sweep(now=start + elapsed), 0)
+            self.store.touch(1, state, now=start + elapsed)
+        self.assertIs(self.store.get(1), state)
+        reopened: ChatStateStore = ChatStateStore('test_chat_state.sqlite')
+        self.assertEqual(reopened.get(1).last_time, start + 150.)
+        reopened.close()
+        self.store.touch(1, state, now=start + 155.)
+        self.assertEqual(state.last_time, start + 150.)
+        self.assertEqual(self.store.sweep(now=start + 300.), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import pathlib
+import sqlite3
+import threading
+import unittest
+from typing import List
+
+from db.connection import ConnectionManager, ConnectionSettings
+
+FILENAME: str = 'test_connection.sqlite'
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.settings: ConnectionSettings = ConnectionSettings.from_json({'journal_mode': 'wal',
+                                                                          'synchronous': 'normal',
+                                                                          'cache_size': -2000})
+        self.manager: ConnectionManager = ConnectionManager(FILENAME, self.settings)
+        with self.manager.transaction() as connection:
+            connection.execute('CREATE TABLE [item] (id INTEGER PRIMARY KEY, value TEXT);')
+
+    def tearDown(self):
+        self.manager.close_all()
+        for suffix in ('', '-wal', '-shm'):
+            db_file: pathlib.Path = pathlib.Path(FILENAME + suffix)
+            if db_file.exists():
+                db_file.unlink()
+
+    def test_pragmas(self):
+        connection: sqlite3.Connection = self.manager.connection()
+        self.assertEqual(connection.execute('PRAGMA journal_mode;').fetchone()[0], 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous;').fetchone()[0], 1)
+        self.assertEqual(connection.execute('PRAGMA cache_size;').fetchone()[0], -2000)
+
+    def test_connection_per_thread(self):
+        connections: List[sqlite3.Connection] = []
+        thread: threading.Thread = threading.Thread(target=lambda: connections.append(self.manager.connection()))
+        thread.start()
+        thread.join()
+        self.assertIs(self.manager.connection(), self.manager.connection())
+        self.assertIsNot(connections[0], self.manager.connection())
+        self.assertEqual(self.manager.connections_opened, 2)
+
+    def test_transaction(self):
+        with self.manager.transaction() as connection:
+            connection.execute('INSERT INTO [item] VALUES (1, \'a\');')
+            with self.manager.transaction() as inner:
+                inner.execute('INSERT INTO [item] VALUES (2, \'b\');')
+            # Not committed until the outer block exits
+            other: sqlite3.Connection = self.manager.connect()
+            self.assertEqual(other.execute('SELECT COUNT(*) FROM [item];').fetchone()[0], 0)
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM [item];').fetchone()[0], 2)
+        with self.assertRaises(ValueError):
+            with self.manager.transaction() as connection:
+                connection.execute('INSERT INTO [item] VALUES (3, \'c\');')
+                raise ValueError()
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM [item];').fetchone()[0], 2)
+        other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
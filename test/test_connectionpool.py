@@ -0,0 +1,85 @@
+import http.client
+import http.server
+import threading
+import time
+import unittest
+
+from bot.connectionpool import HttpConnectionPool
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body: bytes = self.path.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/drop':
+            # Hang up without announcing it, like a server dropping an idle keep-alive connection
+            self.close_connection = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts += 1
+        # The request is received but the connection drops before the response
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        self.server.posts = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool = HttpConnectionPool('127.0.0.1', self.server.server_address[1], use_ssl=False, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        for i in range(5):
+            status, _, body = self.pool.request('GET', f'/{i}', timeout=5.)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, f'/{i}'.encode('utf8'))
+        self.assertEqual(self.pool.connections_created, 1)
+        self.assertEqual(self.pool.idle_count(), 1)
+
+    def test_closed_connection_not_pooled(self):
+        self.pool.request('GET', '/close', timeout=5.)
+        self.assertEqual(self.pool.idle_count(), 0)
+        self.pool.request('GET', '/1', timeout=5.)
+        self.assertEqual(self.pool.connections_created, 2)
+
+    def test_stale_connection_replaced(self):
+        self.pool.request('GET', '/drop', timeout=5.)
+        self.assertEqual(self.pool.idle_count(), 1)
+        time.sleep(0.1)
+        status, _, body = self.pool.request('GET', '/2', timeout=5.)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'/2')
+        self.assertEqual(self.pool.connections_created, 2)
+
+    def test_sent_request_not_retried(self):
+        self.pool.request('GET', '/1', timeout=5.)
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.pool.request('POST', '/sendMessage', b'text=hello', timeout=5.)
+        self.assertEqual(self.server.posts, 1)
+
+        self.pool.request('GET', '/2', timeout=5.)
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.pool.request('POST', '/getUpdates', b'offset=1', timeout=5., idempotent=True)
+        self.assertEqual(self.server.posts, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
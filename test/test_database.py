@@ -1,3 +1,5 @@
+import json
+import time
 import unittest
 
 import pathlib
@@ -7,7 +9,8 @@ from typing import List
 import sqlite3
 
 import utils
-from db.database import Database, DbSerializable, DataSet, DataRow, DataTable, Table, Column
+from db.database import Database, DbSerializable, DataSet, DataRow, DataTable, Table, Column, TableLayout, QueryRow, \
+    UnitOfWork
 
 TABLE_PARENT: str = 'table_parent'
 TABLE_CHILD: str = 'table_child'
@@ -63,6 +66,19 @@ class ParentObject(DbSerializable):
         return res
 
 
+INDEXED_DB: Dict = {
+    'filename': 'test.sqlite',
+    'tables': [{'name': 'event',
+                'columns': [{'name': 'id_event', 'type': 'int'}, {'name': 'id_chat', 'type': 'int?'},
+                            {'name': 'date', 'type': 'int'}, {'name': 'code', 'type': 'str'}],
+                'primary_key': 'id_event',
+                'foreign_keys': [],
+                'indexes': [{'columns': ['id_chat', 'date']},
+                            {'name': 'ix_event_code', 'columns': ['code'], 'unique': True},
+                            {'columns': ['date'], 'where': 'id_chat IS NULL'}]}]
+}
+
+
 class TestDatabase(unittest.TestCase):
 
     def setUp(self):
@@ -96,6 +112,237 @@ class TestDatabase(unittest.TestCase):
         except RuntimeError:
             self.fail(f'Column {column_name} not found in table {"table_child"}')
 
+    def test_table_layout(self):
+        db: Database = Database.from_json(utils.get_file_json('testfiles/db_definition.json'))
+        self.assertEqual(sorted(db.layouts), [TABLE_CHILD, TABLE_PARENT])
+        layout: TableLayout = db.get_layout(TABLE_CHILD)
+        self.assertIs(layout, db.layouts[TABLE_CHILD])
+        self.assertEqual(layout.column_index['value_1'], 2)
+        row: DataRow = DataRow(TABLE_CHILD, 100)
+        row.put('value_1', 'child')
+        row.put('id_table_child', 100)
+        self.assertEqual(layout.row_to_tuple_for_insert(row), (100, None, 'child'))
+        self.assertEqual(layout.row_to_tuple_for_update(row), (None, 'child', 100))
+        row.put('missing', 0)
+        with self.assertRaises(RuntimeError):
+            layout.row_to_tuple_for_insert(row)
+        with self.assertRaises(AttributeError):
+            layout.insert_sql = ''
+
+    def test_row_schema_per_column_list(self):
+        tables: List[List[Dict]] = [[{'name': 'id_event', 'type': 'int'}, {'name': 'code', 'type': 'str?'}],
+                                    [{'name': 'id_event', 'type': 'int'}, {'name': 'value', 'type': 'float?'},
+                                     {'name': 'code', 'type': 'str?'}]]
+        layouts: List[TableLayout] = [
+            Database.from_json({'filename': 'unused.sqlite',
+                                'tables': [{'name': 'event', 'columns': columns, 'primary_key': 'id_event',
+                                            'foreign_keys': []}]}).get_layout('event')
+            for columns in tables]
+        first: DataRow = layouts[0].to_row('event', (1, 'first'))
+        second: DataRow = layouts[1].to_row('event', (2, 2.5, 'second'))
+        self.assertIsNot(first.schema, second.schema)
+        self.assertEqual(first.schema.names, ['id_event', 'code'])
+        self.assertEqual(second.schema.names, ['id_event', 'value', 'code'])
+        self.assertEqual(first.values, [1, 'first'])
+        self.assertEqual(layouts[0].row_to_tuple_for_insert(first), (1, 'first'))
+        self.assertEqual(layouts[1].row_to_tuple_for_insert(second), (2, 2.5, 'second'))
+
+    def test_data_row(self):
+        row: DataRow = DataRow('row_test', 1)
+        row.put('b', 2)
+        row.put('a', None)
+        other: DataRow = DataRow('row_test', 2)
+        other.put('a', 'other')
+        self.assertIs(row.schema, other.schema)
+        self.assertEqual(row.get('a'), None)
+        with self.assertRaises(KeyError):
+            other.get('b')
+        self.assertEqual(dict(other.items), {'a': 'other'})
+        other.items['c'] = 3
+        del other.items['a']
+        self.assertEqual(other.items, {'c': 3})
+        self.assertEqual(other.items.get('a'), None)
+        row.set_values(('c', 'b'), (30, 20))
+        self.assertEqual(row.items, {'b': 20, 'c': 30})
+
+    def test_indexes(self):
+        db: Database = Database.from_json(INDEXED_DB)
+        db.create_tables()
+        connection: sqlite3.Connection = db.connection()
+        self.assertEqual(sorted(db.get_current_indexes(connection, 'event')),
+                         ['ix_event_code', 'ix_event_date', 'ix_event_id_chat_date'])
+        self.assertEqual(db.indexes_used(connection, 'SELECT * FROM [event] WHERE id_chat=? AND date>?', (1, 0)),
+                         ['ix_event_id_chat_date'])
+        self.assertTrue(db.get_current_indexes(connection, 'event')['ix_event_date'].endswith('WHERE id_chat IS NULL'))
+        self.assertIn('SCAN', db.explain(connection, 'SELECT * FROM [event] WHERE code LIKE ?', ('a%',))[0])
+        db.close()
+
+        changed: Dict = json.loads(json.dumps(INDEXED_DB))
+        changed['tables'][0]['indexes'] = [{'name': 'ix_event_code', 'columns': ['code', 'date']}]
+        db = Database.from_json(changed)
+        db.create_tables()
+        current: Dict[str, str] = db.get_current_indexes(db.connection(), 'event')
+        self.assertEqual(list(current), ['ix_event_code'])
+        self.assertEqual(current['ix_event_code'], 'CREATE INDEX [ix_event_code] ON [event] (code, date)')
+        db.close()
+
+    def test_schema_fingerprint(self):
+        db: Database = Database.from_json(INDEXED_DB)
+        db.create_tables()
+        fingerprint: str = db.read_schema_fingerprint(db.connection())
+        self.assertEqual(fingerprint, db.get_schema_fingerprint())
+        reordered: Dict = json.loads(json.dumps(INDEXED_DB))
+        reordered['tables'][0]['indexes'].reverse()
+        self.assertEqual(Database.from_json(reordered).get_schema_fingerprint(), fingerprint)
+
+        inspected: List[str] = []
+        get_current_table = db.get_current_table
+        db.get_current_table = lambda c, t: inspected.append(t) or get_current_table(c, t)
+        db.create_tables()
+        self.assertEqual(inspected, [])
+        db.create_tables(force=True)
+        self.assertEqual(inspected, ['event'])
+        db.close()
+
+        changed: Dict = json.loads(json.dumps(INDEXED_DB))
+        changed['tables'][0]['columns'].append({'name': 'value', 'type': 'float?'})
+        db = Database.from_json(changed)
+        self.assertNotEqual(db.get_schema_fingerprint(), fingerprint)
+        db.create_tables()
+        self.assertIn('value', [c.name for c in db.get_current_table(db.connection(), 'event').columns])
+        self.assertEqual(db.read_schema_fingerprint(db.connection()), db.get_schema_fingerprint())
+        db.close()
+
+    def test_unit_of_work(self):
+        db: Database = self.create_db()
+        count_sql: str = f'SELECT COUNT(*) FROM [{TABLE_PARENT}];'
+        reader: sqlite3.Connection = db.create_connection()
+        work: UnitOfWork = db.unit_of_work(max_objects=3, max_delay=60.)
+        for i in range(2, 4):
+            parent: ParentObject = ParentObject()
+            parent.id_table_parent = i
+            work.add(parent)
+        self.assertEqual(reader.execute(count_sql).fetchone()[0], 1)
+        self.assertEqual(work.pending_count(), 2)
+        parent = ParentObject()
+        parent.id_table_parent = 4
+        work.add(parent)
+        self.assertEqual(reader.execute(count_sql).fetchone()[0], 4)
+        self.assertEqual(work.metrics()['commits'], 1)
+        self.assertEqual(work.metrics()['rows_per_commit'], 3)
+        parent = ParentObject()
+        parent.id_table_parent = 5
+        work.add(parent)
+        work.close()
+        self.assertEqual(reader.execute(count_sql).fetchone()[0], 5)
+        with self.assertRaises(RuntimeError):
+            work.add(parent)
+
+        work = db.unit_of_work(max_objects=100, max_delay=0.01)
+        parent = ParentObject()
+        parent.id_table_parent = 6
+        work.add(parent)
+        for _ in range(200):
+            if work.commits == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(reader.execute(count_sql).fetchone()[0], 6)
+        work.close()
+
+        work = db.unit_of_work(max_delay=None)
+        parent = ParentObject()
+        parent.id_table_parent = 7
+        work.add(parent)
+        self.assertEqual(reader.execute(count_sql).fetchone()[0], 7)
+        self.assertEqual(work.metrics()['objects_saved'], 1)
+        reader.close()
+        db.close()
+
+    def test_unit_of_work_failed_commit(self):
+        db: Database = self.create_db()
+        count_sql: str = f'SELECT COUNT(*) FROM [{TABLE_PARENT}];'
+        save_data_set = db.save_data_set
+        failures: List[int] = [1]
+
+        def fail_once(connection: sqlite3.Connection, data_set: DataSet) -> None:
+            if failures[0] > 0:
+                failures[0] -= 1
+                raise sqlite3.OperationalError('database is locked')
+            save_data_set(connection, data_set)
+
+        db.save_data_set = fail_once
+        work: UnitOfWork = db.unit_of_work(max_objects=100, max_delay=0.01, retry_delay=0.01)
+        with self.assertLogs(level='WARNING'):
+            for i in range(2, 5):
+                parent: ParentObject = ParentObject()
+                parent.id_table_parent = i
+                work.add(parent)
+            for _ in range(200):
+                if work.commits == 1:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(work.metrics()['commits_failed'], 1)
+        self.assertEqual(db.connection().execute(count_sql).fetchone()[0], 4)
+        work.close()
+
+        # A bad object is dropped on its own once the retries are exhausted
+        work = db.unit_of_work(max_objects=3, max_delay=60., max_retries=1, retry_delay=0.)
+        for i in range(5, 8):
+            parent = ParentObject()
+            parent.id_table_parent = i
+            parent.value_1 = None if i == 6 else f'value {i}'
+            if i < 7:
+                work.add(parent)
+        # The third object triggers the commit
+        with self.assertRaises(sqlite3.IntegrityError):
+            work.add(parent)
+        self.assertEqual(work.pending_count(), 3)
+        with self.assertLogs(level='ERROR'):
+            work.close()
+        self.assertEqual(work.metrics()['objects_dropped'], 1)
+        self.assertEqual(db.connection().execute(count_sql).fetchone()[0], 6)
+
+    def test_write_cache(self):
+        definition: Dict = json.loads(json.dumps(INDEXED_DB))
+        definition['tables'][0]['write_cache'] = True
+        db: Database = Database.from_json(definition)
+        db.create_tables()
+
+        def event(code: str, id_chat: int = -1) -> DataRow:
+            row: DataRow = DataRow('event', 1)
+            row.set_values(('id_event', 'id_chat', 'date', 'code'), (1, id_chat, 100, code))
+            return row
+
+        def saved() -> List:
+            return db.connection().execute('SELECT id_chat, code FROM [event];').fetchall()
+
+        with db.transaction() as connection:
+            db.upsert_rows(connection, [event('a')])
+            db.upsert_rows(connection, [event('a')])
+        self.assertEqual((db.write_cache.rows_written, db.write_cache.rows_skipped), (1, 1))
+        with db.transaction() as connection:
+            db.upsert_rows(connection, [event('b', -2)])
+        self.assertEqual(db.write_cache.rows_updated, 1)
+        self.assertEqual(saved(), [(-2, 'b')])
+        self.assertEqual(db.get_layout('event').get_partial_update_sql((1, 3)),
+                         'UPDATE [event] SET id_chat=?, code=? WHERE id_event=?;')
+
+        with db.transaction() as connection:
+            connection.execute('DELETE FROM [event];')
+            db.upsert_rows(connection, [event('c', -2)])
+        self.assertEqual(saved(), [(-2, 'c')])
+        with self.assertRaises(ValueError):
+            with db.transaction() as connection:
+                db.upsert_rows(connection, [event('d', -2)])
+                raise ValueError()
+        self.assertEqual(len(db.write_cache), 0)
+        with db.transaction() as connection:
+            db.update_rows(connection, [event('e')])
+            self.assertEqual(len(db.write_cache), 0)
+            db.upsert_rows(connection, [event('c', -2)])
+        self.assertEqual(saved(), [(-2, 'c')])
+        db.close()
+
     def test_db_created(self):
         db: Database = self.create_db()
         db_file: pathlib.Path = pathlib.Path(db.filename)
@@ -109,6 +356,38 @@ class TestDatabase(unittest.TestCase):
             obj: ParentObject = db.query_object(connection, ParentObject, TABLE_PARENT, 1)
         self.assertTrue(obj is not None)
 
+    def test_save_updates_existing_rows(self):
+        db: Database = self.create_db()
+        parent_obj: ParentObject = ParentObject()
+        parent_obj.id_table_parent = 1
+        parent_obj.value_1 = 'updated parent'
+        db.save(parent_obj)
+        parent_obj.id_table_parent = 2
+        db.save(parent_obj)
+        connection: sqlite3.Connection
+        with db.create_connection() as connection:
+            rows: List = connection.execute('SELECT id_table_parent, value_1 FROM [table_parent] '
+                                            'ORDER BY id_table_parent;').fetchall()
+            children: List = connection.execute('SELECT value_1 FROM [table_child];').fetchall()
+        connection.close()
+        self.assertEqual(rows, [(1, 'updated parent'), (2, 'updated parent')])
+        self.assertEqual(children, [('test str child',)])
+
+    def test_iter_rows(self):
+        db: Database = self.create_db()
+        connection: sqlite3.Connection = db.connection()
+        with db.transaction():
+            connection.executemany('INSERT INTO [table_child] (id_table_child, id_table_parent, value_1) VALUES (?, 1, ?);',
+                                   [(i, f'child {i}') for i in range(200, 210)])
+        rows: List[QueryRow] = list(db.iter_rows(connection, 'table_child', 'id_table_child>=?', (200,), batch_size=3))
+        self.assertEqual([r.identity for r in rows], list(range(200, 210)))
+        self.assertEqual(rows[4].get('value_1'), 'child 204')
+        self.assertIs(rows[0].column_index, rows[9].column_index)
+        row: QueryRow = next(db.iter_rows(connection, 'table_child', column_list=['value_1']))
+        self.assertEqual(row.values, (100, 'test str child'))
+        self.assertEqual(row.to_data_row().items, {'id_table_child': 100, 'value_1': 'test str child'})
+        db.close()
+
     def create_db(self) -> Database:
         db_json: Dict = utils.get_file_json('testfiles/db_definition.json')
         db: Database = Database.from_json(db_json)
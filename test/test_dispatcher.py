@@ -0,0 +1,68 @@
+import threading
+import time
+import unittest
+from typing import Dict, List, Tuple
+
+from bot.dispatcher import UpdateDispatcher
+from data import Update
+
+
+def create_update(id_update: int, id_chat: int) -> Update:
+    return Update.from_json({'update_id': id_update,
+                             'message': {'message_id': id_update,
+                                         'from': {'id': 1, 'is_bot': False, 'first_name': 'user'},
+                                         'chat': {'id': id_chat, 'type': 'private'},
+                                         'date': 0,
+                                         'text': 'hello'}})
+
+
+class TestUpdateDispatcher(unittest.TestCase):
+    def test_order_within_chat(self):
+        handled: Dict[int, List[int]] = {}
+        lock: threading.Lock = threading.Lock()
+
+        def handler(update: Update) -> None:
+            with lock:
+                handled.setdefault(update.message.chat.id_chat, []).append(update.id_update)
+
+        dispatcher: UpdateDispatcher = UpdateDispatcher(handler, 3)
+        dispatcher.start()
+        for i in range(100):
+            dispatcher.submit(create_update(i, i % 7))
+        dispatcher.stop()
+        self.assertEqual(sum(len(v) for v in handled.values()), 100)
+        for id_chat in handled:
+            self.assertEqual(handled[id_chat], sorted(handled[id_chat]))
+
+    def test_parallel_across_chats(self):
+        intervals: List[Tuple[float, float]] = []
+
+        def handler(update: Update) -> None:
+            start: float = time.time()
+            time.sleep(0.1)
+            intervals.append((start, time.time()))
+
+        dispatcher: UpdateDispatcher = UpdateDispatcher(handler, 2)
+        dispatcher.start()
+        dispatcher.submit(create_update(1, 0))
+        dispatcher.submit(create_update(2, 1))
+        dispatcher.stop()
+        self.assertEqual(len(intervals), 2)
+        self.assertLess(max(s for s, _ in intervals), min(e for _, e in intervals))
+
+    def test_queue_depths(self):
+        release: threading.Event = threading.Event()
+        dispatcher: UpdateDispatcher = UpdateDispatcher(lambda u: release.wait(), 2)
+        dispatcher.start()
+        for i in range(5):
+            dispatcher.submit(create_update(i, 0))
+        time.sleep(0.05)
+        depths: List[int] = dispatcher.queue_depths()
+        self.assertEqual(depths[dispatcher.shard_of(create_update(0, 0))], 4)
+        self.assertEqual(depths[dispatcher.shard_of(create_update(0, 1))], 0)
+        release.set()
+        dispatcher.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
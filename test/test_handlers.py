@@ -0,0 +1,82 @@
+import unittest
+from typing import List
+
+from bot.base import BotBase, MessageHandlerBase
+from data import Message, ChatState
+
+
+class RecordingHandler(MessageHandlerBase):
+    created: int = 0
+
+    def __init__(self):
+        super().__init__()
+        RecordingHandler.created += 1
+        self.events: List[str] = []
+
+    def on_start(self, bot: BotBase) -> None:
+        self.events.append('start')
+
+    def on_stop(self, bot: BotBase) -> None:
+        self.events.append('stop')
+
+    def process_message(self, message: Message, bot: BotBase, chat_state: ChatState = None) -> None:
+        self.events.append(message.text)
+
+
+class StatefulHandler(RecordingHandler):
+    thread_safe = False
+
+
+class FailingHandler(RecordingHandler):
+    def on_start(self, bot: BotBase) -> None:
+        raise RuntimeError('could not start')
+
+
+class FailingStatefulHandler(FailingHandler):
+    thread_safe = False
+
+
+class TestHandlerLifecycle(unittest.TestCase):
+    def test_single_instance(self):
+        bot: BotBase = BotBase()
+        RecordingHandler.created = 0
+        bot.add_message_handler('recording', RecordingHandler, ['rec'])
+        instance: MessageHandlerBase = bot.handler_instances['recording']
+        self.assertEqual(instance.handler_name, 'recording')
+        bot.start_handlers()
+        for text in ('rec 1', 'rec 2'):
+            message: Message = Message()
+            message.text = text
+            bot.handler_instances['recording'].process_message(message, bot)
+        bot.stop_handlers()
+        self.assertIs(bot.handler_instances['recording'], instance)
+        self.assertEqual(RecordingHandler.created, 1)
+        self.assertEqual(instance.events, ['start', 'rec 1', 'rec 2', 'stop'])
+
+    def test_lock_for_stateful_handler(self):
+        bot: BotBase = BotBase()
+        bot.add_message_handler('recording', RecordingHandler)
+        bot.add_message_handler('stateful', StatefulHandler)
+        self.assertNotIn('recording', bot.handler_locks)
+        self.assertIn('stateful', bot.handler_locks)
+
+    def test_failing_start(self):
+        bot: BotBase = BotBase()
+        bot.add_message_handler('failing', FailingHandler)
+        bot.add_message_handler('failing_fail', FailingStatefulHandler, ['fail'])
+        bot.add_message_handler('recording', RecordingHandler)
+        failing: List[MessageHandlerBase] = [bot.handler_instances['failing'], bot.handler_instances['failing_fail']]
+        with self.assertLogs(level='ERROR'):
+            bot.start_handlers()
+        self.assertEqual(bot.handler_instances['recording'].events, ['start'])
+        # The failed handlers are not routed to, locked or stopped
+        self.assertEqual(list(bot.handler_instances), ['recording'])
+        self.assertEqual(bot.handler_locks, {})
+        self.assertEqual(bot.routing.route('fail now'), ['recording'])
+        self.assertEqual(bot.routing.route('hello'), ['recording'])
+        bot.stop_handlers()
+        self.assertEqual([h.events for h in failing], [[], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import json
+import pathlib
+import sqlite3
+import threading
+import unittest
+from typing import Dict, List
+
+from db.database import Database, Table
+from db.migration import MigrationProgress, SchemaMigrator
+
+FILENAME: str = 'test_migration.sqlite'
+
+EVENT_DB: Dict = {
+    'filename': FILENAME,
+    'tables': [{'name': 'event',
+                'columns': [{'name': 'id_event', 'type': 'int'}, {'name': 'id_chat', 'type': 'int'},
+                            {'name': 'code', 'type': 'str?'}],
+                'primary_key': 'id_event',
+                'foreign_keys': [],
+                'indexes': [{'columns': ['id_chat']}]}]
+}
+
+
+def changed_definition() -> Dict:
+    # id_chat becomes nullable and a value column is added
+    res: Dict = json.loads(json.dumps(EVENT_DB))
+    res['tables'][0]['columns'][1]['type'] = 'int?'
+    res['tables'][0]['columns'].append({'name': 'value', 'type': 'float?'})
+    return res
+
+
+class TestSchemaMigrator(unittest.TestCase):
+    def setUp(self):
+        db: Database = Database.from_json(EVENT_DB)
+        db.create_tables()
+        with db.transaction() as connection:
+            connection.executemany('INSERT INTO [event] (id_event, id_chat, code) VALUES (?, ?, ?);',
+                                   ((i, i % 7, f'code {i}') for i in range(1, 101)))
+        db.close()
+        self.database: Database = Database.from_json(changed_definition())
+
+    def tearDown(self):
+        self.database.close()
+        db_file: pathlib.Path = pathlib.Path(FILENAME)
+        if db_file.exists():
+            db_file.unlink()
+
+    def current_table(self) -> Table:
+        return self.database.get_current_table(self.database.connection(), 'event')
+
+    def test_no_migration_when_unchanged(self):
+        db: Database = Database.from_json(EVENT_DB)
+        db.create_tables()
+        self.assertEqual(db.pending_migrations, [])
+        db.close()
+
+    def test_migration(self):
+        self.database.create_tables()
+        self.assertEqual([t.name for t in self.database.pending_migrations], ['event'])
+        progress: List[MigrationProgress] = []
+        migrator: SchemaMigrator = SchemaMigrator(self.database, batch_size=30, pause=0., on_progress=progress.append)
+        migrator.run()
+        self.assertEqual([p.copied_rows for p in progress], [30, 60, 90, 100])
+        self.assertEqual(self.database.pending_migrations, [])
+        self.assertTrue(self.current_table().columns[1].nullable)
+        connection: sqlite3.Connection = self.database.connection()
+        self.assertEqual(connection.execute('SELECT COUNT(*), SUM(id_chat) FROM [event];').fetchone(),
+                         (100, sum(i % 7 for i in range(1, 101))))
+        self.assertEqual(list(self.database.get_current_indexes(connection, 'event')), ['ix_event_id_chat'])
+        self.assertEqual([m[0] for m in migrator.applied_migrations(connection)], ['event'])
+
+        self.assertEqual(self.database.read_schema_fingerprint(connection), self.database.get_schema_fingerprint())
+        self.database.create_tables()
+        self.assertEqual(self.database.pending_migrations, [])
+
+    def test_writes_during_copy(self):
+        self.database.create_tables()
+        migrator: SchemaMigrator = SchemaMigrator(self.database, batch_size=40, pause=0.)
+        writes: List[str] = []
+
+        def write_between_batches(progress: MigrationProgress) -> None:
+            if len(writes) > 0:
+                return
+            with self.database.transaction() as connection:
+                connection.execute('INSERT INTO [event] (id_event, id_chat, code, value) VALUES (500, 1, NULL, 2.5);')
+                connection.execute('UPDATE [event] SET code=\'changed\' WHERE id_event IN (10, 90);')
+                connection.execute('DELETE FROM [event] WHERE id_event IN (20, 80);')
+            writes.append('done')
+
+        migrator.on_progress = write_between_batches
+        migrator.run()
+        connection: sqlite3.Connection = self.database.connection()
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM [event];').fetchone()[0], 99)
+        self.assertEqual(connection.execute('SELECT code FROM [event] WHERE id_event IN (10, 90);').fetchall(),
+                         [('changed',), ('changed',)])
+        self.assertEqual(connection.execute('SELECT value FROM [event] WHERE id_event=500;').fetchone()[0], 2.5)
+
+    def test_rowids_not_positive(self):
+        # The rowid is the primary key, and group chat ids are negative
+        with self.database.transaction() as connection:
+            connection.executemany('INSERT INTO [event] (id_event, id_chat, code) VALUES (?, ?, ?);',
+                                   ((-100123, -100123, 'group'), (-1, -1, None), (0, 0, None)))
+        self.database.create_tables()
+        progress: List[MigrationProgress] = []
+        SchemaMigrator(self.database, batch_size=40, pause=0., on_progress=progress.append).run()
+        self.assertEqual([p.copied_rows for p in progress], [40, 80, 103])
+        self.assertEqual(self.database.pending_migrations, [])
+        self.assertTrue(self.current_table().columns[1].nullable)
+        self.assertEqual(self.database.connection().execute(
+            'SELECT id_event, code FROM [event] WHERE id_event <= 0 ORDER BY id_event;').fetchall(),
+            [(-100123, 'group'), (-1, None), (0, None)])
+
+    def test_concurrent_writes(self):
+        # Rows are inserted faster than one batch per pause during the whole copy; the triggers mirror them and the
+        # copy still finishes
+        self.database.create_tables()
+        stop: threading.Event = threading.Event()
+        inserted: List[int] = []
+
+        def write() -> None:
+            while not stop.is_set():
+                ids: List[int] = list(range(1000 + len(inserted), 1020 + len(inserted)))
+                with self.database.transaction() as connection:
+                    connection.executemany('INSERT INTO [event] (id_event, id_chat, code) VALUES (?, 1, NULL);',
+                                           ((i,) for i in ids))
+                inserted.extend(ids)
+                stop.wait(0.001)
+
+        writer: threading.Thread = threading.Thread(target=write)
+        writer.start()
+        try:
+            migrator: SchemaMigrator = SchemaMigrator(self.database, batch_size=10, pause=0.001)
+            migrator.run()
+        finally:
+            stop.set()
+            writer.join()
+        self.assertGreater(len(inserted), 0)
+        self.assertEqual(self.database.pending_migrations, [])
+        self.assertTrue(self.current_table().columns[1].nullable)
+        self.assertEqual(self.database.connection().execute('SELECT COUNT(*) FROM [event];').fetchone()[0],
+                         100 + len(inserted))
+
+    def test_resume(self):
+        self.database.create_tables()
+        migrator: SchemaMigrator = SchemaMigrator(self.database, batch_size=25, pause=0.)
+
+        def stop_after_two_batches(progress: MigrationProgress) -> None:
+            if progress.copied_rows >= 50:
+                migrator._stop.set()
+
+        migrator.on_progress = stop_after_two_batches
+        migrator.run()
+        self.assertEqual(migrator.progress.copied_rows, 50)
+        self.assertIsNone(self.database.read_schema_fingerprint(self.database.connection()))
+        self.assertFalse(self.current_table().columns[1].nullable)
+
+        self.database.close()
+        self.database = Database.from_json(changed_definition())
+        self.database.create_tables()
+        resumed: List[int] = []
+        migrator = SchemaMigrator(self.database, batch_size=25, pause=0.,
+                                  on_progress=lambda p: resumed.append(p.copied_rows))
+        migrator.run()
+        self.assertEqual(resumed, [75, 100])
+        self.assertTrue(self.current_table().columns[1].nullable)
+        self.assertEqual(self.database.connection().execute('SELECT COUNT(*) FROM [event];').fetchone()[0], 100)
+
+    def test_writes_not_fitting_new_definition(self):
+        # code becomes NOT NULL: every existing row has one, a row written during the copy does not
+        definition: Dict = changed_definition()
+        definition['tables'][0]['columns'][2]['type'] = 'str'
+        self.database.close()
+        self.database = Database.from_json(definition)
+        self.database.create_tables()
+        migrator: SchemaMigrator = SchemaMigrator(self.database, batch_size=40, pause=0.)
+
+        def write_between_batches(progress: MigrationProgress) -> None:
+            if progress.copied_rows == 40:
+                with self.database.transaction() as connection:
+                    connection.execute('INSERT INTO [event] (id_event, id_chat, code) VALUES (500, 1, NULL);')
+                    connection.execute('UPDATE [event] SET code=NULL WHERE id_event=10;')
+
+        migrator.on_progress = write_between_batches
+        with self.assertLogs(level='ERROR') as logs:
+            migrator.run()
+        self.assertIn('2 row(s) of table event were not copied, rowids 10, 500', '\n'.join(logs.output))
+        connection: sqlite3.Connection = self.database.connection()
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM [event] WHERE code IS NULL;').fetchone()[0], 2)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM [event];').fetchone()[0], 101)
+        self.assertFalse(self.database.table_exists(connection, 'event' + SchemaMigrator.COPY_SUFFIX))
+        self.assertEqual([t.name for t in self.database.pending_migrations], ['event'])
+
+    def test_failed_copy_keeps_table(self):
+        with self.database.transaction() as connection:
+            connection.execute('INSERT INTO [event] (id_event, id_chat, code) VALUES (200, 1, NULL);')
+        definition: Dict = changed_definition()
+        definition['tables'][0]['columns'][2]['type'] = 'str'
+        self.database.close()
+        self.database = Database.from_json(definition)
+        self.database.create_tables()
+        with self.assertLogs(level='ERROR'):
+            SchemaMigrator(self.database, batch_size=500, pause=0.).run()
+        connection: sqlite3.Connection = self.database.connection()
+        self.assertFalse(self.database.table_exists(connection, 'event' + SchemaMigrator.COPY_SUFFIX))
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM [event];').fetchone()[0], 101)
+        self.assertEqual([t.name for t in self.database.pending_migrations], ['event'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,8 @@ import pathlib
 from sqlite3.dbapi2 import Connection
 from typing import List
 
-from db.database import Database, DataSet
-from objectprovider import ObjectProvider
+from db.database import Database, DataRow, DataSet
+from objectprovider import ObjectCache, ObjectProvider, ObjectMapper, ObjectSession
 from test.dbdata import ParentObject, ChildObject
 
 
@@ -50,3 +50,93 @@ class TestObjectProvider(unittest.TestCase):
             self.database.raw_query(connection, 'table_parent', ['id_table_parent', 'value_1'], None, None)
             res: List[object] = object_provider._query_objects(self.database, connection, 'test.dbdata.ParentObject', None, None)
             print(res)
+
+    def test_query_objects_batches_relationships(self):
+        with self.database.transaction() as connection:
+            for i in range(2, 5):
+                connection.execute('INSERT INTO [table_parent] (id_table_parent, single_child, value_1) '
+                                   'VALUES (?, 20, ?);', (i, f'p{i}'))
+                connection.executemany('INSERT INTO [table_child] (id_table_child, id_table_parent, value_1) '
+                                       'VALUES (?, ?, ?);', ((10 * i + j, i, f'c{i}{j}') for j in range(2)))
+            connection.execute('UPDATE [table_parent] SET single_child=2 WHERE id_table_parent=1;')
+        object_provider: ObjectProvider = ObjectProvider.load_from_json_file('testfiles/op_definition.json')
+        connection: Connection = self.database.create_connection()
+        queries: List[str] = []
+        connection.set_trace_callback(queries.append)
+        parents: List[ParentObject] = object_provider._query_objects(self.database, connection,
+                                                                     'test.dbdata.ParentObject', None, None)
+        connection.close()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual([p.id_table_parent for p in parents], [1, 2, 3, 4])
+        self.assertEqual([c.value_1 for c in parents[0].children], ['c2', 'c3'])
+        self.assertEqual([c.value_1 for c in parents[3].children], ['c40', 'c41'])
+        self.assertEqual(parents[0].single_child.value_1, 'c2')
+        self.assertEqual(parents[2].single_child.value_1, 'c20')
+
+    def test_object_mapper(self):
+        object_provider: ObjectProvider = ObjectProvider.load_from_json_file('testfiles/op_definition.json')
+        mapper: ObjectMapper = object_provider.get_mapper('test.dbdata.ChildObject')
+        self.assertIs(object_provider.get_object_definition('test.dbdata.ChildObject'), mapper.definition)
+        self.assertEqual(mapper.column_names, ('id_table_child', 'id_table_parent', 'value_1'))
+        self.assertEqual(mapper.get_select('id_table_parent'),
+                         ('SELECT id_table_child, id_table_parent, value_1 FROM [table_child]', 1))
+        self.assertEqual(object_provider.get_mapper('test.dbdata.ParentObject').get_select('other')[1], 3)
+        child: ChildObject = mapper.build((5, 1, 'five'))
+        self.assertIsInstance(child, ChildObject)
+        self.assertEqual((child.id_table_child, child.id_table_parent, child.value_1), (5, 1, 'five'))
+        with self.assertRaises(ValueError):
+            object_provider.get_mapper('test.dbdata.Missing')
+
+        mapper.definition.property_sources[2].name = 'value 1'
+        child = ObjectMapper(mapper.definition).build((5, 1, 'five'))
+        self.assertEqual(getattr(child, 'value 1'), 'five')
+
+    def test_session_identity_map(self):
+        with self.database.transaction() as connection:
+            connection.execute('UPDATE [table_parent] SET single_child=2 WHERE id_table_parent=1;')
+        object_provider: ObjectProvider = ObjectProvider.load_from_json_file('testfiles/op_definition.json')
+        session: ObjectSession = object_provider.session(self.database)
+        parent: ParentObject = session.query_objects('test.dbdata.ParentObject')[0]
+        self.assertIs(parent.single_child, parent.children[0])
+        self.assertIs(session.get('test.dbdata.ChildObject', 3), parent.children[1])
+        self.assertIs(session.query_objects('test.dbdata.ParentObject')[0], parent)
+        self.assertIsNone(session.get('test.dbdata.ChildObject', 100))
+        self.assertIsNot(object_provider.session(self.database).get('test.dbdata.ChildObject', 3), parent.children[1])
+
+    def test_object_cache(self):
+        object_provider: ObjectProvider = ObjectProvider.load_from_json_file('testfiles/op_definition.json')
+        object_provider.cache = ObjectCache(100)
+        parent: ParentObject = object_provider.session(self.database).query_objects('test.dbdata.ParentObject')[0]
+        connection: Connection = self.database.create_connection()
+        queries: List[str] = []
+        connection.set_trace_callback(queries.append)
+        session: ObjectSession = object_provider.session(self.database, connection)
+        self.assertIs(session.query_objects('test.dbdata.ParentObject')[0], parent)
+        self.assertIs(session.get('test.dbdata.ChildObject', 2), parent.children[0])
+        self.assertIs(session.get('test.dbdata.ChildObject', 2), parent.children[0])
+        # Unchanged rows are still read, but no relationship of a reused object is loaded again
+        self.assertEqual(len(queries), 2)
+
+        # A row changed by another writer is built again
+        with self.database.transaction() as writer:
+            writer.execute('UPDATE [table_child] SET value_1=\'changed\' WHERE id_table_child=2;')
+        child: ChildObject = object_provider.session(self.database).get('test.dbdata.ChildObject', 2)
+        self.assertIsNot(child, parent.children[0])
+        self.assertEqual(child.value_1, 'changed')
+        self.assertEqual(object_provider.cache.stale, 1)
+
+        # Objects referencing a written one are dropped with it
+        ds: DataSet = DataSet()
+        ds.merge_row(DataRow('table_child', 3))
+        object_provider.invalidate_data_set(ds)
+        self.assertEqual(len(object_provider.cache), 1)
+        self.assertIsNot(object_provider.session(self.database).query_objects('test.dbdata.ParentObject')[0], parent)
+        connection.close()
+
+        cache: ObjectCache = ObjectCache(2)
+        for i in range(3):
+            cache.put(('test', i), i, (i,))
+        self.assertIsNone(cache.get(('test', 0), (0,)))
+        self.assertEqual(cache.get(('test', 2), (2,)), 2)
+        self.assertIsNone(cache.get(('test', 1), (10,)))
+        self.assertEqual(cache.metrics(), {'cached_objects': 1, 'hits': 1, 'misses': 1, 'stale': 1})
@@ -0,0 +1,93 @@
+import pathlib
+import threading
+import unittest
+
+from bot.dispatcher import UpdateDispatcher
+from bot.offset import UpdateOffset
+from data import Update
+from db.database import Database
+from test.test_dispatcher import create_update
+
+PARAMETER_DB: dict = {
+    'filename': 'test.sqlite',
+    'tables': [{'name': 'parameter',
+                'columns': [{'name': 'key', 'type': 'str'}, {'name': 'value', 'type': 'str'}],
+                'primary_key': 'key',
+                'foreign_keys': []}]
+}
+
+
+class TestUpdateOffset(unittest.TestCase):
+    def setUp(self):
+        self.database: Database = Database.from_json(PARAMETER_DB)
+        self.database.create_tables()
+
+    def tearDown(self):
+        db_file: pathlib.Path = pathlib.Path('test.sqlite')
+        if db_file.exists():
+            db_file.unlink()
+
+    def test_no_offset(self):
+        offset: UpdateOffset = UpdateOffset(self.database, 60.)
+        self.assertIsNone(offset.next_offset())
+
+    def test_checkpoint_interval(self):
+        offset: UpdateOffset = UpdateOffset(self.database, 60.)
+        offset.advance(10)
+        self.assertEqual(offset.next_offset(), 11)
+        self.assertFalse(offset.checkpoint_if_due())
+        self.assertIsNone(UpdateOffset(self.database, 60.).load())
+        offset.checkpoint_interval = 0.
+        self.assertTrue(offset.checkpoint_if_due())
+        self.assertEqual(UpdateOffset(self.database, 60.).load(), 10)
+        self.assertFalse(offset.checkpoint())
+
+    def test_recovery_resumes_after_checkpoint(self):
+        offset: UpdateOffset = UpdateOffset(self.database, 60.)
+        offset.advance(5)
+        offset.checkpoint()
+        offset.advance(8)
+        offset.advance(7)
+        self.assertEqual(offset.next_offset(), 9)
+        # Crash without checkpoint: updates after 5 are requested again
+        self.assertEqual(UpdateOffset(self.database, 60.).next_offset(), 6)
+
+    def test_in_flight_update_holds_offset(self):
+        offset: UpdateOffset = UpdateOffset(self.database, 60.)
+        release: threading.Event = threading.Event()
+
+        def handler(update: Update) -> None:
+            if update.id_update == 2:
+                release.wait(5.)
+
+        dispatcher: UpdateDispatcher = UpdateDispatcher(handler, 4, on_done=lambda u: offset.complete(u.id_update))
+        dispatcher.start()
+        for i in range(1, 5):
+            self.assertTrue(offset.begin(i, 2))
+            # Persisted at once, handled by the dispatcher
+            offset.complete(i)
+            dispatcher.submit(create_update(i, i))
+        while offset.in_flight() > 1:
+            offset.wait_for_progress(0.01)
+        self.assertEqual(offset.next_offset(), 2)
+        self.assertFalse(offset.begin(2, 2))
+        offset.checkpoint()
+        self.assertEqual(UpdateOffset(self.database, 60.).next_offset(), 2)
+
+        release.set()
+        dispatcher.stop()
+        self.assertEqual(offset.in_flight(), 0)
+        self.assertEqual(offset.next_offset(), 5)
+
+    def test_all_stages_required(self):
+        offset: UpdateOffset = UpdateOffset(self.database, 60.)
+        offset.begin(1, 2)
+        offset.complete(1)
+        self.assertIsNone(offset.next_offset())
+        offset.complete(1)
+        offset.complete(7)
+        self.assertEqual(offset.next_offset(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from bot.base import TelegramError
+from bot.outbox import OutboundQueue
+from data import Chat
+
+
+def create_chat(id_chat: int, chat_type: str = 'private') -> Chat:
+    chat: Chat = Chat()
+    chat.id_chat = id_chat
+    chat.type = chat_type
+    return chat
+
+
+class FakeApi(object):
+    def __init__(self):
+        self.calls: List[Tuple[float, int, str]] = []
+        self.throttle: Dict[str, int] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def call(self, action: str, params: Dict) -> Dict:
+        with self.lock:
+            if self.throttle.get(params['text'], 0) > 0:
+                self.throttle[params['text']] -= 1
+                raise TelegramError('Too Many Requests', 429, 'Too Many Requests: retry after 1', 0.2)
+            self.calls.append((time.time(), params['chat_id'], params['text']))
+        return {'ok': True, 'result': params}
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        self.api: FakeApi = FakeApi()
+        self.outbox: OutboundQueue = OutboundQueue(self.api.call, sender_count=4, global_rate=30)
+        self.outbox.CHAT_INTERVAL = 0.05
+        self.outbox.start()
+
+    def tearDown(self):
+        self.outbox.stop()
+
+    def test_chat_order_and_interval(self):
+        chat: Chat = create_chat(1)
+        futures: List[Future] = [self.outbox.submit(chat, 'sendMessage', {'chat_id': 1, 'text': str(i)}) for i in range(5)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual([c[2] for c in self.api.calls], [str(i) for i in range(5)])
+        for previous, current in zip(self.api.calls, self.api.calls[1:]):
+            self.assertGreaterEqual(current[0] - previous[0], 0.045)
+
+    def test_global_rate(self):
+        self.outbox.global_rate = 5
+        futures: List[Future] = [self.outbox.submit(create_chat(i), 'sendMessage', {'chat_id': i, 'text': 'x'})
+                                 for i in range(10)]
+        for future in futures:
+            future.result(5)
+        times: List[float] = sorted(c[0] for c in self.api.calls)
+        self.assertGreaterEqual(times[5] - times[0], 0.95)
+
+    def test_retry_after(self):
+        self.api.throttle['flood'] = 1
+        chat: Chat = create_chat(2)
+        start: float = time.time()
+        first: Future = self.outbox.submit(chat, 'sendMessage', {'chat_id': 2, 'text': 'flood'})
+        second: Future = self.outbox.submit(chat, 'sendMessage', {'chat_id': 2, 'text': 'next'})
+        self.assertEqual(first.result(5)['result']['text'], 'flood')
+        second.result(5)
+        self.assertGreaterEqual(self.api.calls[0][0] - start, 0.19)
+        self.assertEqual([c[2] for c in self.api.calls], ['flood', 'next'])
+        self.assertEqual(self.outbox.throttled_count, 1)
+
+    def test_stop_drains_pending(self):
+        futures: List[Future] = [self.outbox.submit(create_chat(3), 'sendMessage', {'chat_id': 3, 'text': str(i)})
+                                 for i in range(3)]
+        self.outbox.stop()
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertRaises(RuntimeError, self.outbox.submit, create_chat(3), 'sendMessage', {'chat_id': 3, 'text': 'x'})
+
+
+if __name__ == '__main__':
+    unittest.main()
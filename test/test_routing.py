@@ -0,0 +1,42 @@
+import unittest
+
+from bot.routing import RoutingIndex
+
+
+class TestRoutingIndex(unittest.TestCase):
+    def setUp(self):
+        self.routing: RoutingIndex = RoutingIndex()
+        self.routing.add('base')
+        self.routing.add('xkcd', ['xkcd'])
+        self.routing.add('reminder', ['remind', 'testremind'], 'cmd:w interval:t msg:*w')
+        self.routing.add('echo')
+        self.routing.add('other_xkcd', ['XKCD'])
+
+    def test_keyword_route(self):
+        self.assertEqual(self.routing.route('xkcd random'), ['base', 'xkcd', 'echo', 'other_xkcd'])
+        self.assertEqual(self.routing.route('Xkcd'), ['base', 'xkcd', 'echo', 'other_xkcd'])
+
+    def test_catch_all_only(self):
+        self.assertEqual(self.routing.route('hello world'), ['base', 'echo'])
+        self.assertEqual(self.routing.route(None), ['base', 'echo'])
+        self.assertEqual(self.routing.route(''), ['base', 'echo'])
+
+    def test_pattern(self):
+        self.assertEqual(self.routing.route('remind 5m turn off oven'), ['base', 'reminder', 'echo'])
+        self.assertEqual(self.routing.route('testremind 1h x'), ['base', 'reminder', 'echo'])
+        self.assertEqual(self.routing.route('remind soon'), ['base', 'echo'])
+
+    def test_remove(self):
+        self.routing.remove('xkcd')
+        self.routing.remove('echo')
+        self.assertEqual(self.routing.route('xkcd random'), ['base', 'other_xkcd'])
+        self.assertEqual(self.routing.route('hello world'), ['base'])
+        self.routing.add('xkcd', ['xkcd'])
+        self.assertEqual(self.routing.route('xkcd random'), ['base', 'other_xkcd', 'xkcd'])
+
+    def test_duplicate(self):
+        self.assertRaises(ValueError, self.routing.add, 'xkcd', ['other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from typing import Dict, List
+
+from db.chatstate import ChatState
+from db.statecodec import StateCodec
+
+
+class Question(object):
+    def __init__(self):
+        self.text: str = ''
+        self.answers: List[str] = []
+
+
+class QuestionV2(object):
+    def __init__(self):
+        self.text: str = ''
+        self.options: List[str] = []
+        self.difficulty: str = 'easy'
+
+
+class TestStateCodec(unittest.TestCase):
+    def setUp(self):
+        self.codec: StateCodec = StateCodec()
+        self.codec.register('question', Question)
+
+    def test_round_trip(self):
+        question: Question = Question()
+        question.text = 'Capital of Spain?'
+        question.answers = ['Madrid', 'Lisbon']
+        data: Dict = self.codec.decode(self.codec.encode({'action': 'question', 'question': question, 'index': 1}))
+        self.assertEqual(data['action'], 'question')
+        self.assertEqual(data['index'], 1)
+        self.assertIsInstance(data['question'], Question)
+        self.assertEqual(data['question'].answers, ['Madrid', 'Lisbon'])
+
+    def test_unregistered_type(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode({'question': QuestionV2()})
+
+    def test_migration(self):
+        question: Question = Question()
+        question.answers = ['a', 'b']
+        payload: bytes = self.codec.encode({'question': question})
+        codec_v2: StateCodec = StateCodec()
+        codec_v2.register('question', QuestionV2, version=2)
+        codec_v2.add_migration('question', 1, lambda value: {'text': value['text'], 'options': value['answers']})
+        migrated: QuestionV2 = codec_v2.decode(payload)['question']
+        self.assertEqual(migrated.options, ['a', 'b'])
+        self.assertEqual(migrated.difficulty, 'easy')
+
+    def test_lazy_decode(self):
+        payload: bytes = self.codec.encode({'action': 'line'})
+        state: ChatState = ChatState.from_payload(1, 'tua', 0., payload, self.codec)
+        self.assertIsNone(state._data)
+        self.assertEqual(state.encode_data(self.codec), payload)
+        self.assertEqual(state.data, {'action': 'line'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,3 +20,16 @@ class TestUtils(unittest.TestCase):
     def test_indexof_notsuccess(self):
         l: List[int] = [0, 1, 2, 3, 0]
         self.assertEqual(len(utils.index_of(l, 4)), 0)
+
+    def test_phase_timer(self):
+        timer: utils.PhaseTimer = utils.PhaseTimer()
+        with timer.phase('first'):
+            pass
+        with self.assertRaises(ValueError):
+            with timer.phase('failed'):
+                raise ValueError()
+        self.assertEqual([name for name, _ in timer.phases], ['first', 'failed'])
+        with self.assertLogs(level='INFO') as logs:
+            timer.report('Startup')
+        self.assertEqual(len(logs.output), 3)
+        utils.PhaseTimer(enabled=False).report('Startup')
@@ -0,0 +1,76 @@
+import http.client
+import threading
+import unittest
+from typing import Dict, List
+
+from bot.webhook import WebhookServer, SECRET_TOKEN_HEADER
+from data import Update
+
+
+class TestWebhookServer(unittest.TestCase):
+    def setUp(self):
+        with open('testfiles/update.json', 'r') as fobj:
+            self.body: bytes = fobj.read().encode('utf8')
+        self.received: List[Update] = []
+        self.webhook: WebhookServer = WebhookServer(self.received.append, '127.0.0.1', 0, '/telegram', 'secret', 2)
+        self.webhook.start()
+
+    def tearDown(self):
+        self.webhook.stop()
+
+    def post(self, path: str, body: bytes, headers: Dict[str, str]) -> int:
+        connection: http.client.HTTPConnection = http.client.HTTPConnection(*self.webhook.server_address, timeout=5)
+        connection.request('POST', path, body, headers)
+        status: int = connection.getresponse().status
+        connection.close()
+        return status
+
+    def test_update_received(self):
+        status: int = self.post('/telegram', self.body, {SECRET_TOKEN_HEADER: 'secret'})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0].id_update, 100200300)
+        self.assertEqual(self.received[0].message.text, 'xkcd random')
+        self.assertEqual(self.received[0].get_chat().id_chat, 12345678)
+
+    def test_secret_token_checked(self):
+        self.assertEqual(self.post('/telegram', self.body, {}), 403)
+        self.assertEqual(self.post('/telegram', self.body, {SECRET_TOKEN_HEADER: 'wrong'}), 403)
+        self.assertEqual(len(self.received), 0)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post('/other', self.body, {SECRET_TOKEN_HEADER: 'secret'}), 404)
+        self.assertEqual(self.post('/telegram', b'{"no_update": 1}', {SECRET_TOKEN_HEADER: 'secret'}), 400)
+        self.assertEqual(len(self.received), 0)
+
+    def test_secret_token_required(self):
+        for secret_token in (None, ''):
+            with self.assertRaises(ValueError):
+                WebhookServer(self.received.append, '127.0.0.1', 0, '/telegram', secret_token)
+
+    def test_bounded_concurrency(self):
+        release: threading.Event = threading.Event()
+        active: List[int] = [0, 0]
+        lock: threading.Lock = threading.Lock()
+
+        def slow_handler(update: Update) -> None:
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            release.wait(0.2)
+            with lock:
+                active[0] -= 1
+
+        self.webhook.on_update = slow_handler
+        clients: List[threading.Thread] = [
+            threading.Thread(target=self.post, args=('/telegram', self.body, {SECRET_TOKEN_HEADER: 'secret'}))
+            for _ in range(6)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertEqual(active[1], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import pathlib
+import unittest
+from typing import List
+
+from db.database import Database, DataSet, DataTable
+from db.writebehind import WriteBehindWriter
+from test.dbdata import ParentObject
+
+
+class TestWriteBehindWriter(unittest.TestCase):
+    def setUp(self):
+        self.database: Database = Database.load_from_json_file('testfiles/db_definition.json')
+        self.database.create_tables()
+
+    def tearDown(self):
+        db_file: pathlib.Path = pathlib.Path('test.sqlite')
+        if db_file.exists():
+            db_file.unlink()
+
+    def create_parent(self, id_table_parent: int, value_1: str) -> ParentObject:
+        parent: ParentObject = ParentObject()
+        parent.id_table_parent = id_table_parent
+        parent.value_1 = value_1
+        return parent
+
+    def test_flush_on_stop(self):
+        writer: WriteBehindWriter = WriteBehindWriter(self.database, batch_size=10, max_delay=0.5)
+        writer.start()
+        for i in range(25):
+            writer.submit(self.create_parent(i, f'value {i}').to_data_set())
+        writer.stop()
+        with self.database.create_connection() as connection:
+            ds: DataSet = self.database.query(connection, 'table_parent', None, False)
+        self.assertEqual(len(ds.tables['table_parent'].rows), 25)
+        self.assertEqual(writer.data_sets_written, 25)
+        self.assertLess(writer.batches_committed, 25)
+        self.assertEqual(writer.lag(), 0.)
+
+    def test_submission_order(self):
+        writer: WriteBehindWriter = WriteBehindWriter(self.database)
+        writer.start()
+        for value in ('first', 'second', 'third'):
+            writer.submit(self.create_parent(1, value).to_data_set())
+        writer.flush()
+        with self.database.create_connection() as connection:
+            ds: DataSet = self.database.query(connection, 'table_parent', 1, False)
+        dt: DataTable = ds.tables['table_parent']
+        self.assertEqual(list(dt.rows.values())[0].get('value_1'), 'third')
+        writer.stop()
+
+    def test_bad_data_set_dropped_alone(self):
+        writer: WriteBehindWriter = WriteBehindWriter(self.database, batch_size=10, retries=1, retry_delay=0.)
+        done: List[int] = []
+        for i in range(5):
+            # value_1 is NOT NULL
+            parent: ParentObject = self.create_parent(i, f'value {i}' if i != 2 else None)
+            writer.submit(parent.to_data_set(), lambda i=i: done.append(i))
+        with self.assertLogs(level='WARNING') as logs:
+            writer.start()
+            writer.stop()
+        with self.database.create_connection() as connection:
+            ds: DataSet = self.database.query(connection, 'table_parent', None, False)
+        self.assertEqual(sorted(ds.tables['table_parent'].rows), [0, 1, 3, 4])
+        self.assertEqual(writer.batches_failed, 2)
+        self.assertEqual(writer.metrics()['data_sets_dropped'], 1)
+        self.assertEqual(writer.data_sets_written, 4)
+        self.assertEqual(done, [0, 1, 2, 3, 4])
+        self.assertEqual(len([r for r in logs.records if r.levelname == 'ERROR']), 1)
+
+    def test_on_written_after_commit(self):
+        committed: List[int] = []
+
+        def on_written(data_set: DataSet) -> None:
+            with self.database.create_connection() as connection:
+                ds: DataSet = self.database.query(connection, 'table_parent', None, False)
+            committed.append(len(ds.tables['table_parent'].rows))
+
+        writer: WriteBehindWriter = WriteBehindWriter(self.database, on_written=on_written)
+        writer.start()
+        writer.submit(self.create_parent(1, 'first').to_data_set())
+        writer.stop()
+        self.assertEqual(committed, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
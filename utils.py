@@ -1,9 +1,12 @@
+import contextlib
 import http.client
 import json
+import logging
+import time
 import urllib.request
 import urllib.parse
 import socket
-from typing import Iterable, List, Dict, Callable, TypeVar
+from typing import Iterable, List, Dict, Callable, TypeVar, Tuple, Iterator
 import re
 
 import lxml.html
@@ -148,6 +151,28 @@ def get_ip_address() -> str:
     s.connect(("8.8.8.8", 80))
     return s.getsockname()[0]
 
+
+class PhaseTimer(object):
+    # Wall-clock duration of named phases; report() logs them only when enabled
+    def __init__(self, enabled: bool = True):
+        self.enabled: bool = enabled
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self, title: str) -> None:
+        if not self.enabled:
+            return
+        for name, seconds in self.phases:
+            logging.info(f'{title}: {name} took {seconds * 1e3:.1f} ms')
+        logging.info(f'{title}: {sum(s for _, s in self.phases) * 1e3:.1f} ms in total')
+
 # 'cmd:w num:n msg:*w'
 # def parse_words(input_str: str, word_group_str: str) -> Dict[str, object]:
 #     words = list(map(str.lower, input_str.split(' ')))